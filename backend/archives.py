@@ -0,0 +1,82 @@
+"""
+Helpers for reading image uploads that may be bundled in zip/tar archives.
+"""
+import os
+import tarfile
+import zipfile
+
+from preprocessing import ImageTooLarge
+
+ARCHIVE_EXTENSIONS = ('.zip', '.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz', '.txz')
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.gif', '.tif', '.tiff', '.webp', '.dcm', '.dicom')
+
+
+def read_limited(fileobj, max_bytes=None):
+    """Read a file object, raising ImageTooLarge once more than ``max_bytes``
+    have been read (so an oversized or decompression-bomb member is never
+    held in memory in full)"""
+    if not max_bytes:
+        return fileobj.read()
+    data = fileobj.read(max_bytes + 1)
+    if len(data) > max_bytes:
+        raise ImageTooLarge(f"Image is larger than the {max_bytes / 2 ** 20:g} MB limit")
+    return data
+
+
+def is_archive(filename):
+    return (filename or '').lower().endswith(ARCHIVE_EXTENSIONS)
+
+
+def is_image_member(name):
+    """Skip directories, hidden files and macOS resource forks inside archives"""
+    base = os.path.basename(name)
+    if not base or base.startswith('.') or '__MACOSX/' in name:
+        return False
+    return base.lower().endswith(IMAGE_EXTENSIONS)
+
+
+def _read_member(member, max_bytes):
+    try:
+        return read_limited(member, max_bytes)
+    except ImageTooLarge as e:
+        return e
+
+
+def iter_archive(fileobj, filename, max_bytes=None):
+    """Yield (member_name, bytes) for every image in a zip or tar archive.
+
+    Members are read one at a time, so only the current image is held in
+    memory. Tar archives are read in stream mode and do not need a seekable
+    file object; zip archives keep their index at the end and do. A member
+    over ``max_bytes`` is yielded as its ImageTooLarge error instead of its
+    bytes, so it fails on its own rather than the whole archive.
+    """
+    if filename.lower().endswith('.zip'):
+        with zipfile.ZipFile(fileobj) as archive:
+            for info in archive.infolist():
+                if info.is_dir() or not is_image_member(info.filename):
+                    continue
+                with archive.open(info) as member:
+                    yield info.filename, _read_member(member, max_bytes)
+    else:
+        with tarfile.open(fileobj=fileobj, mode='r|*') as archive:
+            for info in archive:
+                if not info.isfile() or not is_image_member(info.name):
+                    continue
+                member = archive.extractfile(info)
+                if member is None:
+                    continue
+                yield info.name, _read_member(member, max_bytes)
+
+
+def iter_uploads(files, max_bytes=None):
+    """Yield (name, bytes) for uploaded files, expanding any archives in order
+    (images over ``max_bytes`` as in iter_archive)"""
+    for file in files:
+        if not file.filename:
+            continue
+        if is_archive(file.filename):
+            for name, data in iter_archive(file.stream, file.filename, max_bytes):
+                yield f"{file.filename}/{name}", data
+        else:
+            yield file.filename, _read_member(file, max_bytes)
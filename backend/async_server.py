@@ -0,0 +1,378 @@
+#!/usr/bin/env python3
+"""
+asyncio (aiohttp) entry point, an alternative to wsgi.py.
+
+Uploads are read on the event loop without tying up a thread per client.
+Decoding and cache I/O run on a bounded thread pool and inference goes
+through the same micro-batching scheduler, model and cache as main.py.
+At most ASYNC_MAX_IN_FLIGHT prediction requests are admitted at a time;
+further requests get 429 with Retry-After straight away instead of queueing
+until the gunicorn timeout. Requests that wait longer than
+ASYNC_REQUEST_TIMEOUT for their result (counted once the upload has been
+read) get 503. Work that is still queued is then cancelled; work already
+running keeps the request's admission slot until it finishes, so retries
+cannot pile up work the server no longer accounts for.
+
+    python async_server.py
+    gunicorn async_server:app -c gunicorn.conf.py --worker-class aiohttp.GunicornWebWorker
+"""
+import asyncio
+import io
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from aiohttp import web
+from werkzeug.datastructures import FileStorage
+
+import main
+import metrics
+from archives import iter_uploads
+from metrics import ERRORS, IN_FLIGHT, PREDICTIONS, REQUESTS, REQUEST_SECONDS, STAGE_SECONDS
+from model_loader import ModelNotReady
+
+# Admission control and timeouts
+ASYNC_MAX_IN_FLIGHT = int(os.environ.get('ASYNC_MAX_IN_FLIGHT', str(4 * main.BATCH_MAX_SIZE)))
+ASYNC_REQUEST_TIMEOUT = float(os.environ.get('ASYNC_REQUEST_TIMEOUT', '30'))
+# Same body limit as the Flask app (MAX_UPLOAD_MB) unless set; 0 disables it
+ASYNC_MAX_UPLOAD_MB = float(os.environ.get('ASYNC_MAX_UPLOAD_MB') or main.MAX_UPLOAD_MB)
+# Threads running whole /predict/batch jobs (each fans out to main.preprocess_pool),
+# and how many more jobs may wait for one before /predict/batch returns 503
+ASYNC_BATCH_WORKERS = int(os.environ.get('ASYNC_BATCH_WORKERS', '2'))
+ASYNC_BATCH_QUEUE = int(os.environ.get('ASYNC_BATCH_QUEUE', '2'))
+OVERLOADED_RETRY_AFTER = '1'
+NOT_READY_RETRY_AFTER = '5'
+
+batch_pool = ThreadPoolExecutor(max_workers=ASYNC_BATCH_WORKERS, thread_name_prefix='async-batch')
+
+
+class AdmissionControl:
+    """Non-blocking cap on concurrently admitted requests"""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.in_flight = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self._lock = threading.Lock()
+
+    def try_acquire(self):
+        with self._lock:
+            if self.in_flight >= self.limit:
+                self.rejected += 1
+                return False
+            self.in_flight += 1
+            self.admitted += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self.in_flight -= 1
+
+    def release_after(self, futures):
+        """Release once every one of ``futures`` has finished"""
+        pending = [future for future in futures if not future.done()]
+        if not pending:
+            self.release()
+            return
+        remaining = [len(pending)]
+
+        def done(_):
+            with self._lock:
+                remaining[0] -= 1
+                last = remaining[0] == 0
+            if last:
+                self.release()
+
+        for future in pending:
+            future.add_done_callback(done)
+
+    def record_timeout(self):
+        with self._lock:
+            self.timed_out += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'max_in_flight': self.limit,
+                'in_flight': self.in_flight,
+                'admitted': self.admitted,
+                'rejected': self.rejected,
+                'timed_out': self.timed_out,
+            }
+
+
+admission = AdmissionControl(ASYNC_MAX_IN_FLIGHT)
+# Slots for /predict/batch jobs running on or queued for batch_pool
+batch_jobs = AdmissionControl(ASYNC_BATCH_WORKERS + ASYNC_BATCH_QUEUE)
+
+
+class RequestTimeout(Exception):
+    """The request's work did not finish within ASYNC_REQUEST_TIMEOUT"""
+
+
+class BatchQueueFull(Exception):
+    """batch_pool already has ASYNC_BATCH_QUEUE jobs waiting"""
+
+
+def error_response(message, status, retry_after=None):
+    headers = {'Retry-After': retry_after} if retry_after else None
+    return web.json_response({'error': message}, status=status, headers=headers)
+
+
+def start_work(request):
+    """Start the request's ASYNC_REQUEST_TIMEOUT clock (call once the upload is read)"""
+    request['deadline'] = asyncio.get_running_loop().time() + ASYNC_REQUEST_TIMEOUT
+
+
+async def wait_work(request, future):
+    """Await a concurrent.futures.Future started for ``request`` until its
+    deadline. On timeout the future is cancelled if it has not started, and
+    the request's admission slot is held until it finishes either way."""
+    request['work'].append(future)
+    remaining = request['deadline'] - asyncio.get_running_loop().time()
+    try:
+        # shield: a timeout must not cancel the chained future behind our back
+        return await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), max(remaining, 0))
+    except asyncio.TimeoutError:
+        future.cancel()
+        raise RequestTimeout() from None
+
+
+def admitted(handler):
+    """Reject requests before reading their body when the model is not
+    ready or the server is saturated, and release the slot once the
+    request's work has finished"""
+    async def wrapper(request):
+        endpoint = request.path
+        if main.model_loader.state == 'failed':
+            ERRORS.inc(endpoint=endpoint, type='ModelLoadFailed')
+            return error_response(f"Model not loaded: {main.model_loader.error}", 500)
+        if not main.model_loader.accepting:
+            ERRORS.inc(endpoint=endpoint, type='ModelNotReady')
+            return error_response('Model is still loading, please retry shortly', 503, NOT_READY_RETRY_AFTER)
+        if not admission.try_acquire():
+            ERRORS.inc(endpoint=endpoint, type='Overloaded')
+            return error_response('Server is busy, please retry shortly', 429, OVERLOADED_RETRY_AFTER)
+        request['work'] = []
+        try:
+            return await handler(request)
+        except RequestTimeout:
+            admission.record_timeout()
+            ERRORS.inc(endpoint=endpoint, type='Timeout')
+            return error_response('Prediction timed out, please retry shortly', 503, OVERLOADED_RETRY_AFTER)
+        except BatchQueueFull:
+            ERRORS.inc(endpoint=endpoint, type='Overloaded')
+            return error_response('Too many batch jobs queued, please retry shortly', 503, OVERLOADED_RETRY_AFTER)
+        except ModelNotReady:
+            ERRORS.inc(endpoint=endpoint, type='ModelNotReady')
+            return error_response('Model is still loading, please retry shortly', 503, NOT_READY_RETRY_AFTER)
+        except web.HTTPRequestEntityTooLarge as e:
+            ERRORS.inc(endpoint=endpoint, type='RequestEntityTooLarge')
+            return error_response(f"RequestEntityTooLarge: {e.text}", 413)
+        finally:
+            admission.release_after(request['work'])
+    return wrapper
+
+
+async def read_files(request, max_part_bytes=None):
+    """Read multipart file fields as (filename, bytes) without blocking the loop.
+
+    Parts are read in chunks, and reading stops with a 413 as soon as the
+    body passes ASYNC_MAX_UPLOAD_MB or a part passes ``max_part_bytes``
+    (aiohttp's client_max_size does not cover multipart reads).
+    """
+    if not request.content_type.startswith('multipart/'):
+        return []
+    max_bytes = int(ASYNC_MAX_UPLOAD_MB * 1024 * 1024)
+    files = []
+    total = 0
+    with STAGE_SECONDS.time(stage='upload_read'):
+        reader = await request.multipart()
+        async for part in reader:
+            if part.filename is None:
+                continue
+            chunks = []
+            size = 0
+            while chunk := await part.read_chunk():
+                size += len(chunk)
+                total += len(chunk)
+                if (max_part_bytes and size > max_part_bytes) or (max_bytes and total > max_bytes):
+                    limit = max_part_bytes if max_part_bytes and size > max_part_bytes else max_bytes
+                    raise web.HTTPRequestEntityTooLarge(max_size=limit, actual_size=total)
+                chunks.append(chunk)
+            files.append((part.name, part.filename, b''.join(chunks)))
+    return files
+
+
+@web.middleware
+async def metrics_middleware(request, handler):
+    route = request.match_info.route.resource
+    endpoint = route.canonical if route is not None else 'unmatched'
+    started = time.perf_counter()
+    IN_FLIGHT.inc(endpoint=endpoint)
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        IN_FLIGHT.dec(endpoint=endpoint)
+        REQUESTS.inc(endpoint=endpoint, status=status)
+        REQUEST_SECONDS.observe(time.perf_counter() - started, endpoint=endpoint)
+
+
+@web.middleware
+async def cors_middleware(request, handler):
+    allowed = main.get_allowed_origins()
+    origin = request.headers.get('Origin')
+    if request.method == 'OPTIONS':
+        response = web.Response(status=204)
+    else:
+        response = await handler(request)
+    if origin and ('*' in allowed or origin in allowed):
+        response.headers['Access-Control-Allow-Origin'] = '*' if '*' in allowed else origin
+        response.headers['Access-Control-Allow-Methods'] = 'GET, POST, OPTIONS'
+        response.headers['Access-Control-Allow-Headers'] = 'Content-Type'
+    return response
+
+
+@admitted
+async def predict(request):
+    files = [(filename, data) for name, filename, data in await read_files(request, main.MAX_IMAGE_BYTES)
+             if name == 'file']
+    if not files:
+        return error_response('No file provided', 400)
+    filename, image_bytes = files[0]
+    if filename == '':
+        return error_response('No file selected', 400)
+
+    tta = main.is_enabled(request.query.get('tta'))
+    explain = main.is_enabled(request.query.get('explain'))
+    if tta and explain:
+        ERRORS.inc(endpoint='/predict', type='bad_request')
+        return error_response('tta and explain cannot be combined', 400)
+    if explain and main.model_loader.ready and main.model_loader.runtime.mode == 'quantized':
+        ERRORS.inc(endpoint='/predict', type='bad_request')
+        return error_response('Explanations are not available with MODEL_MODE=quantized', 400)
+
+    start_work(request)
+    _, cache_key, image, result, error = await wait_work(request, main.preprocess_pool.submit(
+        main._safe_load, (filename, image_bytes), main.prediction_namespace(tta, explain)))
+    if error is not None:
+        ERRORS.inc(endpoint='/predict', type=error.split(':', 1)[0])
+        return error_response(error, 413 if error.startswith('ImageTooLarge') else 500)
+    if image is not None:
+        result = await wait_work(request, main.prediction_scheduler(tta, explain).submit(image))
+        # Heatmap encoding and the cache write; not held to the deadline, the result is already computed
+        result = await asyncio.wrap_future(main.preprocess_pool.submit(main.finish_result, result, cache_key))
+
+    with STAGE_SECONDS.time(stage='serialize'):
+        body = main.prediction_body(result, tta, explain)
+        response = web.json_response(body)
+    PREDICTIONS.inc(prediction=body['prediction'], source='cache' if image is None else 'model')
+    return response
+
+
+@admitted
+async def predict_batch(request):
+    files = [FileStorage(io.BytesIO(data), filename=filename) for _, filename, data in await read_files(request)]
+    if not files:
+        return error_response('No files provided', 400)
+
+    def run():
+        main.get_runtime()
+        return list(main.predict_entries(iter_uploads(files, main.MAX_IMAGE_BYTES)))
+
+    # batch_pool's own queue is unbounded; jobs past ASYNC_BATCH_QUEUE get 503
+    if not batch_jobs.try_acquire():
+        raise BatchQueueFull()
+    start_work(request)
+    future = batch_pool.submit(run)
+    future.add_done_callback(lambda _: batch_jobs.release())
+    results = await wait_work(request, future)
+    if not results:
+        return error_response('No images found in upload', 400)
+    return web.json_response({
+        'count': len(results),
+        'errors': sum(1 for result in results if 'error' in result),
+        'results': results
+    })
+
+
+async def health(request):
+    ready = main.model_loader.accepting
+    failed = main.model_loader.state == 'failed'
+    return web.json_response({
+        'status': 'error' if failed else 'ok' if ready else 'loading',
+        'model_loaded': main.model_loader.ready,
+        'live': True,
+        'ready': ready,
+        'model': main.model_loader.status(),
+    }, status=500 if failed else 200 if ready else 503)
+
+
+async def health_live(request):
+    return web.json_response({'status': 'ok', 'live': True})
+
+
+async def health_ready(request):
+    ready = main.model_loader.accepting
+    return web.json_response({
+        'status': 'ok' if ready else main.model_loader.state,
+        'ready': ready,
+        'model': main.model_loader.status()
+    }, status=200 if ready else 503)
+
+
+async def prometheus_metrics(request):
+    return web.Response(body=metrics.render(), headers={'Content-Type': metrics.CONTENT_TYPE})
+
+
+async def model_info(request):
+    return web.json_response(main.model_info())
+
+
+async def stats(request):
+    return web.json_response({
+        'admission': admission.stats(),
+        'batch_jobs': batch_jobs.stats(),
+        'batching': main.scheduler.stats(),
+        'cache': main.cache.stats(),
+        'process': dict(
+            main.process_memory(),
+            pid=os.getpid(),
+            model_mode=main.model_loader.runtime.mode if main.model_loader.ready else None,
+            model_load_seconds=main.model_loader.status()['load_seconds'],
+            first_prediction_seconds=main.first_prediction_seconds,
+        )
+    })
+
+
+def create_app():
+    app = web.Application(
+        client_max_size=int(ASYNC_MAX_UPLOAD_MB * 1024 * 1024),
+        middlewares=[metrics_middleware, cors_middleware],
+    )
+    app.router.add_get('/api/health', health)
+    app.router.add_get('/api/health/live', health_live)
+    app.router.add_get('/api/health/ready', health_ready)
+    app.router.add_get('/api/model', model_info)
+    app.router.add_get('/api/stats', stats)
+    app.router.add_get('/metrics', prometheus_metrics)
+    app.router.add_post('/predict', predict)
+    app.router.add_post('/predict/batch', predict_batch)
+    # Preflight requests are answered by cors_middleware
+    app.router.add_route('OPTIONS', '/{tail:.*}', health_live)
+    return app
+
+
+app = create_app()
+
+if __name__ == '__main__':
+    web.run_app(app, host='0.0.0.0', port=int(os.environ.get('PORT', '5000')))
@@ -0,0 +1,161 @@
+"""
+Dynamic micro-batching for model inference.
+
+Concurrent requests submit single inputs to a BatchScheduler, which groups
+them into one batch (bounded by a maximum size and a maximum wait time),
+runs the batch through the model once and hands each caller its own result.
+"""
+import os
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+from timing import percentile
+
+# Number of recent batches/requests kept for the percentile figures in stats()
+STATS_WINDOW = 1024
+
+
+class BatchScheduler:
+    """Groups concurrent inference requests into batched model calls.
+
+    ``run_batch`` receives a list of submitted items and must return a list of
+    results in the same order. A batch is dispatched as soon as
+    ``max_batch_size`` items are waiting or the oldest waiting item has been
+    queued for ``max_wait_ms`` milliseconds, whichever comes first.
+
+    The worker thread is started on first use (and restarted after a fork),
+    so the scheduler can be created at import time in a preloaded app.
+    """
+
+    def __init__(self, run_batch, max_batch_size=16, max_wait_ms=5.0):
+        if max_batch_size < 1:
+            raise ValueError("max_batch_size must be at least 1")
+        self.run_batch = run_batch
+        self.max_batch_size = int(max_batch_size)
+        self.max_wait = max(0.0, float(max_wait_ms)) / 1000.0
+        self._start_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._queue = queue.Queue()
+        self._thread = None
+        self._batches = 0
+        self._items = 0
+        self._errors = 0
+        self._batch_sizes = {}
+        self._recent_sizes = deque(maxlen=STATS_WINDOW)
+        self._recent_waits = deque(maxlen=STATS_WINDOW)
+        self._recent_run_times = deque(maxlen=STATS_WINDOW)
+
+    def _ensure_started(self):
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid != os.getpid():
+                # Threads do not survive fork(); start fresh in the child
+                self._reset()
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._worker, name='batch-scheduler', daemon=True
+                )
+                self._thread.start()
+
+    def submit(self, item):
+        """Queue a single item and return a Future for its result"""
+        self._ensure_started()
+        future = Future()
+        self._queue.put((item, future, time.perf_counter()))
+        return future
+
+    def predict(self, item, timeout=None):
+        """Queue a single item and block until its result is ready"""
+        return self.submit(item).result(timeout=timeout)
+
+    def _collect_batch(self):
+        first = self._queue.get()
+        batch = [first]
+        deadline = first[2] + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            try:
+                if remaining <= 0:
+                    batch.append(self._queue.get_nowait())
+                else:
+                    batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _worker(self):
+        while True:
+            # Drop requests whose caller gave up (cancelled) while queued
+            batch = [entry for entry in self._collect_batch() if entry[1].set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            started = time.perf_counter()
+            items = [entry[0] for entry in batch]
+            futures = [entry[1] for entry in batch]
+            try:
+                results = self.run_batch(items)
+                if len(results) != len(items):
+                    raise RuntimeError(
+                        f"run_batch returned {len(results)} results for {len(items)} items"
+                    )
+            except Exception as e:
+                for future in futures:
+                    future.set_exception(e)
+                failed = True
+            else:
+                for future, result in zip(futures, results):
+                    future.set_result(result)
+                failed = False
+            finished = time.perf_counter()
+            self._record(batch, started, finished, failed)
+
+    def _record(self, batch, started, finished, failed):
+        size = len(batch)
+        with self._stats_lock:
+            self._batches += 1
+            self._items += size
+            if failed:
+                self._errors += 1
+            self._batch_sizes[size] = self._batch_sizes.get(size, 0) + 1
+            self._recent_sizes.append(size)
+            self._recent_run_times.append(finished - started)
+            for _, _, queued_at in batch:
+                self._recent_waits.append(started - queued_at)
+
+    def queue_depth(self):
+        """Number of submitted items waiting for a batch"""
+        return self._queue.qsize()
+
+    def stats(self):
+        """Return queue depth, achieved batch sizes and latency figures"""
+        with self._stats_lock:
+            recent_sizes = list(self._recent_sizes)
+            waits_ms = [w * 1000 for w in self._recent_waits]
+            run_ms = [r * 1000 for r in self._recent_run_times]
+            return {
+                'max_batch_size': self.max_batch_size,
+                'max_wait_ms': self.max_wait * 1000,
+                'queue_depth': self._queue.qsize(),
+                'batches': self._batches,
+                'items': self._items,
+                'failed_batches': self._errors,
+                'avg_batch_size': round(self._items / self._batches, 3) if self._batches else 0.0,
+                'recent_avg_batch_size': round(sum(recent_sizes) / len(recent_sizes), 3) if recent_sizes else 0.0,
+                'batch_size_histogram': {str(k): v for k, v in sorted(self._batch_sizes.items())},
+                'queue_wait_ms': {
+                    'p50': round(percentile(waits_ms, 50), 3),
+                    'p99': round(percentile(waits_ms, 99), 3),
+                },
+                'batch_run_ms': {
+                    'p50': round(percentile(run_ms, 50), 3),
+                    'p99': round(percentile(run_ms, 99), 3),
+                },
+            }
@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+"""
+Inference benchmark suite.
+
+Starts a local server (or targets --url), then measures:
+- startup: time until /api/health/ready answers and until the first prediction
+- single: sequential /predict latency
+- concurrency sweep: closed-loop load at several concurrency levels, with
+  throughput and p50/p95/p99 latency
+- memory: RSS/PSS of every server process after the load
+
+Payloads are the bundled pneumonia.png plus synthetic X-ray-sized JPEGs. A
+counter is appended to every upload so the prediction cache never hits
+(use --cache-hits to measure cached responses instead).
+
+Results are written as JSON together with the commit and configuration, and
+--compare prints the change against an earlier results file.
+
+Usage:
+    python benchmark.py --output bench.json
+    python benchmark.py --server async --workers 2 --concurrency 1 8 32 --compare bench.json
+    MODEL_MODE=quantized python benchmark.py --output bench-int8.json
+    TTA_VIEWS=8 python benchmark.py --tta --compare bench.json   # /predict?tta=1
+    python benchmark.py --explain --compare bench.json           # /predict?explain=1
+"""
+import argparse
+import io
+import itertools
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+import numpy as np
+import requests
+from PIL import Image
+
+from metrics import process_memory
+from startup_benchmark import BASE_DIR, SAMPLE_IMAGE, free_port, wait_for
+from timing import percentile
+
+SERVERS = {
+    'gunicorn': ['gunicorn', 'wsgi:app', '-c', 'gunicorn.conf.py'],
+    'async': ['gunicorn', 'async_server:app', '-c', 'gunicorn.conf.py',
+              '--worker-class', 'aiohttp.GunicornWebWorker'],
+    'flask': [sys.executable, '-c',
+              "import os; from main import app; app.run(host='127.0.0.1', port=int(os.environ['PORT']), threaded=True)"],
+}
+
+
+def synthetic_xray(size=1024, seed=0):
+    """Encode a grayscale, chest X-ray-like image (dark background, two bright
+    lung fields, rib-like bands, film noise) as JPEG bytes"""
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:size, 0:size] / size
+    image = 0.25 + 0.35 * np.exp(-((x - 0.5) ** 2) / 0.08)
+    for cx in (0.3, 0.7):
+        image += 0.3 * np.exp(-(((x - cx) / 0.14) ** 2 + ((y - 0.5) / 0.3) ** 2))
+    image += 0.05 * np.sin(y * 60 + rng.uniform(0, np.pi))
+    image += rng.normal(0, 0.03, image.shape)
+    pixels = (np.clip(image, 0, 1) * 255).astype(np.uint8)
+    buffer = io.BytesIO()
+    Image.fromarray(pixels, mode='L').save(buffer, format='JPEG', quality=90)
+    return buffer.getvalue()
+
+
+def load_payloads(count, size):
+    with open(SAMPLE_IMAGE, 'rb') as f:
+        payloads = [('pneumonia.png', f.read())]
+    payloads += [(f'synthetic_{i}.jpg', synthetic_xray(size, seed=i)) for i in range(count)]
+    return payloads
+
+
+class PayloadSource:
+    """Cycles through payloads; unless repeat is set, every upload gets a
+    unique suffix (ignored by image decoders) so it misses the cache"""
+
+    def __init__(self, payloads, repeat=False):
+        self._cycle = itertools.cycle(payloads)
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+        self.repeat = repeat
+
+    def next(self):
+        with self._lock:
+            name, data = next(self._cycle)
+            n = next(self._counter)
+        if not self.repeat:
+            data = data + n.to_bytes(8, 'little')
+        return name, data
+
+
+def post(session, url, payload, path='/predict', field='file'):
+    name, data = payload
+    started = time.perf_counter()
+    response = session.post(url + path, files={field: (name, data)}, timeout=120)
+    return time.perf_counter() - started, response.status_code
+
+
+def latency_summary(latencies, statuses, elapsed=None):
+    ms = [latency * 1000 for latency in latencies]
+    ok = sum(1 for status in statuses if status == 200)
+    summary = {
+        'requests': len(ms),
+        'ok': ok,
+        'status_counts': {str(k): statuses.count(k) for k in sorted(set(statuses))},
+        'mean_ms': round(statistics.fmean(ms), 3) if ms else 0.0,
+        'p50_ms': round(percentile(ms, 50), 3),
+        'p95_ms': round(percentile(ms, 95), 3),
+        'p99_ms': round(percentile(ms, 99), 3),
+    }
+    if elapsed:
+        summary['throughput_rps'] = round(ok / elapsed, 2)
+    return summary
+
+
+def run_sequential(url, source, count, path='/predict', field='file'):
+    """Sequential requests: latency without queueing or batching effects"""
+    with requests.Session() as session:
+        results = [post(session, url, source.next(), path, field) for _ in range(count)]
+    return latency_summary([r[0] for r in results], [r[1] for r in results])
+
+
+def run_load(url, source, concurrency, duration, path='/predict', field='file'):
+    """Closed-loop load: ``concurrency`` clients send back-to-back requests for ``duration`` seconds"""
+    results = []
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def client():
+        local = []
+        with requests.Session() as session:
+            while time.perf_counter() < deadline:
+                local.append(post(session, url, source.next(), path, field))
+        with lock:
+            results.extend(local)
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    summary = latency_summary([r[0] for r in results], [r[1] for r in results], elapsed)
+    summary['concurrency'] = concurrency
+    return summary
+
+
+def child_pids(pid):
+    try:
+        with open(f'/proc/{pid}/task/{pid}/children') as f:
+            return [int(p) for p in f.read().split()]
+    except OSError:
+        return []
+
+
+def server_memory(pid):
+    """RSS/PSS for the server process and each of its workers (Linux only)"""
+    main = process_memory(pid)
+    workers = [dict(process_memory(child), pid=child) for child in child_pids(pid)]
+    worker_pss = [worker.get('pss_mb', 0) for worker in workers] or [main.get('pss_mb', 0)]
+    return {
+        'main': main,
+        'workers': workers,
+        'mean_worker_pss_mb': round(statistics.fmean(worker_pss), 1),
+        'total_pss_mb': round(sum(worker_pss) + (main.get('pss_mb', 0) if workers else 0), 1),
+    }
+
+
+class LocalServer:
+    """Runs one of SERVERS in a subprocess on a free port"""
+
+    def __init__(self, kind, workers, env=None):
+        self.kind = kind
+        self.port = free_port()
+        self.url = f'http://127.0.0.1:{self.port}'
+        self.env = dict(os.environ, PORT=str(self.port), WEB_CONCURRENCY=str(workers), **(env or {}))
+        self.process = None
+
+    def start(self, timeout=180):
+        started = time.perf_counter()
+        self.process = subprocess.Popen(
+            SERVERS[self.kind], cwd=BASE_DIR, env=self.env,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        ready = wait_for(f'{self.url}/api/health/ready', started, timeout)
+        with open(SAMPLE_IMAGE, 'rb') as f:
+            requests.post(f'{self.url}/predict', files={'file': ('warmup.png', f.read() + b'startup')},
+                          timeout=timeout).raise_for_status()
+        return {'ready_s': round(ready, 3), 'first_prediction_s': round(time.perf_counter() - started, 3)}
+
+    def stop(self):
+        if self.process is not None:
+            self.process.terminate()
+            self.process.wait()
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BASE_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def environment(args):
+    keys = ('MODEL_MODE', 'MODEL_LOAD', 'BATCH_MAX_SIZE', 'BATCH_MAX_WAIT_MS', 'INFERENCE_THREADS',
+            'PREPROCESS_BACKEND', 'GUNICORN_THREADS', 'WEIGHTS_MMAP', 'TTA_VIEWS', 'TTA_ENSEMBLE', 'TTA_CHUNK_SIZE',
+            'EXPLAIN_HEATMAP_SIZE', 'DECODE_DRAFT')
+    return {
+        'commit': git_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'server': args.url or args.server,
+        'workers': None if args.url else args.workers,
+        'tta': args.tta,
+        'explain': args.explain,
+        'env': {key: os.environ[key] for key in keys if key in os.environ},
+    }
+
+
+# Figures shown by --compare: latencies, times, throughput and memory
+COMPARED_SUFFIXES = ('_ms', '_s', '_rps', '_mb')
+
+
+def compare(current, baseline_path):
+    """Print the relative change of each figure against a previous results file"""
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    print(f"\nCompared with {baseline_path} (commit {baseline['environment'].get('commit')}):")
+
+    def walk(new, old, prefix=''):
+        for key, value in new.items():
+            if key not in old:
+                continue
+            if isinstance(value, dict) and isinstance(old[key], dict):
+                walk(value, old[key], f'{prefix}{key}.')
+            elif key.endswith(COMPARED_SUFFIXES) and isinstance(value, (int, float)) and old[key]:
+                change = (value - old[key]) / old[key] * 100
+                print(f"  {prefix + key:36s} {old[key]:>10} -> {value:>10}  ({change:+.1f}%)")
+
+    walk(current['results'], baseline['results'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--server', choices=sorted(SERVERS), default='gunicorn')
+    parser.add_argument('--url', help='benchmark a running server instead of starting one')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 16, 32])
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds per concurrency level')
+    parser.add_argument('--single', type=int, default=50, help='sequential requests for the latency figure')
+    parser.add_argument('--synthetic', type=int, default=8, help='number of distinct synthetic images')
+    parser.add_argument('--image-size', type=int, default=1024, help='synthetic image width and height')
+    parser.add_argument('--cache-hits', action='store_true', help='repeat identical uploads')
+    parser.add_argument('--tta', action='store_true', help='request test-time augmentation (/predict?tta=1)')
+    parser.add_argument('--explain', action='store_true', help='request Grad-CAM heatmaps (/predict?explain=1)')
+    parser.add_argument('--output', help='write results as JSON to this file')
+    parser.add_argument('--compare', help='previous results file to compare against')
+    args = parser.parse_args()
+
+    source = PayloadSource(load_payloads(args.synthetic, args.image_size), repeat=args.cache_hits)
+    path = '/predict?tta=1' if args.tta else '/predict?explain=1' if args.explain else '/predict'
+    results = {}
+    server = None
+    if args.url:
+        url = args.url.rstrip('/')
+    else:
+        server = LocalServer(args.server, args.workers)
+        results['startup'] = server.start()
+        url = server.url
+        print(f"startup      ready {results['startup']['ready_s']:.3f}s  "
+              f"first prediction {results['startup']['first_prediction_s']:.3f}s")
+    try:
+        results['single'] = run_sequential(url, source, args.single, path)
+        print(f"single       p50 {results['single']['p50_ms']:.1f} ms  p99 {results['single']['p99_ms']:.1f} ms")
+        results['concurrency'] = {}
+        for level in args.concurrency:
+            summary = run_load(url, source, level, args.duration, path)
+            results['concurrency'][str(level)] = summary
+            print(f"c={level:<10d} {summary['throughput_rps']:8.1f} req/s  p50 {summary['p50_ms']:.1f}  "
+                  f"p95 {summary['p95_ms']:.1f}  p99 {summary['p99_ms']:.1f} ms  "
+                  f"errors {summary['requests'] - summary['ok']}")
+        if server is not None:
+            results['memory'] = server_memory(server.process.pid)
+            print(f"memory       total PSS {results['memory']['total_pss_mb']} MB")
+    finally:
+        if server is not None:
+            server.stop()
+
+    report = {'environment': environment(args), 'results': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to: {args.output}")
+    if args.compare:
+        compare(report, args.compare)
+
+
+if __name__ == '__main__':
+    main()
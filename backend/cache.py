@@ -0,0 +1,325 @@
+"""
+Content-addressed cache for prediction results.
+
+Entries are keyed by a hash of the uploaded bytes plus a fingerprint of the
+model weights that produced them. A bounded in-memory LRU tier is backed by
+an optional on-disk tier shared by all workers, so results survive worker
+restarts. The disk tier is bounded too: the least recently used entries
+beyond ``max_disk_bytes`` are evicted, and entries of models nobody has
+used for DISK_STALE_SECONDS are deleted.
+"""
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict, deque
+
+from model_registry import file_sha256
+from timing import percentile
+
+logger = logging.getLogger(__name__)
+
+# A disk sweep runs at least this often (seconds) while entries are written,
+# and evicts down to this fraction of max_disk_bytes
+DISK_SWEEP_INTERVAL = 60.0
+DISK_LOW_WATERMARK = 0.9
+# The disk tier can be shared by workers briefly serving different versions
+# during a hot swap, or by services in different MODEL_MODEs, so another
+# fingerprint's entries are only deleted once none has been written or read
+# for this long (seconds)
+DISK_STALE_SECONDS = 24 * 3600.0
+
+
+def file_fingerprint(path, length=16):
+    """Hash of a file's contents, used as the model-version part of cache keys.
+
+    A prefix of the registry's SHA-256 (metadata.json ``sha256``).
+    """
+    return file_sha256(path)[:length]
+
+
+def model_version(weights_path, variant=None):
+    """Model-version part of cache keys: the weights fingerprint plus ``variant``"""
+    # Different inference modes of the same weights (e.g. eager vs INT8)
+    # produce slightly different outputs, so they get separate entries
+    fingerprint = file_fingerprint(weights_path)
+    return f"{fingerprint}.{variant}" if variant else fingerprint
+
+
+def _file_state(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+class PredictionCache:
+    """LRU cache of JSON-serialisable prediction results.
+
+    The memory tier holds at most ``max_entries`` results. When ``disk_dir`` is
+    set, results are also written there (one small JSON file per entry,
+    grouped by model version) and read back on memory misses.
+
+    The weights file is re-checked at most every ``check_interval`` seconds;
+    when it changes, the memory tier is dropped and the fingerprint is
+    recomputed. Disk entries are namespaced by fingerprint, so entries from
+    other weights are never served. ``variant`` (e.g. the inference mode) is
+    appended to the fingerprint.
+
+    The disk tier is swept in a background thread after the fingerprint
+    changes, when it may have grown past ``max_disk_bytes`` (disk space
+    actually used, not file sizes) and otherwise every DISK_SWEEP_INTERVAL
+    seconds while entries are written. A sweep deletes the directories of
+    other fingerprints whose entries are all older than DISK_STALE_SECONDS,
+    then the least recently used entries of any fingerprint (by mtime, which
+    disk hits refresh) until the tier is under DISK_LOW_WATERMARK of the limit.
+    """
+
+    def __init__(self, weights_path, max_entries=2048, disk_dir=None, check_interval=2.0, variant=None,
+                 max_disk_bytes=0):
+        self.weights_path = weights_path
+        self.variant = variant
+        self.max_entries = int(max_entries)
+        self.disk_dir = disk_dir
+        self.max_disk_bytes = int(max_disk_bytes)
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._weights_state = _file_state(weights_path) if weights_path else None
+        self.model_version = self._fingerprint() if self._weights_state else 'none'
+        self._last_check = time.monotonic()
+        self._memory_hits = 0
+        self._disk_hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._invalidations = 0
+        self._skipped_writes = 0
+        self._disk_bytes = 0
+        self._disk_entries = 0
+        self._disk_evictions = 0
+        self._last_sweep = time.monotonic()
+        self._sweeping = False
+        self._lookup_times = deque(maxlen=1024)
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0 or bool(self.disk_dir)
+
+    def key(self, data, namespace='prediction'):
+        """Cache key for raw upload bytes under the current model version"""
+        self._check_weights()
+        return f"{namespace}-{self.model_version}-{hashlib.sha256(data).hexdigest()}"
+
+    def set_weights(self, weights_path, variant=None):
+        """Switch to the weights (and inference mode) now being served"""
+        state = _file_state(weights_path) if weights_path else None
+        with self._lock:
+            self.weights_path = weights_path
+            self.variant = variant
+            self._weights_state = state
+            version = self._fingerprint() if state else 'none'
+            changed = version != self.model_version
+            if changed:
+                self.model_version = version
+                self._entries.clear()
+            self._last_check = time.monotonic()
+        if changed:
+            self._start_sweep()
+
+    def _fingerprint(self):
+        return model_version(self.weights_path, self.variant)
+
+    def _check_weights(self):
+        now = time.monotonic()
+        if not self.weights_path or now - self._last_check < self.check_interval:
+            return
+        self._last_check = now
+        state = _file_state(self.weights_path)
+        if state == self._weights_state:
+            return
+        version = self._fingerprint() if state else 'none'
+        with self._lock:
+            self._weights_state = state
+            changed = version != self.model_version
+            if changed:
+                logger.info(f"Model weights changed ({self.model_version} -> {version}), invalidating prediction cache")
+                self.model_version = version
+                self._entries.clear()
+                self._invalidations += 1
+        if changed:
+            self._start_sweep()
+
+    def _disk_path(self, key):
+        _, version, digest = key.rsplit('-', 2)
+        return os.path.join(self.disk_dir, version, digest[:2], f"{key}.json")
+
+    def get(self, key):
+        """Return the cached value for ``key``, or None on a miss"""
+        started = time.perf_counter()
+        value = None
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                value = self._entries[key]
+                self._memory_hits += 1
+        if value is None and self.disk_dir:
+            path = self._disk_path(key)
+            try:
+                with open(path) as f:
+                    value = json.load(f)
+                # Marks the entry as recently used for eviction
+                os.utime(path)
+            except (OSError, ValueError):
+                value = None
+            if value is not None:
+                self._store_memory(key, value)
+                with self._lock:
+                    self._disk_hits += 1
+        with self._lock:
+            if value is None:
+                self._misses += 1
+            self._lookup_times.append(time.perf_counter() - started)
+        return value
+
+    def put(self, key, value, model_version=None):
+        """Store ``value``. With ``model_version`` (of the model that computed
+        it), the write is skipped if the key was made for another model, e.g.
+        a key computed just before a model swap."""
+        if model_version is not None and key.rsplit('-', 2)[1] != model_version:
+            with self._lock:
+                self._skipped_writes += 1
+            return
+        self._store_memory(key, value)
+        if self.disk_dir:
+            self._store_disk(key, value)
+
+    def _store_memory(self, key, value):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._evictions += 1
+
+    def _store_disk(self, key, value):
+        path = self._disk_path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Write then rename so concurrent workers never read a partial file
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(value, f)
+            os.replace(tmp_path, path)
+            used = os.stat(path).st_blocks * 512
+        except OSError as e:
+            logger.warning(f"Could not write prediction cache entry: {str(e)}")
+            return
+        with self._lock:
+            self._disk_bytes += used
+            due = (self.max_disk_bytes and self._disk_bytes > self.max_disk_bytes) or \
+                time.monotonic() - self._last_sweep >= DISK_SWEEP_INTERVAL
+        if due:
+            self._start_sweep()
+
+    def _start_sweep(self):
+        if not self.disk_dir:
+            return
+        with self._lock:
+            if self._sweeping:
+                return
+            self._sweeping = True
+            self._last_sweep = time.monotonic()
+        threading.Thread(target=self._sweep_disk, name='prediction-cache-sweep', daemon=True).start()
+
+    def _sweep_disk(self):
+        """Delete other fingerprints' stale entries, then evict the least
+        recently used ones until the disk tier is under DISK_LOW_WATERMARK of
+        max_disk_bytes"""
+        try:
+            entries = []
+            current = self.model_version
+            stale_before = time.time() - DISK_STALE_SECONDS
+            try:
+                version_dirs = [entry for entry in os.scandir(self.disk_dir) if entry.is_dir()]
+            except OSError:
+                version_dirs = []
+            for version_dir in version_dirs:
+                version_entries = []
+                for shard in os.scandir(version_dir.path):
+                    for entry in os.scandir(shard.path):
+                        # Skip files another worker is still writing
+                        if entry.name.endswith('.json'):
+                            try:
+                                stat = entry.stat()
+                            except OSError:
+                                continue
+                            version_entries.append((stat.st_mtime, stat.st_blocks * 512, entry.path))
+                if version_dir.name != current and all(mtime < stale_before for mtime, _, _ in version_entries):
+                    logger.info(f"Removing prediction cache entries of model {version_dir.name}, "
+                                f"unused for {DISK_STALE_SECONDS / 3600:.0f}h")
+                    shutil.rmtree(version_dir.path, ignore_errors=True)
+                    continue
+                entries.extend(version_entries)
+            total = sum(used for _, used, _ in entries)
+            evicted = 0
+            if self.max_disk_bytes and total > self.max_disk_bytes:
+                entries.sort()
+                target = self.max_disk_bytes * DISK_LOW_WATERMARK
+                for _, used, path in entries:
+                    if total <= target:
+                        break
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+                    total -= used
+                    evicted += 1
+            with self._lock:
+                self._disk_bytes = total
+                self._disk_entries = len(entries) - evicted
+                self._disk_evictions += evicted
+        except OSError as e:
+            logger.warning(f"Prediction cache disk sweep failed: {str(e)}")
+        finally:
+            with self._lock:
+                self._sweeping = False
+                self._last_sweep = time.monotonic()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._invalidations += 1
+
+    def stats(self):
+        with self._lock:
+            hits = self._memory_hits + self._disk_hits
+            lookups = hits + self._misses
+            lookup_ms = [t * 1000 for t in self._lookup_times]
+            return {
+                'model_version': self.model_version,
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'disk_tier': bool(self.disk_dir),
+                'disk_bytes': self._disk_bytes,
+                'disk_entries': self._disk_entries,
+                'max_disk_bytes': self.max_disk_bytes,
+                'disk_evictions': self._disk_evictions,
+                'memory_hits': self._memory_hits,
+                'disk_hits': self._disk_hits,
+                'misses': self._misses,
+                'hit_rate': round(hits / lookups, 4) if lookups else 0.0,
+                'evictions': self._evictions,
+                'invalidations': self._invalidations,
+                'skipped_writes': self._skipped_writes,
+                'lookup_ms': {
+                    'p50': round(percentile(lookup_ms, 50), 4),
+                    'p99': round(percentile(lookup_ms, 99), 4),
+                },
+            }
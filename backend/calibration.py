@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+"""
+Probability calibration for PneumoniaCNN outputs.
+
+A ``Calibrator`` maps the model's sigmoid outputs to calibrated
+probabilities with either:
+- temperature scaling: ``sigmoid(logit(p) / T)``. It has one parameter, so
+  it is safe on small validation sets and never changes a prediction;
+- isotonic regression: a monotonic step function fitted with
+  pool-adjacent-violators and applied by linear interpolation between the
+  fitted points (``np.interp``).
+
+Both apply to a whole numpy batch at once. The fitted calibrator is a small
+JSON artifact saved next to the weights (``model.pth`` ->
+``model.calibration.json``), tied to them by their SHA-256, and loaded by
+the server together with the model.
+
+Fitting uses the validation split. The report gives expected calibration
+error (ECE), negative log-likelihood and Brier score on the test split,
+before and after calibration, from a single batched pass over it:
+
+    python calibration.py                                  # pneumonia_detection_model.pth
+    python calibration.py --version v3 --method isotonic   # a registry version
+
+This module only needs numpy; torch is imported to collect model outputs.
+"""
+import argparse
+import hashlib
+import json
+import os
+import time
+
+import numpy as np
+
+METHODS = ('temperature', 'isotonic')
+# 'auto' fits isotonic regression only when there is enough validation data
+# for a non-parametric fit, otherwise temperature scaling
+AUTO_ISOTONIC_MIN_SAMPLES = 1000
+ECE_BINS = 15
+# Isotonic outputs are kept away from exact 0/1, which the data cannot support
+ISOTONIC_EPS = 1e-3
+_LOGIT_EPS = 1e-7
+
+
+def calibration_path(weights_path):
+    """The calibration artifact stored next to ``weights_path``"""
+    return os.path.splitext(weights_path)[0] + '.calibration.json'
+
+
+def _logit(probs):
+    probs = np.clip(np.asarray(probs, dtype=np.float64), _LOGIT_EPS, 1 - _LOGIT_EPS)
+    return np.log(probs) - np.log1p(-probs)
+
+
+def _sigmoid(x):
+    return 1.0 / (1.0 + np.exp(-x))
+
+
+def nll(probs, labels):
+    """Mean binary negative log-likelihood"""
+    probs = np.clip(np.asarray(probs, dtype=np.float64), _LOGIT_EPS, 1 - _LOGIT_EPS)
+    labels = np.asarray(labels, dtype=np.float64)
+    return float(-np.mean(labels * np.log(probs) + (1 - labels) * np.log1p(-probs)))
+
+
+def brier(probs, labels):
+    return float(np.mean((np.asarray(probs, dtype=np.float64) - np.asarray(labels)) ** 2))
+
+
+def expected_calibration_error(probs, labels, bins=ECE_BINS):
+    """Top-label ECE: the gap between confidence (probability of the predicted
+    class) and accuracy, averaged over ``bins`` equal-width confidence bins
+    weighted by their size"""
+    probs = np.asarray(probs, dtype=np.float64)
+    labels = np.asarray(labels)
+    if probs.size == 0:
+        return 0.0
+    predictions = probs > 0.5
+    confidence = np.where(predictions, probs, 1 - probs)
+    correct = (predictions == (labels == 1)).astype(np.float64)
+    # Confidence is in [0.5, 1]; bin over that range
+    index = np.minimum(((confidence - 0.5) * 2 * bins).astype(np.int64), bins - 1)
+    gap = np.bincount(index, weights=confidence - correct, minlength=bins)
+    return float(np.abs(gap).sum() / probs.size)
+
+
+def fit_temperature(probs, labels):
+    """Temperature minimising the NLL of ``sigmoid(logit(p) / T)``"""
+    logits = _logit(probs)
+    labels = np.asarray(labels, dtype=np.float64)
+
+    def loss(log_t):
+        return nll(_sigmoid(logits / np.exp(log_t)), labels)
+
+    # Coarse grid over T in [0.05, 20], then golden-section refinement
+    grid = np.linspace(np.log(0.05), np.log(20.0), 61)
+    best = int(np.argmin([loss(value) for value in grid]))
+    low, high = grid[max(best - 1, 0)], grid[min(best + 1, len(grid) - 1)]
+    ratio = (np.sqrt(5) - 1) / 2
+    for _ in range(40):
+        a = high - ratio * (high - low)
+        b = low + ratio * (high - low)
+        if loss(a) < loss(b):
+            high = b
+        else:
+            low = a
+    return float(np.exp((low + high) / 2))
+
+
+def fit_isotonic(probs, labels):
+    """Pool-adjacent-violators fit; returns the (x, y) points of the
+    non-decreasing calibration curve"""
+    order = np.argsort(probs, kind='stable')
+    x = np.asarray(probs, dtype=np.float64)[order]
+    y = np.asarray(labels, dtype=np.float64)[order]
+    # Blocks as (sum of y, sum of x, count); merged while they violate monotonicity
+    sums, xs, counts = [], [], []
+    for xi, yi in zip(x, y):
+        sums.append(yi)
+        xs.append(xi)
+        counts.append(1)
+        while len(sums) > 1 and sums[-2] / counts[-2] >= sums[-1] / counts[-1]:
+            y_sum, x_sum, count = sums.pop(), xs.pop(), counts.pop()
+            sums[-1] += y_sum
+            xs[-1] += x_sum
+            counts[-1] += count
+    counts = np.asarray(counts, dtype=np.float64)
+    points_x = np.asarray(xs) / counts
+    points_y = np.clip(np.asarray(sums) / counts, ISOTONIC_EPS, 1 - ISOTONIC_EPS)
+    return points_x, points_y
+
+
+class Calibrator:
+    """Maps raw model probabilities to calibrated ones, vectorised over batches"""
+
+    def __init__(self, method, temperature=None, points_x=None, points_y=None, weights_sha256=None,
+                 report=None):
+        if method not in METHODS:
+            raise ValueError(f"Unknown calibration method: {method} (expected one of {METHODS})")
+        self.method = method
+        self.temperature = temperature
+        self.points_x = None if points_x is None else np.asarray(points_x, dtype=np.float64)
+        self.points_y = None if points_y is None else np.asarray(points_y, dtype=np.float64)
+        self.weights_sha256 = weights_sha256
+        self.report = report or {}
+
+    @classmethod
+    def fit(cls, probs, labels, method='auto'):
+        if method == 'auto':
+            method = 'isotonic' if len(labels) >= AUTO_ISOTONIC_MIN_SAMPLES else 'temperature'
+        if method == 'temperature':
+            return cls('temperature', temperature=fit_temperature(probs, labels))
+        points_x, points_y = fit_isotonic(probs, labels)
+        return cls('isotonic', points_x=points_x, points_y=points_y)
+
+    def apply(self, probs):
+        """Calibrated probabilities for an array (any shape) of raw probabilities"""
+        probs = np.asarray(probs, dtype=np.float64)
+        if self.method == 'temperature':
+            return _sigmoid(_logit(probs) / self.temperature)
+        return np.interp(probs, self.points_x, self.points_y)
+
+    @property
+    def id(self):
+        """Short identifier of the fitted parameters, for cache keys"""
+        return hashlib.sha256(json.dumps(self.to_dict(report=False), sort_keys=True).encode()).hexdigest()[:12]
+
+    def to_dict(self, report=True):
+        data = {'method': self.method, 'weights_sha256': self.weights_sha256}
+        if self.method == 'temperature':
+            data['temperature'] = self.temperature
+        else:
+            data['points_x'] = self.points_x.tolist()
+            data['points_y'] = self.points_y.tolist()
+        if report:
+            data['report'] = self.report
+        return data
+
+    def save(self, path):
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            data = json.load(f)
+        return cls(data['method'], temperature=data.get('temperature'), points_x=data.get('points_x'),
+                   points_y=data.get('points_y'), weights_sha256=data.get('weights_sha256'),
+                   report=data.get('report'))
+
+
+def calibration_metrics(probs, labels):
+    return {
+        'ece': expected_calibration_error(probs, labels),
+        'nll': nll(probs, labels),
+        'brier': brier(probs, labels),
+    }
+
+
+def collect_probabilities(model, loader, device, dtype=None):
+    """Model probabilities and labels for a whole loader as numpy arrays.
+
+    Outputs stay on the device until the end and are copied to the host once.
+    """
+    import torch
+
+    model.eval()
+    outputs, targets = [], []
+    with torch.no_grad(), torch.autocast(device.type, dtype=dtype, enabled=dtype is not None):
+        for images, labels in loader:
+            outputs.append(model(images.to(device)).float().view(-1))
+            targets.append(labels.to(device).view(-1))
+    return torch.cat(outputs).cpu().numpy(), torch.cat(targets).cpu().numpy()
+
+
+def fit_and_report(val_probs, val_labels, test_probs, test_labels, method='auto'):
+    """Fit on the validation outputs and report test-split metrics before and after"""
+    calibrator = Calibrator.fit(val_probs, val_labels, method)
+    calibrated = calibrator.apply(test_probs)
+    calibrator.report = {
+        'fitted_on': {'split': 'val', 'samples': int(len(val_labels))},
+        'evaluated_on': {'split': 'test', 'samples': int(len(test_labels))},
+        'before': calibration_metrics(test_probs, test_labels),
+        'after': calibration_metrics(calibrated, test_labels),
+        # Temperature scaling never changes the predicted class; isotonic can at the 0.5 boundary
+        'accuracy_before': float(np.mean((test_probs > 0.5) == (test_labels == 1))),
+        'accuracy_after': float(np.mean((calibrated > 0.5) == (test_labels == 1))),
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+    }
+    return calibrator
+
+
+def format_report(calibrator):
+    report = calibrator.report
+    before, after = report['before'], report['after']
+    detail = f"T={calibrator.temperature:.3f}" if calibrator.method == 'temperature' \
+        else f"{len(calibrator.points_x)} points"
+    return (f"Calibration ({calibrator.method}, {detail}; fitted on {report['fitted_on']['samples']} val images)\n"
+            f"  test ECE   {before['ece']:.4f} -> {after['ece']:.4f}\n"
+            f"  test NLL   {before['nll']:.4f} -> {after['nll']:.4f}\n"
+            f"  test Brier {before['brier']:.4f} -> {after['brier']:.4f}")
+
+
+def main():
+    import torch
+
+    import data_shards
+    from model_registry import ModelRegistry, build_model, file_sha256
+
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--weights', default=os.path.join(base_dir, 'pneumonia_detection_model.pth'))
+    parser.add_argument('--version', help='calibrate this registry version instead of --weights')
+    parser.add_argument('--registry', default=os.environ.get('MODEL_REGISTRY_DIR') or os.path.join(base_dir, 'models'))
+    parser.add_argument('--method', choices=('auto',) + METHODS, default='auto')
+    parser.add_argument('--data-cache', default=os.path.join(base_dir, 'data_cache'))
+    parser.add_argument('--dataset', help='chest_xray directory (downloaded with kagglehub if omitted)')
+    args = parser.parse_args()
+
+    weights_path = ModelRegistry(args.registry).weights_path(args.version) if args.version else args.weights
+    dataset_root = args.dataset
+    if dataset_root is None:
+        import kagglehub
+        dataset_root = os.path.join(kagglehub.dataset_download("paultimothymooney/chest-xray-pneumonia"),
+                                    'chest_xray')
+    data_shards.ensure_shards(dataset_root, args.data_cache)
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    model = build_model().to(device)
+    model.load_state_dict(torch.load(weights_path, map_location=device))
+    _, val_loader, test_loader = data_shards.build_loaders(args.data_cache, device)
+    val_probs, val_labels = collect_probabilities(model, val_loader, device)
+    test_probs, test_labels = collect_probabilities(model, test_loader, device)
+
+    calibrator = fit_and_report(val_probs, val_labels, test_probs, test_labels, args.method)
+    calibrator.weights_sha256 = file_sha256(weights_path)
+    calibrator.save(calibration_path(weights_path))
+    print(format_report(calibrator))
+    print(f"Calibration saved to: {calibration_path(weights_path)}")
+
+
+if __name__ == '__main__':
+    main()
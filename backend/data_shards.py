@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+"""
+Pre-decoded training data.
+
+``write_split`` decodes and resizes an ImageFolder-style split once, in
+parallel worker processes, into a uint8 ``<split>_images.npy`` array of shape
+(N, C, 150, 150) plus ``<split>_labels.npy``. Resizing uses
+preprocessing.decode_image, which is pixel-identical to the Resize((150, 150))
++ ToTensor() pipeline in train_model.py. C is 1 when every image in the
+split is grayscale (the usual case for X-rays), otherwise 3.
+
+``shard_loader`` reads those files memory-mapped, one whole batch per
+indexing operation, in DataLoader worker processes. ``DeviceBatches`` moves
+the uint8 batches to the training device and applies the random affine +
+horizontal flip augmentation to the whole batch there (``augment_batch``),
+replacing the per-image PIL transforms.
+
+    python data_shards.py --out data_cache            # download + write all splits
+    python data_shards.py --out data_cache --benchmark  # compare epoch load time
+"""
+import argparse
+import json
+import math
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import numpy as np
+
+from preprocessing import IMAGE_SIZE, decode_image
+
+SPLITS = ('train', 'val', 'test')
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff', '.webp')
+MANIFEST = 'manifest.json'
+
+# Same ranges as the RandomAffine in the original training transforms
+AUGMENT_DEGREES = 30.0
+AUGMENT_TRANSLATE = 0.1
+AUGMENT_SCALE = (0.8, 1.2)
+
+
+def find_images(folder):
+    """(path, label) pairs and the class list, ordered like torchvision's ImageFolder"""
+    classes = sorted(entry.name for entry in os.scandir(folder) if entry.is_dir())
+    samples = []
+    for label, name in enumerate(classes):
+        for root, _, files in sorted(os.walk(os.path.join(folder, name), followlinks=True)):
+            for filename in sorted(files):
+                if filename.lower().endswith(IMAGE_EXTENSIONS):
+                    samples.append((os.path.join(root, filename), label))
+    return samples, classes
+
+
+def _decode_file(path, size=IMAGE_SIZE):
+    with open(path, 'rb') as f:
+        array = decode_image(f.read(), size)
+    if array.ndim == 2:
+        return array[np.newaxis], True
+    channels_equal = bool((array[..., 0] == array[..., 1]).all() and (array[..., 0] == array[..., 2]).all())
+    return np.ascontiguousarray(array.transpose(2, 0, 1)), channels_equal
+
+
+def write_split(folder, out_dir, split, size=IMAGE_SIZE, workers=None):
+    """Decode every image under ``folder`` into ``out_dir/<split>_images.npy``.
+
+    Returns the split's manifest entry (count, channels, classes, files).
+    """
+    samples, classes = find_images(folder)
+    if not samples:
+        raise RuntimeError(f"No images found under {folder}")
+    os.makedirs(out_dir, exist_ok=True)
+    images_path = os.path.join(out_dir, f'{split}_images.npy')
+    rgb_path = images_path + '.rgb.tmp'
+
+    # Decode into a 3-channel file; reduced to one channel afterwards if the
+    # whole split turns out to be grayscale
+    images = np.lib.format.open_memmap(rgb_path, mode='w+', dtype=np.uint8, shape=(len(samples), 3, size, size))
+    all_gray = True
+    paths = [path for path, _ in samples]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        chunksize = max(1, len(paths) // (4 * (workers or os.cpu_count() or 1)))
+        for i, (array, gray) in enumerate(pool.map(partial(_decode_file, size=size), paths, chunksize=chunksize)):
+            images[i] = array
+            all_gray = all_gray and gray
+    images.flush()
+
+    if all_gray:
+        gray_images = np.lib.format.open_memmap(images_path + '.tmp', mode='w+', dtype=np.uint8,
+                                                shape=(len(samples), 1, size, size))
+        gray_images[:] = images[:, :1]
+        gray_images.flush()
+        del images, gray_images
+        os.replace(images_path + '.tmp', images_path)
+        os.remove(rgb_path)
+    else:
+        del images
+        os.replace(rgb_path, images_path)
+
+    labels = np.array([label for _, label in samples], dtype=np.int64)
+    np.save(os.path.join(out_dir, f'{split}_labels.npy'), labels)
+    return {
+        'count': len(samples),
+        'channels': 1 if all_gray else 3,
+        'classes': classes,
+        'class_counts': np.bincount(labels, minlength=len(classes)).tolist(),
+        'files': [os.path.relpath(path, folder) for path in paths],
+    }
+
+
+def write_shards(dataset_root, out_dir, size=IMAGE_SIZE, workers=None):
+    """Write train/val/test shards from a chest_xray/{train,val,test} tree"""
+    manifest = {'image_size': size, 'source': dataset_root, 'splits': {}}
+    for split in SPLITS:
+        started = time.perf_counter()
+        entry = write_split(os.path.join(dataset_root, split), out_dir, split, size, workers)
+        manifest['splits'][split] = entry
+        print(f"{split}: {entry['count']} images, {entry['channels']} channel(s), "
+              f"{time.perf_counter() - started:.1f}s")
+    # Written last: its presence marks a complete cache
+    with open(os.path.join(out_dir, MANIFEST), 'w') as f:
+        json.dump(manifest, f)
+    return manifest
+
+
+def load_manifest(out_dir):
+    path = os.path.join(out_dir, MANIFEST)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+class ShardDataset:
+    """Indexable by a list of indices, returning a whole (uint8 images, labels) batch.
+
+    The image file is memory-mapped lazily, so each DataLoader worker opens
+    its own map and nothing large is pickled to the workers.
+    """
+
+    def __init__(self, out_dir, split):
+        self.images_path = os.path.join(out_dir, f'{split}_images.npy')
+        self.labels = np.load(os.path.join(out_dir, f'{split}_labels.npy'))
+        self._images = None
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getitem__(self, indices):
+        import torch
+
+        if self._images is None:
+            self._images = np.load(self.images_path, mmap_mode='r')
+        # Sorted indices read the memory map front to back
+        indices = np.sort(np.asarray(indices))
+        return torch.from_numpy(self._images[indices]), torch.from_numpy(self.labels[indices])
+
+
+def shard_loader(out_dir, split, batch_size=32, shuffle=False, num_workers=None, pin_memory=False, seed=None):
+    """DataLoader yielding (uint8 (N, C, H, W), int64 (N,)) batches from a shard"""
+    import torch
+    from torch.utils.data import BatchSampler, DataLoader, RandomSampler, SequentialSampler
+
+    dataset = ShardDataset(out_dir, split)
+    if shuffle:
+        generator = torch.Generator().manual_seed(seed) if seed is not None else None
+        sampler = RandomSampler(range(len(dataset)), generator=generator)
+    else:
+        sampler = SequentialSampler(range(len(dataset)))
+    if num_workers is None:
+        num_workers = min(4, os.cpu_count() or 1)
+    return DataLoader(
+        dataset,
+        sampler=BatchSampler(sampler, batch_size, drop_last=False),
+        batch_size=None,
+        num_workers=num_workers,
+        pin_memory=pin_memory,
+        persistent_workers=num_workers > 0,
+        prefetch_factor=4 if num_workers > 0 else None,
+    )
+
+
+def augment_batch(images, degrees=AUGMENT_DEGREES, translate=AUGMENT_TRANSLATE, scale=AUGMENT_SCALE,
+                  flip_p=0.5, generator=None):
+    """Random affine transform + horizontal flip of a float (N, C, H, W) batch.
+
+    One affine_grid/grid_sample call for the whole batch, with the same
+    parameter ranges, nearest-neighbour sampling and zero fill as
+    torchvision's RandomAffine(degrees, translate, scale) followed by
+    RandomHorizontalFlip.
+    """
+    import torch
+    import torch.nn.functional as F
+
+    n, _, height, width = images.shape
+    options = {'device': images.device, 'generator': generator}
+    angle = (torch.rand(n, **options) * 2 - 1) * math.radians(degrees)
+    factor = torch.empty(n, device=images.device).uniform_(scale[0], scale[1], generator=generator)
+    # torchvision translates by a whole number of pixels; grid units span 2 / size per pixel
+    shift_x = torch.round((torch.rand(n, **options) * 2 - 1) * translate * width) * 2 / width
+    shift_y = torch.round((torch.rand(n, **options) * 2 - 1) * translate * height) * 2 / height
+    flip = torch.where(torch.rand(n, **options) < flip_p, -1.0, 1.0)
+
+    # affine_grid maps output to input coordinates: the inverse of
+    # x_out = scale * R(angle) @ x_in + shift, applied after the flip
+    cos = torch.cos(angle) / factor
+    sin = torch.sin(angle) / factor
+    theta = torch.empty(n, 2, 3, device=images.device)
+    theta[:, 0, 0] = cos * flip
+    theta[:, 0, 1] = sin
+    theta[:, 1, 0] = -sin * flip
+    theta[:, 1, 1] = cos
+    theta[:, 0, 2] = -(cos * shift_x + sin * shift_y)
+    theta[:, 1, 2] = sin * shift_x - cos * shift_y
+    grid = F.affine_grid(theta.to(images.dtype), list(images.shape), align_corners=False)
+    return F.grid_sample(images, grid, mode='nearest', padding_mode='zeros', align_corners=False)
+
+
+class DeviceBatches:
+    """Wraps a shard loader: moves each uint8 batch to ``device``, converts it
+    to float in [0, 1] (augmented if ``augment``) and broadcasts grayscale to
+    the three channels the model expects. Iterates like the ImageFolder
+    loaders it replaces, with ``len()`` and ``.dataset``."""
+
+    def __init__(self, loader, device, augment=False, channels=3):
+        self.loader = loader
+        self.dataset = loader.dataset
+        self.device = device
+        self.augment = augment
+        self.channels = channels
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        non_blocking = self.device.type == 'cuda'
+        for images, labels in self.loader:
+            images = images.to(self.device, non_blocking=non_blocking).float().div_(255)
+            if self.augment:
+                images = augment_batch(images)
+            if images.shape[1] != self.channels:
+                images = images.expand(-1, self.channels, -1, -1)
+            yield images, labels.to(self.device, non_blocking=non_blocking)
+
+
+def build_loaders(out_dir, device, batch_size=32, num_workers=None, seed=None):
+    """Train (shuffled, augmented), val and test loaders over a shard cache"""
+    pin_memory = device.type == 'cuda'
+    loaders = {}
+    for split in SPLITS:
+        train = split == 'train'
+        loader = shard_loader(out_dir, split, batch_size, shuffle=train, num_workers=num_workers,
+                              pin_memory=pin_memory, seed=seed)
+        loaders[split] = DeviceBatches(loader, device, augment=train)
+    return loaders['train'], loaders['val'], loaders['test']
+
+
+def ensure_shards(dataset_root, out_dir, workers=None, size=IMAGE_SIZE):
+    """Return the manifest of ``out_dir``, writing the shards first if missing"""
+    manifest = load_manifest(out_dir)
+    if manifest is None or manifest.get('image_size') != size:
+        print(f"Writing pre-decoded data cache to: {out_dir}")
+        manifest = write_shards(dataset_root, out_dir, size=size, workers=workers)
+    return manifest
+
+
+def _benchmark(dataset_root, out_dir, batch_size=32):
+    """Time one pass over the training split with the ImageFolder loader and
+    with the shard loader (data loading + augmentation only)"""
+    import torch
+    from torchvision import datasets, transforms
+    from torch.utils.data import DataLoader
+
+    train_transforms = transforms.Compose([
+        transforms.Resize((IMAGE_SIZE, IMAGE_SIZE)),
+        transforms.RandomAffine(degrees=AUGMENT_DEGREES, translate=(AUGMENT_TRANSLATE, AUGMENT_TRANSLATE),
+                                scale=AUGMENT_SCALE),
+        transforms.RandomHorizontalFlip(),
+        transforms.ToTensor(),
+    ])
+    folder = DataLoader(datasets.ImageFolder(os.path.join(dataset_root, 'train'), transform=train_transforms),
+                        batch_size=batch_size, shuffle=True, num_workers=0)
+    started = time.perf_counter()
+    for _ in folder:
+        pass
+    folder_seconds = time.perf_counter() - started
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    shards = DeviceBatches(shard_loader(out_dir, 'train', batch_size, shuffle=True), device, augment=True)
+    for _ in shards:  # first pass starts the workers and warms the page cache
+        pass
+    started = time.perf_counter()
+    for _ in shards:
+        pass
+    shard_seconds = time.perf_counter() - started
+    print(f"ImageFolder epoch: {folder_seconds:.2f}s  shards epoch: {shard_seconds:.2f}s  "
+          f"({folder_seconds / shard_seconds:.1f}x)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--out', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data_cache'))
+    parser.add_argument('--dataset', help='chest_xray directory (downloaded with kagglehub if omitted)')
+    parser.add_argument('--workers', type=int, help='decode processes (default: all CPUs)')
+    parser.add_argument('--benchmark', action='store_true', help='compare epoch load time with ImageFolder')
+    args = parser.parse_args()
+
+    dataset_root = args.dataset
+    if dataset_root is None:
+        import kagglehub
+        dataset_root = os.path.join(kagglehub.dataset_download("paultimothymooney/chest-xray-pneumonia"),
+                                    'chest_xray')
+    ensure_shards(dataset_root, args.out, workers=args.workers)
+    if args.benchmark:
+        _benchmark(dataset_root, args.out)
+
+
+if __name__ == '__main__':
+    main()
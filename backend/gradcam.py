@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+"""
+Grad-CAM explanation heatmaps computed in the prediction pass.
+
+``GradCAM`` splits PneumoniaCNN at the BatchNorm of the last ``features``
+block (256 channels, 9 x 9 for 150 px input, before the final max-pool).
+The body up to that point runs once, without autograd, exactly as in a
+plain prediction. Only the small head (max-pool + classifier) is run with
+gradients, and a single backward pass through it gives every image's
+gradients at once (in eval mode the images do not interact). The
+prediction and the heatmap therefore come from the same forward pass, and
+the extra cost is the head's backward plus the CAM arithmetic.
+
+Each heatmap explains the predicted class: the gradient of the pneumonia
+logit for pneumonia predictions, of its negative for normal ones. It is
+ReLU'd and scaled to [0, 255] per image, then resized to a small square. It
+covers the 150 x 150 model input, i.e. the whole upload stretched to a
+square.
+
+    python gradcam.py                 # overhead vs a plain prediction
+    python gradcam.py --check --weights pneumonia_detection_model.pth
+
+``--check`` compares the batched heatmaps with ``reference_gradcam``, a
+per-image pass with hooks on the whole model, and exits non-zero if they
+differ by more than PARITY_TOLERANCE.
+"""
+import argparse
+import base64
+import io
+import sys
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from PIL import Image
+
+from timing import median_ms
+
+DEFAULT_HEATMAP_SIZE = 32
+# Max abs difference allowed between batched and reference heatmaps scaled to
+# [0, 1], a quarter of one uint8 step
+PARITY_TOLERANCE = 1e-3
+
+
+def _normalized_cams(activations, gradients, heatmap_size):
+    """(B, S, S) Grad-CAM maps scaled to [0, 1] per image"""
+    weights = gradients.mean(dim=(2, 3), keepdim=True)
+    cam = F.relu((weights * activations).sum(dim=1, keepdim=True))
+    cam = F.interpolate(cam, size=(heatmap_size, heatmap_size), mode='bilinear', align_corners=False)
+    return cam[:, 0] / cam.amax(dim=(2, 3), keepdim=True)[:, 0].clamp_min(1e-12)
+
+
+class GradCAM:
+    """(probabilities, uint8 heatmaps) for a batch from one forward pass of a PneumoniaCNN"""
+
+    def __init__(self, model, heatmap_size=DEFAULT_HEATMAP_SIZE):
+        self.model = model.eval()
+        self.heatmap_size = heatmap_size
+        self.body = model.features[:-1]
+        self.pool = model.features[-1]
+        # The classifier without its final Sigmoid, so gradients do not vanish for confident outputs
+        self.head = model.classifier[:-1]
+
+    def explain(self, images):
+        """(probabilities, float heatmaps in [0, 1])"""
+        with torch.no_grad():
+            activations = self.body(images)
+        activations.requires_grad_(True)
+        with torch.enable_grad():
+            logits = self.head(self.pool(activations).flatten(1))[:, 0]
+            probs = torch.sigmoid(logits)
+            sign = torch.where(probs > 0.5, 1.0, -1.0).detach()
+            gradients, = torch.autograd.grad((logits * sign).sum(), activations)
+        with torch.no_grad():
+            cams = _normalized_cams(activations, gradients, self.heatmap_size)
+        return probs.detach(), cams
+
+    def __call__(self, images):
+        probs, cams = self.explain(images)
+        return probs, (cams * 255).round_().to(torch.uint8)
+
+
+def encode_heatmap(heatmap):
+    """A (S, S) uint8 array as a PNG data URI"""
+    buffer = io.BytesIO()
+    Image.fromarray(np.ascontiguousarray(heatmap), 'L').save(buffer, format='PNG', optimize=False)
+    return 'data:image/png;base64,' + base64.b64encode(buffer.getvalue()).decode('ascii')
+
+
+def reference_gradcam(model, image, heatmap_size=DEFAULT_HEATMAP_SIZE):
+    """(probability, float heatmap) for one (1, 3, H, W) image, computed the
+    usual way: a full forward and backward pass of the whole model, with hooks
+    on the last features block and on the logit before the Sigmoid. The target
+    is the same as GradCAM's: the logit for pneumonia predictions, its negative
+    for normal ones."""
+    captured = {}
+    layer = model.features[-2]
+    hooks = [
+        layer.register_forward_hook(lambda module, args, output: captured.update(activations=output)),
+        layer.register_full_backward_hook(
+            lambda module, grad_input, grad_output: captured.update(gradients=grad_output[0])),
+        model.classifier[-2].register_forward_hook(lambda module, args, output: captured.update(logit=output)),
+    ]
+    try:
+        # Full backward hooks need an input that requires grad
+        model(image.clone().requires_grad_(True))
+        logit = captured['logit'][0, 0]
+        model.zero_grad(set_to_none=True)
+        (logit if logit > 0 else -logit).backward()
+    finally:
+        for hook in hooks:
+            hook.remove()
+    cam = _normalized_cams(captured['activations'].detach(), captured['gradients'], heatmap_size)[0]
+    return torch.sigmoid(logit).item(), cam
+
+
+def check_parity(model, heatmap_size=DEFAULT_HEATMAP_SIZE, image_size=150, batch_size=8):
+    """(max abs heatmap difference, max abs probability difference, number of
+    pneumonia predictions) between GradCAM on a batch and reference_gradcam on
+    each image, for optimize.smooth_images"""
+    from optimize import smooth_images
+
+    model.eval()
+    images = smooth_images(batch_size, image_size, torch.Generator().manual_seed(0)).contiguous()
+    probs, cams = GradCAM(model, heatmap_size).explain(images)
+    heatmap_diff = prob_diff = 0.0
+    for i in range(batch_size):
+        prob, cam = reference_gradcam(model, images[i:i + 1], heatmap_size)
+        heatmap_diff = max(heatmap_diff, (cam - cams[i]).abs().max().item())
+        prob_diff = max(prob_diff, abs(prob - probs[i].item()))
+    return heatmap_diff, prob_diff, int((probs > 0.5).sum())
+
+
+def _benchmark(batch_sizes, repeats, threads, heatmap_size):
+    from model_registry import build_model
+
+    torch.manual_seed(0)
+    if threads:
+        torch.set_num_threads(threads)
+    model = build_model().eval()
+    explainer = GradCAM(model, heatmap_size)
+    print(f"{torch.get_num_threads()} thread(s), {heatmap_size} px heatmaps\n")
+    print(f"{'batch':>5} {'plain ms':>8} {'+grad-cam ms':>12} {'overhead':>8} {'encode ms':>9} "
+          f"{'separate pass ms':>16} {'x plain':>7}")
+    for batch in batch_sizes:
+        images = torch.rand(batch, 3, 150, 150)
+        with torch.no_grad():
+            for _ in range(3):
+                model(images)
+            plain = median_ms(lambda: model(images), repeats)
+        explainer(images)
+        explained = median_ms(lambda: explainer(images), repeats)
+        heatmaps = explainer(images)[1].numpy()
+        encode = median_ms(lambda: [encode_heatmap(heatmap) for heatmap in heatmaps], repeats)
+
+        def separate():
+            with torch.no_grad():
+                model(images)
+            for i in range(batch):
+                reference_gradcam(model, images[i:i + 1], heatmap_size)
+
+        separate_ms = median_ms(separate, repeats)
+        print(f"{batch:>5} {plain:>8.2f} {explained:>12.2f} {(explained + encode) / plain - 1:>7.0%} "
+              f"{encode:>9.2f} {separate_ms:>16.2f} {separate_ms / plain:>6.2f}x")
+
+
+def _check(weights_path, heatmap_size):
+    """Parity of the batched heatmaps with reference_gradcam; False on failure"""
+    from model_registry import build_model
+
+    torch.manual_seed(0)
+    model = build_model()
+    if weights_path:
+        model.load_state_dict(torch.load(weights_path, map_location='cpu'))
+    batch_size = 8
+    heatmap_diff, prob_diff, pneumonia = check_parity(model, heatmap_size, batch_size=batch_size)
+    print(f"Grad-CAM parity vs per-image reference ({weights_path or 'untrained model'}): "
+          f"max heatmap diff {heatmap_diff:.2e} (tolerance {PARITY_TOLERANCE:.0e}), "
+          f"max probability diff {prob_diff:.2e}, {pneumonia}/{batch_size} predicted pneumonia")
+    return heatmap_diff <= PARITY_TOLERANCE
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--check', action='store_true',
+                        help='check parity with the per-image reference instead of benchmarking; exits 1 on failure')
+    parser.add_argument('--weights', help='weights for --check (default: an untrained model)')
+    parser.add_argument('--batch', type=int, nargs='+', default=[1, 4, 16])
+    parser.add_argument('--repeats', type=int, default=30)
+    parser.add_argument('--threads', type=int, help='intra-op threads (default: torch default)')
+    parser.add_argument('--heatmap-size', type=int, default=DEFAULT_HEATMAP_SIZE)
+    args = parser.parse_args()
+    if args.check:
+        sys.exit(0 if _check(args.weights, args.heatmap_size) else 1)
+    _benchmark(args.batch, args.repeats, args.threads, args.heatmap_size)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,45 @@
+"""
+gunicorn configuration for the Flask backend.
+
+With preload_app (the default) the app, and therefore the model, is loaded
+once in the master process. Forked workers share the weight pages
+copy-on-write and never write to them, so adding workers adds little
+resident memory and workers can serve as soon as they are forked.
+"""
+import gc
+import multiprocessing
+import os
+import time
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+workers = int(os.environ.get('WEB_CONCURRENCY', '1'))
+threads = int(os.environ.get('GUNICORN_THREADS', '8'))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', '120'))
+preload_app = os.environ.get('GUNICORN_PRELOAD', 'true').lower() in ('1', 'true', 'yes')
+
+# A preloaded master must finish loading the model before it forks; without
+# preload each worker starts listening at once and loads in the background
+os.environ.setdefault('MODEL_LOAD', 'eager' if preload_app else 'background')
+
+
+def _worker_threads():
+    # Split the cores between workers unless INFERENCE_THREADS says otherwise
+    configured = int(os.environ.get('INFERENCE_THREADS', '0'))
+    if configured > 0:
+        return configured
+    return max(1, multiprocessing.cpu_count() // max(1, workers))
+
+
+def pre_fork(server, worker):
+    # Move everything allocated so far out of the GC's reach, so collections in
+    # the workers do not write to (and un-share) the master's pages
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    worker.forked_at = time.time()
+
+
+def post_worker_init(worker):
+    import main
+    main.on_worker_start(threads=_worker_threads(), started_at=worker.forked_at)
@@ -0,0 +1,252 @@
+"""
+Model loading and batched forward passes.
+
+Everything that needs torch lives here, so main.py can start serving health
+checks before torch is imported; model_loader.py decides when this module is
+loaded.
+"""
+import logging
+import os
+import time
+
+import torch
+import torchvision.transforms as transforms
+
+from calibration import Calibrator, calibration_path
+from metrics import BATCH_SIZE, STAGE_SECONDS
+from optimize import optimize_for_inference, check_parity, load_quantized
+from pneumonia_model import PneumoniaCNN
+from preprocessing import IMAGE_SIZE, to_batch
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_MODEL_PATH = os.path.join(BASE_DIR, "pneumonia_detection_model.pth")
+DEFAULT_QUANTIZED_MODEL_PATH = os.path.join(BASE_DIR, "pneumonia_detection_model_int8.pt")
+OPTIMIZED_PARITY_TOLERANCE = 1e-4
+
+logger = logging.getLogger(__name__)
+
+# Define image transforms - same as training. Inference uses the equivalent
+# tensor-native path in preprocessing.py (see `python preprocessing.py`)
+transform = transforms.Compose([
+    transforms.Resize((150, 150)),  # Resize to match model's expected input size
+    transforms.ToTensor(),          # Convert to tensor and scale to [0, 1]
+])
+
+
+class ModelRuntime:
+    """A loaded model ready to serve, with the weights file, registry version
+    (None for an unregistered file) and mode it came from.
+
+    With a ``calibrator`` (see calibration.py), every probability returned is
+    calibrated, applied to the whole batch at once.
+    """
+
+    def __init__(self, model, device, weights_path, mode, load_seconds, version=None, calibrator=None):
+        self.model = model
+        self.device = device
+        self.weights_path = weights_path
+        self.mode = mode
+        self.load_seconds = load_seconds
+        self.version = version
+        self.calibrator = calibrator
+        # Whether the weights are memory-mapped (see load_runtime)
+        self.weights_mmap = False
+        # Prediction-cache fingerprint (cache.model_version), set by the server
+        self.cache_version = None
+        self._tta = {}
+        self._explainers = {}
+
+    @property
+    def cache_variant(self):
+        """Distinguishes cached results of the same weights served differently"""
+        return f"{self.mode}.cal-{self.calibrator.id}" if self.calibrator else self.mode
+
+    def run_batch(self, image_arrays):
+        """Run a list of decoded uint8 image arrays through the model as one batch"""
+        BATCH_SIZE.observe(len(image_arrays))
+        with STAGE_SECONDS.time(stage='transform'):
+            batch = to_batch(image_arrays).to(self.device)
+        with STAGE_SECONDS.time(stage='forward'), torch.no_grad():
+            output = self.model(batch)
+        # Model already has sigmoid in final layer
+        if self.calibrator is None:
+            return output[:, 0].tolist()
+        with STAGE_SECONDS.time(stage='calibrate'):
+            return self.calibrator.apply(output[:, 0].float().cpu().numpy()).tolist()
+
+    def run_batch_tta(self, image_arrays, views, ensemble_paths=(), chunk_size=None):
+        """Like run_batch, but returns (mean probability, variance) per image over
+        ``views`` test-time augmentations of this model and of the models in
+        ``ensemble_paths`` (see tta.py)"""
+        from tta import TTAEnsemble
+
+        key = (views, tuple(ensemble_paths), chunk_size)
+        runner = self._tta.get(key)
+        if runner is None:
+            # Extra checkpoints are loaded once per runtime; a hot swap starts afresh
+            models = [self.model] + [load_float_model(path, self.device) for path in ensemble_paths]
+            runner = self._tta[key] = TTAEnsemble(models, views, chunk_size=chunk_size,
+                                                  stack=self.device.type == 'cuda')
+        BATCH_SIZE.observe(len(image_arrays))
+        with STAGE_SECONDS.time(stage='transform'):
+            batch = to_batch(image_arrays).to(self.device)
+        with STAGE_SECONDS.time(stage='forward'):
+            if self.calibrator is None:
+                mean, variance = runner(batch)
+                return list(zip(mean.tolist(), variance.tolist()))
+            samples = runner.samples_for(batch)
+        # Every view/model prediction is calibrated before the mean and variance
+        with STAGE_SECONDS.time(stage='calibrate'):
+            samples = self.calibrator.apply(samples.cpu().numpy())
+        return list(zip(samples.mean(axis=1).tolist(), samples.var(axis=1).tolist()))
+
+    def run_batch_explain(self, image_arrays, heatmap_size):
+        """Like run_batch, but also returns a (heatmap_size, heatmap_size)
+        uint8 Grad-CAM heatmap per image from the same forward pass (see gradcam.py)"""
+        from gradcam import GradCAM
+
+        if self.mode == 'quantized':
+            raise ValueError("Explanations need the float model (MODEL_MODE=eager or optimized)")
+        explainer = self._explainers.get(heatmap_size)
+        if explainer is None:
+            # The optimized TorchScript graph cannot be split, so it explains with the eager weights
+            model = self.model if self.mode == 'eager' else load_float_model(self.weights_path, self.device)
+            explainer = self._explainers[heatmap_size] = GradCAM(model, heatmap_size)
+        BATCH_SIZE.observe(len(image_arrays))
+        with STAGE_SECONDS.time(stage='transform'):
+            batch = to_batch(image_arrays).to(self.device)
+        with STAGE_SECONDS.time(stage='forward'):
+            probs, heatmaps = explainer(batch)
+        probs = probs.float().cpu().numpy()
+        if self.calibrator is not None:
+            with STAGE_SECONDS.time(stage='calibrate'):
+                probs = self.calibrator.apply(probs)
+        return list(zip(probs.tolist(), heatmaps.cpu().numpy()))
+
+    def warmup(self, image_size=IMAGE_SIZE):
+        """One forward pass on a blank image, so the first real batch does not
+        pay for allocations and kernel selection"""
+        with torch.no_grad():
+            self.model(torch.zeros(1, 3, image_size, image_size, device=self.device))
+
+    @property
+    def threads(self):
+        return torch.get_num_threads()
+
+    def set_threads(self, threads):
+        torch.set_num_threads(threads)
+
+
+def load_float_model(model_path, device, weights_mmap=True):
+    """Load PneumoniaCNN weights; on CPU they can be memory-mapped and shared"""
+    if weights_mmap and device.type == 'cpu':
+        # Build the module without allocating (or randomly initialising) weights,
+        # then point its parameters at the memory-mapped tensors
+        with torch.device('meta'):
+            model = PneumoniaCNN()
+        logger.debug("Model architecture created")
+
+        state_dict = torch.load(model_path, map_location=device, mmap=True)
+        logger.debug(f"State dict memory-mapped, {len(state_dict)} tensors")
+
+        model.load_state_dict(state_dict, assign=True)
+        logger.debug("Memory-mapped weights assigned to model")
+    else:
+        model = PneumoniaCNN().to(device)
+        logger.debug("Model architecture created")
+
+        state_dict = torch.load(model_path, map_location=device)
+        logger.debug(f"State dict loaded, {len(state_dict)} tensors")
+
+        model.load_state_dict(state_dict)
+        logger.debug("State dict loaded into model")
+
+    model.eval()
+    logger.debug("Model set to eval mode")
+    return model
+
+
+def load_calibrator(model_path):
+    """The calibration artifact saved next to ``model_path``, or None if there
+    is none or it was fitted for other weights"""
+    path = calibration_path(model_path)
+    if not os.path.exists(path):
+        return None
+    from model_registry import file_sha256
+    try:
+        calibrator = Calibrator.load(path)
+    except Exception as e:
+        logger.warning(f"Could not load calibration from {path} ({type(e).__name__}: {str(e)}), serving raw probabilities")
+        return None
+    if calibrator.weights_sha256 and calibrator.weights_sha256 != file_sha256(model_path):
+        logger.warning(f"Calibration in {path} was fitted for other weights, serving raw probabilities")
+        return None
+    logger.info(f"Using {calibrator.method} calibration from {path}")
+    return calibrator
+
+
+def load_runtime(model_path=DEFAULT_MODEL_PATH, mode='eager', weights_mmap=True, threads=0,
+                 quantized_model_path=DEFAULT_QUANTIZED_MODEL_PATH, version=None):
+    """Load the model for serving.
+
+    mode is 'eager', 'optimized' (BatchNorm folded, frozen channels-last
+    TorchScript, used only if it matches the eager model within
+    OPTIMIZED_PARITY_TOLERANCE) or 'quantized' (the INT8 model built by
+    quantize_model.py). Optimized and quantized modes fall back to the eager
+    model when they cannot be used.
+
+    ``weights_mmap`` memory-maps the weights of registry versions, which are
+    never modified. An unregistered file (``version`` None) is read into
+    memory: train_model.py can replace it while it is being served.
+    """
+    load_started = time.perf_counter()
+    if threads > 0:
+        torch.set_num_threads(threads)
+        logger.info(f"Intra-op threads set to {threads}")
+
+    if mode == 'quantized':
+        try:
+            model, quantization_info = load_quantized(quantized_model_path)
+            logger.info(f"Using INT8 model from {quantized_model_path} (engine: {quantization_info.get('engine')})")
+            return ModelRuntime(model, torch.device('cpu'), quantized_model_path, 'quantized',
+                                time.perf_counter() - load_started)
+        except Exception as e:
+            logger.warning(f"Could not load quantized model ({type(e).__name__}: {str(e)}), using float model")
+
+    logger.info(f"Attempting to load model from: {model_path}")
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    logger.info(f"Using device: {device}")
+    try:
+        weights_mmap = weights_mmap and version is not None and device.type == 'cpu'
+        model = load_float_model(model_path, device, weights_mmap=weights_mmap)
+    except Exception as e:
+        logger.error(f"Error loading model: {str(e)}")
+        logger.error(f"Error type: {type(e).__name__}")
+        logger.error(f"Current working directory: {os.getcwd()}")
+        logger.error(f"Directory contents: {os.listdir(BASE_DIR)}")
+        raise
+    served_mode = 'eager'
+
+    if mode == 'optimized':
+        if device.type != 'cpu':
+            logger.warning(f"Optimized mode targets CPU inference, keeping eager model on {device}")
+        else:
+            try:
+                optimized_model = optimize_for_inference(model)
+                parity = check_parity(model, optimized_model)
+                logger.info(f"Optimized model parity vs eager (max abs diff): {parity:.2e}")
+                if parity <= OPTIMIZED_PARITY_TOLERANCE:
+                    model = optimized_model
+                    served_mode = 'optimized'
+                    logger.info("Using optimized model")
+                else:
+                    logger.warning("Optimized model failed parity check, keeping eager model")
+            except Exception as e:
+                logger.warning(f"Could not build optimized model ({type(e).__name__}: {str(e)}), keeping eager model")
+
+    load_seconds = time.perf_counter() - load_started
+    logger.info(f"Model loaded successfully in {load_seconds:.3f}s")
+    runtime = ModelRuntime(model, device, model_path, served_mode, load_seconds, version=version,
+                           calibrator=load_calibrator(model_path))
+    runtime.weights_mmap = weights_mmap
+    return runtime
@@ -1,11 +1,23 @@
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, request, jsonify, send_from_directory, Response, stream_with_context, g
 from flask_cors import CORS
-import torch
-import torch.nn as nn
-import torchvision.transforms as transforms
-from PIL import Image
-import io
+from werkzeug.exceptions import RequestEntityTooLarge
+import json
+import logging
 import os
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from archives import iter_archive, iter_uploads, read_limited
+from batching import BatchScheduler
+from cache import PredictionCache, model_version
+import metrics
+from metrics import (ERRORS, IN_FLIGHT, MODEL_INFO, MODEL_RELOADS, PREDICTIONS, REQUESTS, REQUEST_SECONDS, STAGE_SECONDS,
+                     process_memory)
+from model_loader import ModelLoader, ModelNotReady
+from model_registry import ModelRegistry, RegistryWatcher
+from preprocessing import IMAGE_SIZE, ImageTooLarge, decode_image
 
 app = Flask(__name__, static_folder='../dist', static_url_path='')
 
@@ -27,87 +39,403 @@ CORS(app, origins=get_allowed_origins(), methods=['GET', 'POST', 'OPTIONS'], all
 # Enable debug mode only in development
 app.debug = os.environ.get('FLASK_ENV') == 'development'
 
-# Define the model architecture (improved version)
-class PneumoniaCNN(nn.Module):
-    def __init__(self):
-        super(PneumoniaCNN, self).__init__()
-        self.features = nn.Sequential(
-            nn.Conv2d(3, 32, kernel_size=3, padding=1),
-            nn.ReLU(),
-            nn.BatchNorm2d(32),
-            nn.MaxPool2d(2, 2),
-
-            nn.Conv2d(32, 64, kernel_size=3, padding=1),
-            nn.ReLU(),
-            nn.Dropout(0.1),
-            nn.BatchNorm2d(64),
-            nn.MaxPool2d(2, 2),
-
-            nn.Conv2d(64, 64, kernel_size=3, padding=1),
-            nn.ReLU(),
-            nn.BatchNorm2d(64),
-            nn.MaxPool2d(2, 2),
-
-            nn.Conv2d(64, 128, kernel_size=3, padding=1),
-            nn.ReLU(),
-            nn.Dropout(0.2),
-            nn.BatchNorm2d(128),
-            nn.MaxPool2d(2, 2),
-
-            nn.Conv2d(128, 256, kernel_size=3, padding=1),
-            nn.ReLU(),
-            nn.Dropout(0.2),
-            nn.BatchNorm2d(256),
-            nn.MaxPool2d(2, 2),
-        )
-        # Calculate the correct input size for the linear layer
-        # 150x150 -> 75x75 -> 37x37 -> 18x18 -> 9x9 -> 4x4
-        # So the final feature map is 256 * 4 * 4 = 4096
-        self.classifier = nn.Sequential(
-            nn.Linear(256 * 4 * 4, 128),
-            nn.ReLU(),
-            nn.Dropout(0.2),
-            nn.Linear(128, 1),
-            nn.Sigmoid()
-        )
+# Per-request details are logged at DEBUG, which is only on by default in development
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'DEBUG' if app.debug else 'INFO').upper()
+logging.basicConfig(level=LOG_LEVEL, format='%(asctime)s %(levelname)s [%(process)d] %(name)s: %(message)s')
+logger = logging.getLogger(__name__)
 
-    def forward(self, x):
-        x = self.features(x)
-        x = x.view(x.size(0), -1)
-        return self.classifier(x)
-
-# Load the model
-try:
-    model_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "pneumonia_detection_model.pth")
-    print(f"Attempting to load model from: {model_path}")
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    print(f"Using device: {device}")
-    
-    model = PneumoniaCNN().to(device)
-    print("Model architecture created")
-    
-    state_dict = torch.load(model_path, map_location=device)
-    print(f"State dict loaded, keys: {state_dict.keys()}")
-    
-    model.load_state_dict(state_dict)
-    print("State dict loaded into model")
+# Memory-map registry versions' weights on CPU: parameters then live in the OS
+# page cache and are shared by every worker process instead of being copied
+# into each one. MODEL_PATH is read into memory (see inference.load_runtime).
+WEIGHTS_MMAP = os.environ.get('WEIGHTS_MMAP', 'true').lower() in ('1', 'true', 'yes')
+WORKER_STARTED_AT = time.time()
+first_prediction_seconds = None
+
+# Optional CPU inference modes (see inference.load_runtime):
+# - MODEL_MODE=optimized folds BatchNorm, drops Dropout, uses channels-last and a
+#   frozen TorchScript graph, if it matches the eager model's outputs.
+# - MODEL_MODE=quantized serves the INT8 model built by quantize_model.py.
+MODEL_MODE = os.environ.get('MODEL_MODE', 'eager')
+INFERENCE_THREADS = int(os.environ.get('INFERENCE_THREADS', '0'))
+MODEL_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "pneumonia_detection_model.pth")
+QUANTIZED_MODEL_PATH = os.environ.get('QUANTIZED_MODEL_PATH') or os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "pneumonia_detection_model_int8.pt")
+
+# Versioned weights (see model_registry.py). The server serves MODEL_VERSION if
+# set, otherwise the registry's active version, otherwise MODEL_PATH. Unless a
+# version is pinned, every MODEL_WATCH_INTERVAL seconds each worker checks the
+# active version and hot-swaps to it; the previous model keeps serving until
+# the swap and is released once its in-flight batches have drained (waiting at
+# most MODEL_DRAIN_TIMEOUT seconds).
+MODEL_REGISTRY_DIR = os.environ.get('MODEL_REGISTRY_DIR') or os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "models")
+MODEL_VERSION = os.environ.get('MODEL_VERSION') or None
+MODEL_WATCH_INTERVAL = float(os.environ.get('MODEL_WATCH_INTERVAL', '10'))
+MODEL_DRAIN_TIMEOUT = float(os.environ.get('MODEL_DRAIN_TIMEOUT', '30'))
+
+# When to import torch and load the model: 'background' (default) starts the app
+# immediately and loads in a thread, 'lazy' loads on the first request, 'eager'
+# loads at import time. Requests wait up to MODEL_READY_TIMEOUT seconds for it.
+MODEL_LOAD = os.environ.get('MODEL_LOAD', 'background')
+MODEL_READY_TIMEOUT = float(os.environ.get('MODEL_READY_TIMEOUT', '60'))
+
+# 'pil' resizes in the image's native mode (exact parity with `transform`),
+# 'torch' uses an antialiased bilinear tensor kernel (within 1/255)
+PREPROCESS_BACKEND = os.environ.get('PREPROCESS_BACKEND', 'pil')
+# Large JPEGs are decoded at reduced scale (draft mode) and other large
+# images box-reduced before the resize; see preprocessing.py
+DECODE_DRAFT = os.environ.get('DECODE_DRAFT', 'true').lower() in ('1', 'true', 'yes')
+
+# Upload limits (0 disables each): the whole request body, enforced while it
+# is read; each image, including archive members; and each image's pixel
+# count, checked from its header before decoding
+MAX_UPLOAD_MB = float(os.environ.get('MAX_UPLOAD_MB', '512'))
+MAX_IMAGE_MB = float(os.environ.get('MAX_IMAGE_MB', '32'))
+MAX_IMAGE_PIXELS = int(os.environ.get('MAX_IMAGE_PIXELS', '50000000'))
+MAX_IMAGE_BYTES = int(MAX_IMAGE_MB * 1024 * 1024) or None
+app.config['MAX_CONTENT_LENGTH'] = int(MAX_UPLOAD_MB * 1024 * 1024) or None
+
+# Dynamic micro-batching: concurrent requests are grouped into one forward pass
+BATCH_MAX_SIZE = int(os.environ.get('BATCH_MAX_SIZE', '16'))
+BATCH_MAX_WAIT_MS = float(os.environ.get('BATCH_MAX_WAIT_MS', '5'))
+
+# Opt-in uncertainty estimate (/predict?tta=1): mean and variance of the
+# probability over TTA_VIEWS test-time augmentations (see tta.py), run through
+# the served model and the registry versions listed in TTA_ENSEMBLE, batched
+# together with concurrent requests. TTA_CHUNK_SIZE caps the images per
+# forward call (0: no cap).
+TTA_VIEWS = int(os.environ.get('TTA_VIEWS', '8'))
+TTA_ENSEMBLE = [version.strip() for version in os.environ.get('TTA_ENSEMBLE', '').split(',') if version.strip()]
+TTA_CHUNK_SIZE = int(os.environ.get('TTA_CHUNK_SIZE', '4'))
+TTA_SAMPLES = TTA_VIEWS * (1 + len(TTA_ENSEMBLE))
+# Registry versions never change, so their names identify the ensemble in cache keys
+TTA_NAMESPACE = f"tta{TTA_VIEWS}" + ''.join(f"+{version}" for version in TTA_ENSEMBLE)
+
+# Opt-in explanations (/predict?explain=1): a Grad-CAM heatmap of
+# EXPLAIN_HEATMAP_SIZE px computed in the batched prediction pass (see gradcam.py)
+EXPLAIN_HEATMAP_SIZE = int(os.environ.get('EXPLAIN_HEATMAP_SIZE', '32'))
+EXPLAIN_NAMESPACE = f"explain{EXPLAIN_HEATMAP_SIZE}"
+
+registry = ModelRegistry(MODEL_REGISTRY_DIR)
+
+def resolve_model(version=None):
+    """(registry version or None, weights path) of the model to serve"""
+    version = version or MODEL_VERSION or registry.current()
+    if version is None:
+        return None, MODEL_PATH
+    metadata = registry.get(version)
+    if metadata['input_size'] != IMAGE_SIZE:
+        raise ValueError(f"Model {version} expects {metadata['input_size']}px input, "
+                         f"the server preprocesses to {IMAGE_SIZE}px")
+    return version, registry.weights_path(version)
+
+def _load_version(version=None):
+    import inference
+    version, model_path = resolve_model(version)
+    return inference.load_runtime(
+        model_path,
+        mode=MODEL_MODE,
+        weights_mmap=WEIGHTS_MMAP,
+        threads=INFERENCE_THREADS,
+        quantized_model_path=QUANTIZED_MODEL_PATH,
+        version=version,
+    )
+
+def load_model_runtime():
+    """Import torch and load the model (run by model_loader)"""
+    runtime = _load_version()
+    runtime.cache_version = model_version(runtime.weights_path, runtime.cache_variant)
+    cache.set_weights(runtime.weights_path, variant=runtime.cache_variant)
+    MODEL_INFO.set(1, version=runtime.version or 'unversioned', mode=runtime.mode)
+    return runtime
+
+_reload_lock = threading.Lock()
+
+def reload_model(version):
+    """Load and warm up ``version``, swap it in and release the previous model
+    once its in-flight batches have drained. Returns False if the first model
+    has not finished loading yet."""
+    if not model_loader.ready:
+        return False
+    with _reload_lock:
+        previous = model_loader.runtime
+        started = time.perf_counter()
+        try:
+            runtime = _load_version(version)
+            runtime.warmup()
+            runtime.cache_version = model_version(runtime.weights_path, runtime.cache_variant)
+        except Exception:
+            MODEL_RELOADS.inc(result='failed')
+            raise
+        # Results are cached only under the fingerprint of the runtime that
+        # computed them (see _results), so requests keyed either side of the
+        # swap never store one model's results under the other's fingerprint
+        cache.set_weights(runtime.weights_path, variant=runtime.cache_variant)
+        _, drained = model_loader.swap(runtime, drain_timeout=MODEL_DRAIN_TIMEOUT)
+        MODEL_INFO.clear()
+        MODEL_INFO.set(1, version=runtime.version or 'unversioned', mode=runtime.mode)
+        MODEL_RELOADS.inc(result='ok' if drained else 'drain_timeout')
+        logger.info(f"Swapped model {previous.version or 'unversioned'} -> {runtime.version} in "
+                    f"{time.perf_counter() - started:.3f}s"
+                    f"{'' if drained else f', previous model still busy after {MODEL_DRAIN_TIMEOUT}s'}")
+    return True
+
+watcher = RegistryWatcher(
+    registry,
+    reload_model,
+    served_version=lambda: model_loader.runtime.version if model_loader.ready else None,
+    # A pinned version, or INT8 weights (not registry versions), are never swapped
+    interval=0 if MODEL_VERSION or MODEL_MODE == 'quantized' else MODEL_WATCH_INTERVAL,
+)
+
+def get_runtime():
+    """The loaded model runtime; waits for a load in progress"""
+    watcher.ensure_started()
+    return model_loader.get(timeout=MODEL_READY_TIMEOUT)
+
+def _results(runtime, probs, variances=None):
+    """Result dicts (as cached) for a batch of outputs of ``runtime``"""
+    results = [{'pneumonia_prob': prob, 'model_version': runtime.cache_version} for prob in probs]
+    for i, result in enumerate(results):
+        if variances is not None:
+            result['variance'] = variances[i]
+        if runtime.calibrator is not None:
+            result['calibrated'] = True
+    return results
+
+def run_model_batch(image_arrays):
+    """Run a list of decoded uint8 image arrays through the model as one batch
+    and return a result dict ({'pneumonia_prob'[, 'calibrated']}) per image"""
+    global first_prediction_seconds
+    watcher.ensure_started()
+    # Holds this runtime until the batch is done, even if a new version is swapped in meanwhile
+    with model_loader.use(timeout=MODEL_READY_TIMEOUT) as runtime:
+        results = _results(runtime, runtime.run_batch(image_arrays))
+    if first_prediction_seconds is None:
+        first_prediction_seconds = time.time() - WORKER_STARTED_AT
+    return results
+
+scheduler = BatchScheduler(run_model_batch, max_batch_size=BATCH_MAX_SIZE, max_wait_ms=BATCH_MAX_WAIT_MS)
+
+def run_tta_batch(image_arrays):
+    """Result dicts with the mean probability and its variance over the TTA
+    views and ensemble"""
+    watcher.ensure_started()
+    ensemble_paths = [registry.weights_path(version) for version in TTA_ENSEMBLE]
+    with model_loader.use(timeout=MODEL_READY_TIMEOUT) as runtime:
+        outputs = runtime.run_batch_tta(image_arrays, TTA_VIEWS, ensemble_paths, chunk_size=TTA_CHUNK_SIZE or None)
+        return _results(runtime, [mean for mean, _ in outputs], [variance for _, variance in outputs])
+
+tta_scheduler = BatchScheduler(run_tta_batch, max_batch_size=BATCH_MAX_SIZE, max_wait_ms=BATCH_MAX_WAIT_MS)
+
+def run_explain_batch(image_arrays):
+    """Result dicts with a raw uint8 Grad-CAM heatmap per image. The heatmaps
+    are PNG-encoded by finish_result, off the scheduler thread."""
+    watcher.ensure_started()
+    with model_loader.use(timeout=MODEL_READY_TIMEOUT) as runtime:
+        outputs = runtime.run_batch_explain(image_arrays, EXPLAIN_HEATMAP_SIZE)
+        results = _results(runtime, [prob for prob, _ in outputs])
+    for result, (_, heatmap) in zip(results, outputs):
+        result['heatmap'] = heatmap
+    return results
+
+explain_scheduler = BatchScheduler(run_explain_batch, max_batch_size=BATCH_MAX_SIZE, max_wait_ms=BATCH_MAX_WAIT_MS)
+
+def on_worker_start(threads=None, started_at=None):
+    """Per-worker setup, called by gunicorn once the worker has the app loaded"""
+    global WORKER_STARTED_AT, INFERENCE_THREADS, first_prediction_seconds
+    WORKER_STARTED_AT = started_at or time.time()
+    first_prediction_seconds = None
+    if threads:
+        INFERENCE_THREADS = threads
+        if model_loader.ready:
+            model_loader.runtime.set_threads(threads)
+    watcher.ensure_started()
+
+# Content-addressed result cache (upload hash + weights fingerprint), LRU in
+# memory with an optional on-disk tier shared across workers
+PREDICTION_CACHE_SIZE = int(os.environ.get('PREDICTION_CACHE_SIZE', '2048'))
+PREDICTION_CACHE_DIR = os.environ.get('PREDICTION_CACHE_DIR') or None
+PREDICTION_CACHE_DISK_MB = float(os.environ.get('PREDICTION_CACHE_DISK_MB', '1024'))
+# The weights fingerprint is set once the model has been loaded
+cache = PredictionCache(
+    None,
+    max_entries=PREDICTION_CACHE_SIZE,
+    disk_dir=PREDICTION_CACHE_DIR,
+    max_disk_bytes=PREDICTION_CACHE_DISK_MB * 1024 * 1024,
+)
+
+# Bulk prediction: images are decoded in parallel and run in fixed-size chunks
+PREDICT_CHUNK_SIZE = int(os.environ.get('PREDICT_CHUNK_SIZE', '32'))
+PREPROCESS_WORKERS = int(os.environ.get('PREPROCESS_WORKERS', str(min(8, os.cpu_count() or 1))))
+preprocess_pool = ThreadPoolExecutor(max_workers=PREPROCESS_WORKERS, thread_name_prefix='preprocess')
+
+model_loader = ModelLoader(load_model_runtime, mode=MODEL_LOAD)
+metrics.MODEL_LOADED.set_function(lambda: model_loader.ready)
+metrics.QUEUE_DEPTH.set_function(scheduler.queue_depth)
+model_loader.start()
+
+def load_image_array(image_bytes):
+    """Decode raw image bytes into a resized uint8 array"""
+    return decode_image(image_bytes, backend=PREPROCESS_BACKEND, draft=DECODE_DRAFT,
+                        max_pixels=MAX_IMAGE_PIXELS or None)
+
+def format_prediction(pneumonia_prob, calibrated=False):
+    """Turn a pneumonia probability into a (prediction, confidence %) pair.
+
+    A calibrated probability (fitted offline, see calibration.py) is reported
+    as is; otherwise a fixed heuristic damps overconfident outputs.
+    """
+    if pneumonia_prob > 0.5:
+        prediction = "Pneumonia"
+        confidence = pneumonia_prob * 100
+    else:
+        prediction = "Normal"
+        confidence = (1 - pneumonia_prob) * 100
+    if calibrated:
+        return prediction, confidence
     
-    model.eval()
-    print("Model set to eval mode")
-    print("Model loaded successfully")
-except Exception as e:
-    print(f"Error loading model: {str(e)}")
-    print(f"Error type: {type(e).__name__}")
-    print(f"Current working directory: {os.getcwd()}")
-    print(f"Directory contents: {os.listdir(os.path.dirname(os.path.abspath(__file__)))}")
-    model = None
-    print("Model loading failed, but continuing without model")
-
-# Define image transforms - same as training
-transform = transforms.Compose([
-    transforms.Resize((150, 150)),  # Resize to match model's expected input size
-    transforms.ToTensor(),          # Convert to tensor and scale to [0, 1]
-])
+    # Apply confidence calibration to reduce overconfidence
+    # This makes extreme probabilities less extreme
+    if confidence > 95:
+        confidence = 85 + (confidence - 95) * 0.3  # Cap at ~88%
+    elif confidence < 5:
+        confidence = 15 - (5 - confidence) * 0.3   # Floor at ~12%
+    return prediction, confidence
+
+def prediction_namespace(tta=False, explain=False):
+    """Cache namespace for a /predict mode; all are keyed by the same upload hash"""
+    return TTA_NAMESPACE if tta else EXPLAIN_NAMESPACE if explain else 'prediction'
+
+def prediction_scheduler(tta=False, explain=False):
+    return tta_scheduler if tta else explain_scheduler if explain else scheduler
+
+def finish_result(result, cache_key=None):
+    """PNG-encode a computed result's raw heatmap (if any) and cache it.
+    Runs in the requesting thread, so encoding never holds up the next batch."""
+    if 'heatmap' in result and not isinstance(result['heatmap'], str):
+        from gradcam import encode_heatmap
+        with STAGE_SECONDS.time(stage='encode_heatmap'):
+            result = dict(result, heatmap=encode_heatmap(result['heatmap']))
+    if cache_key:
+        cache.put(cache_key, result, result['model_version'])
+    return result
+
+def is_enabled(value):
+    """Whether a query/form flag such as ``tta`` is switched on"""
+    return (value or '').lower() in ('1', 'true', 'yes')
+
+def prediction_body(result, tta=False, explain=False):
+    """JSON body for a cached or computed result
+    ({'pneumonia_prob'[, 'variance'][, 'heatmap'][, 'calibrated']})"""
+    prediction, confidence = format_prediction(result['pneumonia_prob'], result.get('calibrated', False))
+    body = {
+        'prediction': prediction,
+        'confidence': round(confidence, 2)
+    }
+    if tta:
+        body.update(
+            probability=round(result['pneumonia_prob'], 6),
+            variance=round(result['variance'], 6),
+            std=round(result['variance'] ** 0.5, 6),
+            samples=TTA_SAMPLES,
+        )
+    if explain:
+        body['heatmap'] = result['heatmap']
+    return body
+
+def _safe_load(entry, namespace='prediction'):
+    """Return (name, cache_key, image, cached_result, error) for one upload"""
+    name, image_bytes = entry
+    if isinstance(image_bytes, Exception):
+        # An archive member that was over MAX_IMAGE_MB (see archives.iter_archive)
+        return name, None, None, None, f"{type(image_bytes).__name__}: {str(image_bytes)}"
+    with STAGE_SECONDS.time(stage='cache_lookup'):
+        cache_key = cache.key(image_bytes, namespace=namespace) if cache.enabled else None
+        cached = cache.get(cache_key) if cache_key else None
+    if cached is not None:
+        return name, cache_key, None, cached, None
+    try:
+        with STAGE_SECONDS.time(stage='decode'):
+            image = load_image_array(image_bytes)
+        return name, cache_key, image, None, None
+    except Exception as e:
+        return name, cache_key, None, None, f"{type(e).__name__}: {str(e)}"
+
+def iter_chunks(entries, size, ramp_up=False):
+    """Group entries into lists of ``size``; with ramp_up, start at 1 and double"""
+    chunk = []
+    target = 1 if ramp_up else size
+    for entry in entries:
+        chunk.append(entry)
+        if len(chunk) == target:
+            yield chunk
+            chunk = []
+            target = min(size, target * 2)
+    if chunk:
+        yield chunk
+
+def predict_entries(entries, ramp_up=False, endpoint='/predict/batch'):
+    """Yield one result dict per (name, bytes) entry, in input order.
+
+    Entries are consumed lazily and decoding of the next chunk is overlapped
+    with the forward pass of the current one, so at most two chunks are held
+    in memory. With ramp_up the first chunks are small, which gets the first
+    results out quickly when streaming.
+    """
+    chunks = iter_chunks(entries, PREDICT_CHUNK_SIZE, ramp_up=ramp_up)
+    pending = None
+    for chunk in chunks:
+        decoded = preprocess_pool.map(_safe_load, chunk)
+        if pending is not None:
+            yield from _run_decoded_chunk(pending, endpoint)
+        pending = decoded
+    if pending is not None:
+        yield from _run_decoded_chunk(pending, endpoint)
+
+def _run_decoded_chunk(decoded, endpoint):
+    decoded = list(decoded)
+    images = [image for _, _, image, _, _ in decoded if image is not None]
+    results = iter(run_model_batch(images)) if images else iter(())
+    for name, cache_key, image, cached, error in decoded:
+        if error is not None:
+            ERRORS.inc(endpoint=endpoint, type=error.split(':', 1)[0])
+            yield {'filename': name, 'error': error}
+            continue
+        if image is not None:
+            result = next(results)
+            if cache_key:
+                cache.put(cache_key, result, result['model_version'])
+        else:
+            result = cached
+        prediction, confidence = format_prediction(result['pneumonia_prob'], result.get('calibrated', False))
+        PREDICTIONS.inc(prediction=prediction, source='cache' if image is None else 'model')
+        yield {
+            'filename': name,
+            'prediction': prediction,
+            'confidence': round(confidence, 2)
+        }
+
+def _endpoint_label():
+    return request.url_rule.rule if request.url_rule else 'unmatched'
+
+@app.before_request
+def start_request_metrics():
+    g.request_started = time.perf_counter()
+    IN_FLIGHT.inc(endpoint=_endpoint_label())
+
+@app.after_request
+def count_request(response):
+    REQUESTS.inc(endpoint=_endpoint_label(), status=response.status_code)
+    return response
+
+@app.teardown_request
+def finish_request_metrics(exc=None):
+    # Runs after a streamed response has been fully sent
+    if 'request_started' in g:
+        endpoint = _endpoint_label()
+        IN_FLIGHT.dec(endpoint=endpoint)
+        REQUEST_SECONDS.observe(time.perf_counter() - g.request_started, endpoint=endpoint)
 
 @app.route('/')
 def home():
@@ -117,19 +445,21 @@ def home():
             return send_from_directory('../dist', 'index.html')
         
         # Fallback to API response if frontend not built
-        if model is None:
-            raise RuntimeError("Model not loaded")
+        if model_loader.state == 'failed':
+            raise RuntimeError(f"Model not loaded: {model_loader.error}")
             
         return jsonify({
             'status': 'ok',
             'message': 'Pneumonia Detection API is running',
-            'model_loaded': True,
+            'model_loaded': model_loader.ready,
             'endpoints': {
-                '/predict': 'POST - Make pneumonia predictions from chest X-ray images'
+                '/predict': 'POST - Make pneumonia predictions from chest X-ray images',
+                '/predict/batch': 'POST - Predict many images (multiple files or zip/tar archives)',
+                '/predict/stream': 'POST - Like /predict/batch, streaming NDJSON results as they are ready'
             }
         })
     except Exception as e:
-        print(f"Error in home endpoint: {str(e)}")
+        logger.error(f"Error in home endpoint: {str(e)}")
         return jsonify({
             'status': 'error',
             'message': str(e)
@@ -137,26 +467,113 @@ def home():
 
 @app.route('/api/health')
 def api_health():
-    """API health check endpoint"""
+    """API health check endpoint: 200 when ready, 503 while the model loads"""
     try:
-        if model is None:
-            raise RuntimeError("Model not loaded")
-            
+        if model_loader.state == 'failed':
+            raise RuntimeError(f"Model not loaded: {model_loader.error}")
+        
+        ready = model_loader.accepting
         return jsonify({
-            'status': 'ok',
-            'message': 'Pneumonia Detection API is running',
-            'model_loaded': True,
+            'status': 'ok' if ready else 'loading',
+            'message': 'Pneumonia Detection API is running' if ready else 'Model is loading',
+            'model_loaded': model_loader.ready,
+            'live': True,
+            'ready': ready,
+            'model': model_loader.status(),
             'endpoints': {
-                '/predict': 'POST - Make pneumonia predictions from chest X-ray images'
+                '/predict': 'POST - Make pneumonia predictions from chest X-ray images',
+                '/predict/batch': 'POST - Predict many images (multiple files or zip/tar archives)',
+                '/predict/stream': 'POST - Like /predict/batch, streaming NDJSON results as they are ready'
             }
-        })
+        }), 200 if ready else 503
     except Exception as e:
-        print(f"Error in health endpoint: {str(e)}")
+        logger.error(f"Error in health endpoint: {str(e)}")
         return jsonify({
             'status': 'error',
-            'message': str(e)
+            'message': str(e),
+            'model_loaded': False,
+            'live': True,
+            'ready': False
         }), 500
 
+@app.route('/api/health/live')
+def api_health_live():
+    """Liveness: the process is up and serving requests (model may still be loading)"""
+    return jsonify({'status': 'ok', 'live': True})
+
+@app.route('/api/health/ready')
+def api_health_ready():
+    """Readiness: the model is loaded (or loads on first use) and requests can be routed here"""
+    ready = model_loader.accepting
+    return jsonify({
+        'status': 'ok' if ready else model_loader.state,
+        'ready': ready,
+        'model': model_loader.status()
+    }), 200 if ready else 503
+
+def too_large_response(error):
+    """413 for a request body over MAX_UPLOAD_MB or an image over MAX_IMAGE_MB/MAX_IMAGE_PIXELS"""
+    message = error.description if isinstance(error, RequestEntityTooLarge) else str(error)
+    return jsonify({'error': f"{type(error).__name__}: {message}"}), 413
+
+@app.errorhandler(RequestEntityTooLarge)
+def request_too_large(error):
+    ERRORS.inc(endpoint=_endpoint_label(), type='RequestEntityTooLarge')
+    return too_large_response(error)
+
+def not_ready_response():
+    response = jsonify({'error': 'Model is still loading, please retry shortly'})
+    response.headers['Retry-After'] = '5'
+    return response, 503
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """Prometheus text-format metrics for this worker process"""
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+def model_info():
+    """The model version being served and the versions in the registry"""
+    runtime = model_loader.runtime if model_loader.ready else None
+    current = runtime.version if runtime is not None else None
+    return {
+        'serving': {
+            'version': current,
+            'weights_path': runtime.weights_path if runtime is not None else None,
+            'mode': runtime.mode if runtime is not None else None,
+            'calibration': runtime.calibrator.to_dict() if runtime is not None and runtime.calibrator else None,
+            'metadata': registry.get(current) if current else None,
+        },
+        'loader': model_loader.status(),
+        'registry': {
+            'root': MODEL_REGISTRY_DIR,
+            'active': registry.current(),
+            'pinned': MODEL_VERSION,
+            'watch_interval_s': watcher.interval,
+            'versions': [metadata['version'] for metadata in registry.versions()],
+        },
+    }
+
+@app.route('/api/model')
+def api_model():
+    return jsonify(model_info())
+
+@app.route('/api/stats')
+def api_stats():
+    """Inference statistics: batching scheduler, prediction cache and worker process"""
+    return jsonify({
+        'batching': scheduler.stats(),
+        'cache': cache.stats(),
+        'process': dict(
+            process_memory(),
+            pid=os.getpid(),
+            model_mode=model_loader.runtime.mode if model_loader.ready else None,
+            weights_mmap=model_loader.runtime.weights_mmap if model_loader.ready else None,
+            model_load_seconds=model_loader.status()['load_seconds'],
+            first_prediction_seconds=first_prediction_seconds,
+            torch_threads=model_loader.runtime.threads if model_loader.ready else None,
+        )
+    })
+
 @app.route('/predict', methods=['POST', 'OPTIONS'])
 def predict():
     # Handle preflight OPTIONS request
@@ -164,108 +581,182 @@ def predict():
         return '', 204
     
     try:
-        print("\n=== New Prediction Request ===\n")
-        print("Request files:", request.files)
-        print("Request form:", request.form)
-        print("Request headers:", dict(request.headers))
+        logger.debug("New prediction request")
         
-        if 'file' not in request.files:
-            print("No file in request.files")
+        with STAGE_SECONDS.time(stage='upload_read'):
+            file = request.files.get('file')
+            image_bytes = read_limited(file, MAX_IMAGE_BYTES) if file is not None and file.filename != '' else None
+        if file is None:
+            logger.debug("No file in request.files")
+            ERRORS.inc(endpoint='/predict', type='no_file')
             return jsonify({'error': 'No file provided'}), 400
-            
-        file = request.files['file']
-        if file.filename == '':
-            print("Empty filename")
+        if image_bytes is None:
+            logger.debug("Empty filename")
+            ERRORS.inc(endpoint='/predict', type='no_file')
             return jsonify({'error': 'No file selected'}), 400
             
-        print(f"Processing file: {file.filename}")
+        logger.debug(f"Processing file: {file.filename}, {len(image_bytes)} bytes")
+        # Test-time augmentation / ensemble with an uncertainty estimate
+        tta = is_enabled(request.args.get('tta') or request.form.get('tta'))
+        # Grad-CAM heatmap from the prediction pass
+        explain = is_enabled(request.args.get('explain') or request.form.get('explain'))
+        if tta and explain:
+            ERRORS.inc(endpoint='/predict', type='bad_request')
+            return jsonify({'error': 'tta and explain cannot be combined'}), 400
         
         try:
-            # Read and preprocess the image
-            image_bytes = file.read()
-            print(f"Read {len(image_bytes)} bytes")
-            
-            image = Image.open(io.BytesIO(image_bytes)).convert('RGB')
-            print(f"Image opened and converted to RGB, size: {image.size}")
-            
-            image_tensor = transform(image).unsqueeze(0).to(device)
-            print(f"Image transformed to tensor, shape: {image_tensor.shape}, dtype: {image_tensor.dtype}")
+            # Waits for the model if it is still loading
+            runtime = get_runtime()
+            if explain and runtime.mode == 'quantized':
+                ERRORS.inc(endpoint='/predict', type='bad_request')
+                return jsonify({'error': 'Explanations are not available with MODEL_MODE=quantized'}), 400
             
-            # Verify model is loaded and in eval mode
-            if model is None:
-                raise RuntimeError("Model not loaded")
-            if not model.training:
-                print("Model is in eval mode")
+            with STAGE_SECONDS.time(stage='cache_lookup'):
+                cache_key = cache.key(image_bytes, namespace=prediction_namespace(tta, explain)) \
+                    if cache.enabled else None
+                cached = cache.get(cache_key) if cache_key else None
+            if cached is not None:
+                result = cached
+                source = 'cache'
+                logger.debug(f"Cache hit: {cache_key}")
             else:
-                print("WARNING: Model is in training mode")
-                model.eval()
-            
-            # Make prediction
-            with torch.no_grad():
-                print("Making prediction...")
-                output = model(image_tensor)
-                print(f"Raw output shape: {output.shape}, values: {output}")
-                
-                # Model already has sigmoid in final layer
-                pneumonia_prob = output[0][0]
-                print(f"Model output (already sigmoid): {pneumonia_prob.item():.6f}")
-                
-                # Determine prediction and confidence
-                if pneumonia_prob > 0.5:
-                    prediction = "Pneumonia"
-                    confidence = float(pneumonia_prob) * 100
-                else:
-                    prediction = "Normal"
-                    confidence = float(1 - pneumonia_prob) * 100
+                with STAGE_SECONDS.time(stage='decode'):
+                    image_array = load_image_array(image_bytes)
+                logger.debug(f"Image decoded and resized, shape: {image_array.shape}, dtype: {image_array.dtype}")
                 
-                # Apply confidence calibration to reduce overconfidence
-                # This makes extreme probabilities less extreme
-                if confidence > 95:
-                    confidence = 85 + (confidence - 95) * 0.3  # Cap at ~88%
-                elif confidence < 5:
-                    confidence = 15 - (5 - confidence) * 0.3   # Floor at ~12%
-                
-                print(f"Pneumonia probability: {pneumonia_prob.item():.6f}")
-                print(f"Raw confidence: {confidence:.2f}%")
-                print(f"Final prediction: {prediction}, Confidence: {confidence:.2f}%")
-                print(f"Model confidence level: {'Very High' if confidence > 90 else 'High' if confidence > 70 else 'Medium' if confidence > 50 else 'Low'}")
+                # Make prediction (queued and batched with concurrent requests)
+                result = finish_result(prediction_scheduler(tta, explain).predict(image_array), cache_key)
+                source = 'model'
             
-            response = jsonify({
-                'prediction': prediction,
-                'confidence': round(confidence, 2)
-            })
+            # Determine prediction and calibrated confidence
+            with STAGE_SECONDS.time(stage='serialize'):
+                body = prediction_body(result, tta, explain)
+                response = jsonify(body)
+            PREDICTIONS.inc(prediction=body['prediction'], source=source)
+            logger.debug(f"Pneumonia probability: {result['pneumonia_prob']:.6f}, "
+                         f"prediction: {body['prediction']}, confidence: {body['confidence']:.2f}%")
             return response
             
-        except torch.cuda.OutOfMemoryError as e:
-            print(f"CUDA out of memory: {str(e)}")
-            return jsonify({'error': 'GPU memory error'}), 500
+        except ModelNotReady:
+            ERRORS.inc(endpoint='/predict', type='ModelNotReady')
+            return not_ready_response()
         except RuntimeError as e:
+            # torch.cuda.OutOfMemoryError is a RuntimeError too
+            if "CUDA out of memory" in str(e):
+                ERRORS.inc(endpoint='/predict', type='CudaOutOfMemory')
+                logger.error(f"CUDA out of memory: {str(e)}")
+                return jsonify({'error': 'GPU memory error'}), 500
             if "CUDA" in str(e):
-                print(f"CUDA error: {str(e)}")
+                ERRORS.inc(endpoint='/predict', type='CudaError')
+                logger.error(f"CUDA error: {str(e)}")
                 return jsonify({'error': 'GPU error'}), 500
             raise
             
     except Exception as e:
-        print("\n=== Error in prediction endpoint ===\n")
-        print(f"Error type: {type(e).__name__}")
-        print(f"Error message: {str(e)}")
-        import traceback
-        print("\nTraceback:")
-        traceback.print_exc()
+        ERRORS.inc(endpoint='/predict', type=type(e).__name__)
+        if isinstance(e, (ImageTooLarge, RequestEntityTooLarge)):
+            return too_large_response(e)
+        logger.exception(f"Error in prediction endpoint: {type(e).__name__}: {str(e)}")
         return jsonify({'error': f"{type(e).__name__}: {str(e)}"}), 500
 
+@app.route('/predict/batch', methods=['POST', 'OPTIONS'])
+def predict_batch():
+    """Predict many X-rays in one request (multiple files and/or zip/tar archives)"""
+    if request.method == 'OPTIONS':
+        return '', 204
+    
+    try:
+        get_runtime()
+        
+        files = [file for _, file in request.files.items(multi=True)]
+        if not files:
+            return jsonify({'error': 'No files provided'}), 400
+        
+        results = list(predict_entries(iter_uploads(files, MAX_IMAGE_BYTES)))
+        if not results:
+            return jsonify({'error': 'No images found in upload'}), 400
+        
+        return jsonify({
+            'count': len(results),
+            'errors': sum(1 for result in results if 'error' in result),
+            'results': results
+        })
+    except ModelNotReady:
+        ERRORS.inc(endpoint='/predict/batch', type='ModelNotReady')
+        return not_ready_response()
+    except Exception as e:
+        ERRORS.inc(endpoint='/predict/batch', type=type(e).__name__)
+        if isinstance(e, RequestEntityTooLarge):
+            return too_large_response(e)
+        logger.exception(f"Error in batch prediction endpoint: {type(e).__name__}: {str(e)}")
+        return jsonify({'error': f"{type(e).__name__}: {str(e)}"}), 500
+
+def iter_request_body_archive(stream, content_type):
+    """Yield (name, bytes) from an archive sent as the raw request body.
+
+    Tar archives (optionally compressed) are decoded straight off the socket.
+    Zip archives keep their index at the end, so they are spooled to a
+    temporary file on disk first.
+    """
+    if 'zip' in content_type:
+        with tempfile.TemporaryFile() as spool:
+            shutil.copyfileobj(stream, spool, 1024 * 1024)
+            spool.seek(0)
+            yield from iter_archive(spool, 'upload.zip', MAX_IMAGE_BYTES)
+    else:
+        yield from iter_archive(stream, 'upload.tar', MAX_IMAGE_BYTES)
+
+@app.route('/predict/stream', methods=['POST', 'OPTIONS'])
+def predict_stream():
+    """Stream one NDJSON result line per image as soon as it is predicted"""
+    if request.method == 'OPTIONS':
+        return '', 204
+    
+    try:
+        get_runtime()
+    except ModelNotReady:
+        return not_ready_response()
+    except RuntimeError as e:
+        return jsonify({'error': str(e)}), 500
+    
+    content_type = request.mimetype or ''
+    if content_type == 'multipart/form-data':
+        files = [file for _, file in request.files.items(multi=True)]
+        if not files:
+            return jsonify({'error': 'No files provided'}), 400
+        entries = iter_uploads(files, MAX_IMAGE_BYTES)
+    else:
+        entries = iter_request_body_archive(request.stream, content_type)
+    
+    def generate():
+        count = 0
+        errors = 0
+        try:
+            for result in predict_entries(entries, ramp_up=True, endpoint='/predict/stream'):
+                count += 1
+                if 'error' in result:
+                    errors += 1
+                yield json.dumps(result) + '\n'
+        except Exception as e:
+            ERRORS.inc(endpoint='/predict/stream', type=type(e).__name__)
+            logger.error(f"Error in streaming prediction endpoint: {type(e).__name__}: {str(e)}")
+            yield json.dumps({'error': f"{type(e).__name__}: {str(e)}"}) + '\n'
+        yield json.dumps({'done': True, 'count': count, 'errors': errors}) + '\n'
+    
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
 @app.route('/test-model', methods=['GET'])
 def test_model():
     """Test endpoint to check model outputs with a sample image"""
     try:
-        if model is None:
-            return jsonify({'error': 'Model not loaded'}), 500
-            
+        runtime = get_runtime()
+        import torch
+        
         # Create a random test tensor (simulating an image)
-        test_tensor = torch.randn(1, 3, 64, 64).to(device)
+        test_tensor = torch.randn(1, 3, 64, 64).to(runtime.device)
         
         with torch.no_grad():
-            output = model(test_tensor)
+            output = runtime.model(test_tensor)
             pneumonia_prob = torch.sigmoid(output[0][0])
             
         return jsonify({
@@ -0,0 +1,237 @@
+"""
+Prometheus-style metrics for the inference path.
+
+Small, dependency-free counters, gauges and histograms rendered in the
+Prometheus text exposition format (served at /metrics). Values are per
+process: with several gunicorn workers each scrape sees the worker that
+answered it, identified by the ``pid`` label on ``pneumonia_process_info``.
+"""
+import bisect
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Seconds; covers sub-millisecond cache lookups up to slow batched forward passes
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def process_memory(pid='self'):
+    """Resident (RSS) and proportional (PSS) memory of a process in MB.
+
+    PSS splits pages shared with other processes (e.g. copy-on-write weights
+    inherited from the gunicorn master) between them, so it is the better
+    per-worker figure. Linux only.
+    """
+    fields = {}
+    try:
+        with open(f'/proc/{pid}/smaps_rollup') as f:
+            for line in f:
+                key, _, value = line.partition(':')
+                if key in ('Rss', 'Pss'):
+                    fields[key.lower() + '_mb'] = round(int(value.split()[0]) / 1024, 1)
+    except (OSError, ValueError):
+        pass
+    return fields
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        (registry if registry is not None else REGISTRY).register(self)
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self._samples())
+        return lines
+
+    def _samples(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}" for key, value in items]
+
+
+class Counter(_Metric):
+    """Monotonically increasing count, optionally split by labels"""
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """A value that can go up and down, or be read from ``function`` at scrape time"""
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), registry=None, function=None):
+        super().__init__(name, documentation, labelnames, registry)
+        self._function = function
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set_function(self, function):
+        self._function = function
+
+    def _samples(self):
+        if self._function is not None:
+            try:
+                value = float(self._function())
+            except Exception:
+                return []
+            return [f"{self.name} {_format_value(value)}"]
+        return super()._samples()
+
+
+class Histogram(_Metric):
+    """Cumulative-bucket histogram of observed values"""
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), registry=None, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames, registry)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the wall time of the ``with`` block"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def _samples(self):
+        with self._lock:
+            items = sorted((key, ([*counts], total, count)) for key, (counts, total, count) in self._values.items())
+        lines = []
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labelnames, key, ('le', _format_value(bound)))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            if any(m.name == metric.name for m in self._metrics):
+                raise ValueError(f"Metric {metric.name} is already registered")
+            self._metrics.append(metric)
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format"""
+        with self._lock:
+            metrics = list(self._metrics)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+# Inference path instruments, shared by main.py, async_server.py and inference.py
+STAGE_SECONDS = Histogram(
+    'pneumonia_stage_seconds',
+    'Time spent per request stage (upload_read, cache_lookup, decode, encode_heatmap, serialize) '
+    'and per batch stage (transform, forward, calibrate)',
+    ['stage'],
+)
+REQUEST_SECONDS = Histogram(
+    'pneumonia_http_request_duration_seconds', 'HTTP request latency', ['endpoint'],
+)
+REQUESTS = Counter(
+    'pneumonia_http_requests_total', 'HTTP requests by endpoint and status', ['endpoint', 'status'],
+)
+PREDICTIONS = Counter(
+    'pneumonia_predictions_total', 'Predictions by class and whether they came from the cache or the model',
+    ['prediction', 'source'],
+)
+ERRORS = Counter(
+    'pneumonia_prediction_errors_total', 'Failed predictions by endpoint and error type', ['endpoint', 'type'],
+)
+IN_FLIGHT = Gauge(
+    'pneumonia_in_flight_requests', 'Requests currently being handled', ['endpoint'],
+)
+BATCH_SIZE = Histogram(
+    'pneumonia_batch_size', 'Images per forward pass', buckets=(1, 2, 4, 8, 16, 32, 64, 128),
+)
+MODEL_LOADED = Gauge('pneumonia_model_loaded', '1 once the model is loaded and serving, else 0')
+QUEUE_DEPTH = Gauge('pneumonia_batch_queue_depth', 'Images waiting for the batching scheduler')
+PROCESS_INFO = Gauge('pneumonia_process_info', 'Worker process serving this scrape', ['pid'])
+MODEL_INFO = Gauge('pneumonia_model_info', 'Model version and inference mode being served', ['version', 'mode'])
+MODEL_RELOADS = Counter('pneumonia_model_reloads_total', 'Hot swaps to another model version by result', ['result'])
+
+
+def render():
+    # Replaces the entry inherited from the gunicorn master after a fork
+    PROCESS_INFO.clear()
+    PROCESS_INFO.set(1, pid=os.getpid())
+    return REGISTRY.render()
@@ -0,0 +1,160 @@
+"""
+Deferred model loading and hot swapping.
+
+ModelLoader runs the (slow) torch import and weight loading off the import
+path, so the web server can start listening and answer liveness checks
+straight away. Requests that need the model wait until it is ready.
+
+``swap`` replaces the served runtime with a newly loaded one. Batches that
+hold the old runtime (see ``use``) finish on it, and the old one is only
+released once they have drained.
+"""
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+LOAD_MODES = ('eager', 'background', 'lazy')
+
+
+class ModelNotReady(Exception):
+    """The model is still loading; the request may be retried shortly"""
+
+
+class ModelLoader:
+    """Loads a model with ``load()`` and tracks readiness.
+
+    - eager: load in start(), blocking (use when preloading in a gunicorn master)
+    - background: load in a daemon thread started by start()
+    - lazy: load on the first call to get()
+
+    If the process forks while a background load is in progress, the child
+    loads the model again itself on first use.
+    """
+
+    def __init__(self, load, mode='background'):
+        if mode not in LOAD_MODES:
+            raise ValueError(f"Unknown model load mode: {mode} (expected one of {LOAD_MODES})")
+        self._load_fn = load
+        self.mode = mode
+        self._lock = threading.Lock()
+        self._released = threading.Condition(self._lock)
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._loaded = threading.Event()
+        self.state = 'not_started'
+        self.runtime = None
+        self.error = None
+        self.started_at = None
+        self.load_seconds = None
+        self.swaps = 0
+        self._in_use = {}
+
+    def start(self):
+        if self.mode == 'eager':
+            self._load()
+        elif self.mode == 'background':
+            self._begin()
+            threading.Thread(target=self._load, name='model-loader', daemon=True).start()
+
+    def _begin(self):
+        with self._lock:
+            if self.state != 'not_started':
+                return False
+            self.state = 'loading'
+            self.started_at = time.time()
+            return True
+
+    def _load(self):
+        if self.state == 'not_started' and not self._begin():
+            return
+        try:
+            runtime = self._load_fn()
+        except Exception as e:
+            self.error = f"{type(e).__name__}: {str(e)}"
+            self.state = 'failed'
+            logger.error(f"Model loading failed, but continuing without model: {self.error}")
+        else:
+            self.runtime = runtime
+            self.state = 'ready'
+        finally:
+            self.load_seconds = time.time() - self.started_at
+            self._loaded.set()
+
+    def get(self, timeout=None):
+        """Return the loaded runtime, loading or waiting for it if needed.
+
+        Raises ModelNotReady if it is not ready within ``timeout`` seconds and
+        RuntimeError if loading failed.
+        """
+        if self._pid != os.getpid() and self.state == 'loading':
+            # Forked mid-load: the loading thread only exists in the parent
+            self._reset()
+        if self.state == 'not_started' and self._begin():
+            self._load()
+        if not self._loaded.wait(timeout):
+            raise ModelNotReady("Model is still loading")
+        if self.state == 'failed':
+            raise RuntimeError(f"Model not loaded: {self.error}")
+        return self.runtime
+
+    @contextmanager
+    def use(self, timeout=None):
+        """Context manager giving the current runtime, which a concurrent
+        ``swap`` will not release until the block exits"""
+        self.get(timeout)
+        with self._lock:
+            runtime = self.runtime
+            self._in_use[id(runtime)] = self._in_use.get(id(runtime), 0) + 1
+        try:
+            yield runtime
+        finally:
+            with self._lock:
+                self._in_use[id(runtime)] -= 1
+                if not self._in_use[id(runtime)]:
+                    del self._in_use[id(runtime)]
+                    self._released.notify_all()
+
+    def swap(self, runtime, drain_timeout=None):
+        """Serve ``runtime`` from now on and wait until the previous runtime
+        is no longer in use.
+
+        New batches get the new runtime straight away; returns
+        (previous runtime, whether it drained within ``drain_timeout``).
+        """
+        with self._lock:
+            previous = self.runtime
+            self.runtime = runtime
+            self.state = 'ready'
+            self.error = None
+            self.swaps += 1
+            self._loaded.set()
+            drained = self._released.wait_for(lambda: id(previous) not in self._in_use, drain_timeout)
+        return previous, drained
+
+    @property
+    def ready(self):
+        return self.state == 'ready'
+
+    @property
+    def accepting(self):
+        """Whether requests should be routed here (lazy mode loads on first use)"""
+        if self.mode == 'lazy':
+            return self.state in ('not_started', 'loading', 'ready')
+        return self.state == 'ready'
+
+    def status(self):
+        return {
+            'state': self.state,
+            'load_mode': self.mode,
+            'ready': self.ready,
+            'error': self.error,
+            'load_seconds': round(self.load_seconds, 3) if self.load_seconds is not None else None,
+            'version': getattr(self.runtime, 'version', None),
+            'swaps': self.swaps,
+        }
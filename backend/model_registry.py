@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+"""
+Versioned model registry.
+
+Each registered set of weights is stored, never modified, as
+``<root>/<version>/model.pth`` next to a ``metadata.json`` that records the
+architecture, input size, SHA-256 hash, metrics and training configuration,
+and any artifacts that go with the weights (e.g. ``model.calibration.json``).
+``<root>/CURRENT`` names the version the server should serve. It is replaced
+atomically, so activating a version is a single rename that every worker can
+pick up (see MODEL_WATCH_INTERVAL in main.py).
+
+This module does not import torch. ``build_model`` imports the architecture
+module when a model is actually constructed.
+
+    python model_registry.py list
+    python model_registry.py register pneumonia_detection_model.pth --metrics report.json --activate
+    python model_registry.py activate v3
+    python model_registry.py verify v3
+"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+
+from preprocessing import IMAGE_SIZE
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_ROOT = os.path.join(BASE_DIR, 'models')
+WEIGHTS_FILE = 'model.pth'
+METADATA_FILE = 'metadata.json'
+CURRENT_FILE = 'CURRENT'
+ARCHITECTURES = ('PneumoniaCNN',)
+
+_VERSION_PATTERN = re.compile(r'^v(\d+)$')
+
+logger = logging.getLogger(__name__)
+
+
+class UnknownVersion(KeyError):
+    """No such version in the registry"""
+
+
+def build_model(architecture='PneumoniaCNN', input_size=IMAGE_SIZE):
+    """Construct an untrained model of a registered architecture"""
+    if architecture not in ARCHITECTURES:
+        raise ValueError(f"Unknown architecture: {architecture} (expected one of {ARCHITECTURES})")
+    from pneumonia_model import PneumoniaCNN
+    return PneumoniaCNN(input_size)
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _version_number(name):
+    match = _VERSION_PATTERN.match(name)
+    return int(match.group(1)) if match else None
+
+
+class ModelRegistry:
+    """Registered model versions under ``root`` and the pointer to the active one"""
+
+    def __init__(self, root=DEFAULT_ROOT):
+        self.root = root
+
+    def _path(self, *parts):
+        return os.path.join(self.root, *parts)
+
+    def versions(self):
+        """Metadata of every registered version, oldest first"""
+        if not os.path.isdir(self.root):
+            return []
+        names = [entry.name for entry in os.scandir(self.root)
+                 if entry.is_dir() and _version_number(entry.name) is not None
+                 and os.path.exists(self._path(entry.name, METADATA_FILE))]
+        return [self.get(name) for name in sorted(names, key=_version_number)]
+
+    def get(self, version):
+        """Metadata of ``version``; raises UnknownVersion if it is not registered"""
+        try:
+            with open(self._path(version, METADATA_FILE)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            raise UnknownVersion(version) from None
+
+    def weights_path(self, version):
+        return self._path(version, WEIGHTS_FILE)
+
+    def current(self):
+        """The active version, or None if none has been activated"""
+        try:
+            with open(self._path(CURRENT_FILE)) as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def register(self, weights_path, metrics=None, config=None, input_size=IMAGE_SIZE,
+                 architecture='PneumoniaCNN', source=None, activate=False, artifacts=None):
+        """Copy ``weights_path`` into a new version and return its metadata.
+
+        ``artifacts`` maps file names in the version directory to files copied
+        there along with the weights.
+
+        Weights already in the registry (same hash) are not stored again; the
+        existing version is returned (and activated if requested).
+        """
+        if architecture not in ARCHITECTURES:
+            raise ValueError(f"Unknown architecture: {architecture} (expected one of {ARCHITECTURES})")
+        sha256 = file_sha256(weights_path)
+        for metadata in self.versions():
+            if metadata['sha256'] == sha256:
+                if activate:
+                    self.activate(metadata['version'])
+                return metadata
+
+        os.makedirs(self.root, exist_ok=True)
+        # Built in a temporary directory and renamed into place, so a version
+        # directory is never seen half-written
+        staging = tempfile.mkdtemp(prefix='.staging-', dir=self.root)
+        try:
+            shutil.copyfile(weights_path, os.path.join(staging, WEIGHTS_FILE))
+            for name, path in (artifacts or {}).items():
+                shutil.copyfile(path, os.path.join(staging, name))
+            while True:
+                numbers = [_version_number(name) for name in os.listdir(self.root)]
+                version = f"v{max([n for n in numbers if n is not None], default=0) + 1}"
+                metadata = {
+                    'version': version,
+                    'architecture': architecture,
+                    'input_size': input_size,
+                    'sha256': sha256,
+                    'bytes': os.path.getsize(weights_path),
+                    'created_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+                    'source': source or os.path.abspath(weights_path),
+                    'metrics': metrics or {},
+                    'config': config or {},
+                    'artifacts': sorted(artifacts or {}),
+                }
+                with open(os.path.join(staging, METADATA_FILE), 'w') as f:
+                    json.dump(metadata, f, indent=2)
+                try:
+                    os.rename(staging, self._path(version))
+                    break
+                except OSError:
+                    # Another process registered this version number first
+                    if not os.path.exists(self._path(version)):
+                        raise
+        except BaseException:
+            shutil.rmtree(staging, ignore_errors=True)
+            raise
+        if activate:
+            self.activate(version)
+        return metadata
+
+    def activate(self, version):
+        """Point CURRENT at ``version`` (atomically)"""
+        self.get(version)
+        tmp_path = self._path(f'.{CURRENT_FILE}.tmp')
+        with open(tmp_path, 'w') as f:
+            f.write(version + '\n')
+        os.replace(tmp_path, self._path(CURRENT_FILE))
+
+    def verify(self, version):
+        """Whether the stored weights still match the recorded hash"""
+        return file_sha256(self.weights_path(version)) == self.get(version)['sha256']
+
+
+class RegistryWatcher:
+    """Polls CURRENT every ``interval`` seconds from a daemon thread and calls
+    ``on_change(version)`` when it names a version other than
+    ``served_version()``.
+
+    ``on_change`` returns False to be asked again on the next poll (e.g. while
+    the first model is still loading); a version it fails on is not retried
+    until CURRENT has named another one. The thread is started by ``ensure_started`` and
+    restarted after a fork, like the batching scheduler's worker.
+    """
+
+    def __init__(self, registry, on_change, served_version, interval=10.0):
+        self.registry = registry
+        self.on_change = on_change
+        self.served_version = served_version
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._pid = None
+        self._thread = None
+        self._failed = None
+
+    def ensure_started(self):
+        if self.interval <= 0 or (self._thread is not None and self._pid == os.getpid()):
+            return
+        with self._lock:
+            if self._thread is None or self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name='model-watcher', daemon=True)
+                self._thread.start()
+
+    def check(self):
+        """Compare CURRENT with the served version once, calling on_change if they differ"""
+        version = self.registry.current()
+        if not version or version == self.served_version() or version == self._failed:
+            return
+        try:
+            if self.on_change(version) is False:
+                return
+            self._failed = None
+        except Exception as e:
+            self._failed = version
+            logger.error(f"Could not switch to model {version}: {type(e).__name__}: {str(e)}")
+
+    def _run(self):
+        while True:
+            self.check()
+            time.sleep(self.interval)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--root', default=os.environ.get('MODEL_REGISTRY_DIR') or DEFAULT_ROOT)
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('list', help='list registered versions')
+    register = commands.add_parser('register', help='add a weights file as a new version')
+    register.add_argument('weights')
+    register.add_argument('--metrics', help='JSON file with evaluation metrics to record')
+    register.add_argument('--input-size', type=int, default=IMAGE_SIZE)
+    register.add_argument('--activate', action='store_true', help='make it the served version')
+    activate = commands.add_parser('activate', help='serve this version')
+    activate.add_argument('version')
+    verify = commands.add_parser('verify', help='check a version against its recorded hash')
+    verify.add_argument('version')
+    args = parser.parse_args()
+
+    registry = ModelRegistry(args.root)
+    if args.command == 'list':
+        current = registry.current()
+        for metadata in registry.versions():
+            f1 = metadata['metrics'].get('f1')
+            print(f"{'*' if metadata['version'] == current else ' '} {metadata['version']:6s} "
+                  f"{metadata['created_at']}  {metadata['sha256'][:12]}  {metadata['input_size']}px  "
+                  f"f1={f1 if f1 is not None else '-'}")
+    elif args.command == 'register':
+        metrics = None
+        if args.metrics:
+            with open(args.metrics) as f:
+                metrics = json.load(f)
+        # A calibration fitted for these weights travels with them
+        from calibration import calibration_path
+        calibration = calibration_path(args.weights)
+        artifacts = {os.path.basename(calibration_path(WEIGHTS_FILE)): calibration} \
+            if os.path.exists(calibration) else None
+        metadata = registry.register(args.weights, metrics=metrics, input_size=args.input_size,
+                                     activate=args.activate, artifacts=artifacts)
+        print(f"Registered {metadata['version']} ({metadata['sha256'][:12]})"
+              f"{', now active' if args.activate else ''}")
+    elif args.command == 'activate':
+        registry.activate(args.version)
+        print(f"Active version: {args.version}")
+    elif args.command == 'verify':
+        ok = registry.verify(args.version)
+        print(f"{args.version}: {'ok' if ok else 'HASH MISMATCH'}")
+        raise SystemExit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
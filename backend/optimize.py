@@ -0,0 +1,157 @@
+"""
+CPU inference optimizations for PneumoniaCNN.
+
+``optimize_for_inference`` turns an eval-mode model into a frozen TorchScript
+graph with Dropout removed, BatchNorm folded into the neighbouring layers and
+channels-last memory format. ``check_parity`` compares it with the eager model.
+
+In PneumoniaCNN every BatchNorm follows a ReLU, so it cannot be merged into
+the previous convolution the usual way. With per-channel scale s > 0 and
+shift t, ``BN(ReLU(conv(x))) = ReLU(s * conv(x)) + t``, so the scale is folded
+into the convolution weights. The shift commutes with the following
+MaxPool and is added after pooling, on a quarter of the elements. The last
+shift feeds straight into the first Linear layer and is folded into its
+bias. BatchNorms with a non-positive scale are left untouched.
+
+Models quantized by quantize_model.py are stored as TorchScript with their
+quantization settings attached; ``load_quantized`` restores them.
+"""
+import copy
+import json
+
+import torch
+import torch.nn as nn
+
+
+class ChannelShift(nn.Module):
+    """Adds a per-channel constant to an NCHW tensor"""
+
+    def __init__(self, shift):
+        super().__init__()
+        self.register_buffer('shift', shift.detach().clone().view(1, -1, 1, 1))
+
+    def forward(self, x):
+        return x + self.shift
+
+
+class FoldedCNN(nn.Module):
+    """PneumoniaCNN layout after folding; flattens in NCHW order so the
+    classifier weights stay valid when features run in channels-last format"""
+
+    def __init__(self, features, classifier):
+        super().__init__()
+        self.features = features
+        self.classifier = classifier
+
+    def forward(self, x):
+        x = self.features(x)
+        x = x.contiguous().flatten(1)
+        return self.classifier(x)
+
+
+def _bn_scale_shift(bn):
+    scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+    shift = bn.bias - bn.running_mean * scale
+    return scale.detach(), shift.detach()
+
+
+@torch.no_grad()
+def fold_batchnorm(model):
+    """Return an eval-mode copy of ``model`` with Dropout removed and BatchNorm folded"""
+    model = copy.deepcopy(model).eval()
+    layers = list(model.features)
+    folded = []
+    pending_shift = None
+    last_conv = None
+    for layer in layers:
+        if isinstance(layer, nn.Dropout):
+            continue
+        if isinstance(layer, nn.Conv2d):
+            last_conv = layer
+        if isinstance(layer, nn.BatchNorm2d):
+            scale, shift = _bn_scale_shift(layer)
+            if last_conv is not None and bool((scale > 0).all()):
+                last_conv.weight.mul_(scale.view(-1, 1, 1, 1))
+                last_conv.bias.mul_(scale)
+                pending_shift = shift
+                continue
+        folded.append(layer)
+        if isinstance(layer, nn.MaxPool2d) and pending_shift is not None:
+            folded.append(ChannelShift(pending_shift))
+            pending_shift = None
+
+    classifier = [layer for layer in model.classifier if not isinstance(layer, nn.Dropout)]
+    if folded and isinstance(folded[-1], ChannelShift) and isinstance(classifier[0], nn.Linear):
+        # flatten(pool + t) @ W.T = flatten(pool) @ W.T + W @ flatten(t)
+        shift = folded.pop().shift
+        linear = classifier[0]
+        spatial = linear.in_features // shift.numel()
+        linear.bias.add_(linear.weight @ shift.view(-1).repeat_interleave(spatial))
+
+    return FoldedCNN(nn.Sequential(*folded), nn.Sequential(*classifier)).eval()
+
+
+def optimize_for_inference(model, image_size=150, threads=None):
+    """Fold, convert to channels-last, trace and freeze ``model`` for CPU inference"""
+    if threads:
+        torch.set_num_threads(threads)
+    folded = fold_batchnorm(model).to(memory_format=torch.channels_last)
+    example = torch.rand(1, 3, image_size, image_size).contiguous(memory_format=torch.channels_last)
+    with torch.no_grad():
+        traced = torch.jit.trace(folded, example)
+        frozen = torch.jit.freeze(traced)
+    return ChannelsLastWrapper(frozen)
+
+
+class ChannelsLastWrapper(nn.Module):
+    """Feeds channels-last inputs to a frozen TorchScript module"""
+
+    def __init__(self, module):
+        super().__init__()
+        self.module = module
+        self.eval()
+
+    def forward(self, x):
+        return self.module(x.contiguous(memory_format=torch.channels_last))
+
+
+@torch.no_grad()
+def smooth_images(batch_size, image_size=150, generator=None):
+    """Smooth random (B, 3, S, S) images at several brightness levels, for
+    parity checks: uniform noise drives this model's outputs to ~0, where any
+    difference is invisible"""
+    coarse = torch.rand(batch_size, 1, 10, 10, generator=generator)
+    brightness = torch.linspace(0.3, 1.0, batch_size).view(-1, 1, 1, 1)
+    inputs = nn.functional.interpolate(coarse, size=image_size, mode='bilinear', align_corners=False)
+    return (inputs * brightness).expand(-1, 3, -1, -1)
+
+
+def check_parity(reference, optimized, image_size=150, batch_sizes=(1, 8)):
+    """Max abs difference between the two models' sigmoid outputs on smooth_images"""
+    generator = torch.Generator().manual_seed(0)
+    worst = 0.0
+    for batch_size in batch_sizes:
+        inputs = smooth_images(batch_size, image_size, generator)
+        diff = (reference(inputs) - optimized(inputs)).abs().max().item()
+        worst = max(worst, diff)
+    return worst
+
+
+def save_quantized(model, path, engine, image_size=150, metadata=None):
+    """Save a quantized TorchScript model with the engine it was calibrated for"""
+    info = dict(metadata or {}, engine=engine, image_size=image_size)
+    torch.jit.save(model, path, _extra_files={'quantization.json': json.dumps(info)})
+
+
+def load_quantized(path, device='cpu'):
+    """Load a model saved by save_quantized, selecting the engine it was built for"""
+    extra_files = {'quantization.json': ''}
+    model = torch.jit.load(path, map_location=device, _extra_files=extra_files)
+    info = json.loads(extra_files['quantization.json'] or '{}')
+    engine = info.get('engine')
+    if engine:
+        if engine not in torch.backends.quantized.supported_engines:
+            raise RuntimeError(f"Quantized engine '{engine}' is not supported on this machine")
+        torch.backends.quantized.engine = engine
+    model.eval()
+    return model, info
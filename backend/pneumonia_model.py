@@ -0,0 +1,57 @@
+"""
+PneumoniaCNN model architecture shared by the server and the model tooling.
+"""
+import torch.nn as nn
+
+
+# Define the model architecture (improved version)
+class PneumoniaCNN(nn.Module):
+    def __init__(self, image_size=150):
+        super(PneumoniaCNN, self).__init__()
+        self.features = nn.Sequential(
+            nn.Conv2d(3, 32, kernel_size=3, padding=1),
+            nn.ReLU(),
+            nn.BatchNorm2d(32),
+            nn.MaxPool2d(2, 2),
+
+            nn.Conv2d(32, 64, kernel_size=3, padding=1),
+            nn.ReLU(),
+            nn.Dropout(0.1),
+            nn.BatchNorm2d(64),
+            nn.MaxPool2d(2, 2),
+
+            nn.Conv2d(64, 64, kernel_size=3, padding=1),
+            nn.ReLU(),
+            nn.BatchNorm2d(64),
+            nn.MaxPool2d(2, 2),
+
+            nn.Conv2d(64, 128, kernel_size=3, padding=1),
+            nn.ReLU(),
+            nn.Dropout(0.2),
+            nn.BatchNorm2d(128),
+            nn.MaxPool2d(2, 2),
+
+            nn.Conv2d(128, 256, kernel_size=3, padding=1),
+            nn.ReLU(),
+            nn.Dropout(0.2),
+            nn.BatchNorm2d(256),
+            nn.MaxPool2d(2, 2),
+        )
+        # Calculate the correct input size for the linear layer
+        # 150x150 -> 75x75 -> 37x37 -> 18x18 -> 9x9 -> 4x4
+        # So the final feature map is 256 * 4 * 4 = 4096
+        feature_size = image_size
+        for _ in range(5):
+            feature_size //= 2
+        self.classifier = nn.Sequential(
+            nn.Linear(256 * feature_size * feature_size, 128),
+            nn.ReLU(),
+            nn.Dropout(0.2),
+            nn.Linear(128, 1),
+            nn.Sigmoid()
+        )
+
+    def forward(self, x):
+        x = self.features(x)
+        x = x.view(x.size(0), -1)
+        return self.classifier(x)
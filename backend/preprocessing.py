@@ -0,0 +1,393 @@
+"""
+Tensor-native image preprocessing for inference.
+
+Uploads are decoded straight into small uint8 arrays and converted to float
+tensors for a whole batch at once. Grayscale X-rays stay single-channel
+through decode and resize; the three identical channels the model expects
+are only materialised in the final batch tensor.
+
+The output matches the reference torchvision pipeline
+(``Image.open(...).convert('RGB')`` -> ``Resize((150, 150))`` -> ``ToTensor()``):
+exactly with the default PIL resize backend, and within
+``TORCH_BACKEND_TOLERANCE`` with the torch resize backend.
+``python preprocessing.py [images...]`` checks parity for both backends, with
+and without ``draft`` (within ``DRAFT_TOLERANCE``; the server decodes with
+``draft`` by default), and exits non-zero on a mismatch. The deploy build
+runs it.
+
+Large uploads:
+- With ``draft=True``, JPEGs at least twice ``DRAFT_OVERSAMPLE`` x the
+  target size are decoded at 1/2, 1/4 or 1/8 scale in the DCT domain (PIL's
+  draft mode), keeping at least ``DRAFT_OVERSAMPLE`` x the target before
+  the usual antialiased resize. A 3000 x 3000 X-ray is decoded as
+  375 x 375, so the output differs slightly from the reference pipeline.
+  Other formats are decoded in full, then box-reduced by an integer factor
+  before the resize (PIL's ``reducing_gap``).
+- DICOM files are read with pydicom (optional; imported only for DICOM
+  uploads). Their pixel data is box-reduced as integers, then rescaled and
+  windowed to uint8 in numpy. There is no round trip through an image
+  format.
+- ``max_pixels`` is checked against the header before any pixel data is
+  decoded.
+
+``python preprocessing.py --benchmark`` compares full and reduced decoding
+of large synthetic images: latency, and peak RSS measured in a fresh
+process for each case.
+
+torch is imported on first use, so decoding does not pull it into a process
+that has not loaded the model yet.
+"""
+import argparse
+import io
+import statistics
+import sys
+import time
+import warnings
+from collections.abc import Sequence
+
+import numpy as np
+from PIL import Image
+
+IMAGE_SIZE = 150
+
+# Modes that are resized natively; anything else (palette, RGBA, 16-bit, ...)
+# goes through convert('RGB') exactly like the reference pipeline
+NATIVE_MODES = ('L', 'RGB')
+
+# Max abs difference from the reference pipeline, in [0, 1] units.
+# PIL backend: identical. Torch backend: at most one uint8 step after rounding.
+PIL_BACKEND_TOLERANCE = 0.0
+TORCH_BACKEND_TOLERANCE = 1.0 / 255 + 1e-6
+# Either backend with draft=True, on X-ray-like images: at most two uint8 steps
+DRAFT_TOLERANCE = 2.0 / 255 + 1e-6
+
+# Reduced decoding keeps at least this many times the target size, so the
+# final resize still antialiases
+DRAFT_OVERSAMPLE = 2
+
+
+class ImageTooLarge(ValueError):
+    """An upload is over the byte or pixel limit"""
+
+
+def check_pixels(width, height, max_pixels):
+    if max_pixels and width * height > max_pixels:
+        raise ImageTooLarge(f"Image is {width}x{height} pixels, the limit is {max_pixels}")
+
+
+def is_dicom(image_bytes):
+    """DICOM Part 10 files have a 128-byte preamble followed by 'DICM'"""
+    return image_bytes[128:132] == b'DICM'
+
+
+def _open_native(image_bytes, size=IMAGE_SIZE, draft=False, max_pixels=None):
+    # Opening only parses the header; pixels are decoded on first access
+    image = Image.open(io.BytesIO(image_bytes))
+    check_pixels(image.width, image.height, max_pixels)
+    if draft and image.format == 'JPEG' and image.mode in NATIVE_MODES:
+        # Scale is picked so both sides stay >= the requested size; smaller images are left alone
+        image.draft(image.mode, (size * DRAFT_OVERSAMPLE, size * DRAFT_OVERSAMPLE))
+    if image.mode not in NATIVE_MODES:
+        image = image.convert('RGB')
+    return image
+
+
+def _first(value):
+    """The first of a multi-valued DICOM element (alternative windows), or the value itself"""
+    return float(value[0]) if isinstance(value, Sequence) and not isinstance(value, str) else float(value)
+
+
+def _window(values, dataset):
+    """Rescale stored values to modality units and window them to [0, 255]"""
+    slope = float(getattr(dataset, 'RescaleSlope', 1) or 1)
+    intercept = float(getattr(dataset, 'RescaleIntercept', 0) or 0)
+    values = values * slope + intercept
+    center = getattr(dataset, 'WindowCenter', None)
+    width = getattr(dataset, 'WindowWidth', None)
+    if center is not None and width is not None:
+        center, width = _first(center), _first(width)
+        low, high = center - width / 2, center + width / 2
+    else:
+        low, high = float(values.min()), float(values.max())
+    scaled = (values - low) * (255.0 / max(high - low, 1e-6))
+    if getattr(dataset, 'PhotometricInterpretation', '') == 'MONOCHROME1':
+        # MONOCHROME1 stores inverted grayscale (low values are white)
+        scaled = 255.0 - scaled
+    return np.clip(scaled, 0, 255).round().astype(np.uint8)
+
+
+def _open_dicom(image_bytes, size=IMAGE_SIZE, draft=False, max_pixels=None):
+    try:
+        import pydicom
+    except ImportError:
+        raise ValueError("DICOM uploads need pydicom (pip install pydicom)") from None
+    dataset = pydicom.dcmread(io.BytesIO(image_bytes))
+    check_pixels(int(dataset.Columns), int(dataset.Rows), max_pixels)
+    pixels = dataset.pixel_array
+    if int(getattr(dataset, 'NumberOfFrames', 1) or 1) > 1:
+        pixels = pixels[0]
+    if pixels.ndim == 3:
+        # Colour (pydicom converts YBR to RGB); stored as 8 bits in practice
+        return Image.fromarray(pixels.astype(np.uint8), 'RGB')
+    factor = min(pixels.shape) // (size * DRAFT_OVERSAMPLE) if draft else 1
+    if factor > 1:
+        # Box-reduce before windowing; rescaling is linear, so only the clipping sees averaged values
+        height, width = pixels.shape[0] // factor * factor, pixels.shape[1] // factor * factor
+        pixels = pixels[:height, :width].reshape(height // factor, factor, width // factor, factor) \
+            .mean(axis=(1, 3), dtype=np.float32)
+    return Image.fromarray(_window(pixels.astype(np.float32, copy=False), dataset), 'L')
+
+
+def decode_image(image_bytes, size=IMAGE_SIZE, backend='pil', draft=False, max_pixels=None):
+    """Decode and resize an upload (any PIL format, or DICOM) into a uint8
+    array of shape (H, W) or (H, W, 3)"""
+    if is_dicom(image_bytes):
+        image = _open_dicom(image_bytes, size, draft=draft, max_pixels=max_pixels)
+    else:
+        image = _open_native(image_bytes, size, draft=draft, max_pixels=max_pixels)
+    if backend == 'pil':
+        # Same bilinear (antialiased) filter torchvision's Resize uses for PIL images. With draft,
+        # formats that cannot be decoded at reduced scale (PNG, ...) are first box-reduced by
+        # an integer factor down to DRAFT_OVERSAMPLE x the target
+        return np.asarray(image.resize((size, size), Image.BILINEAR,
+                                       reducing_gap=DRAFT_OVERSAMPLE if draft else None))
+    if backend == 'torch':
+        return resize_array(np.asarray(image), size)
+    raise ValueError(f"Unknown preprocessing backend: {backend}")
+
+
+def resize_array(array, size=IMAGE_SIZE):
+    """Antialiased bilinear resize of a uint8 (H, W[, C]) array with a torch kernel"""
+    import torch
+    import torch.nn.functional as F
+
+    with warnings.catch_warnings():
+        # Arrays from PIL are read-only; the tensor is only read from here
+        warnings.simplefilter('ignore', UserWarning)
+        tensor = torch.from_numpy(np.ascontiguousarray(array))
+    tensor = tensor.unsqueeze(-1) if tensor.ndim == 2 else tensor
+    tensor = tensor.permute(2, 0, 1).unsqueeze(0).float()
+    resized = F.interpolate(tensor, size=(size, size), mode='bilinear', antialias=True, align_corners=False)
+    resized = resized.round_().clamp_(0, 255).to(torch.uint8)[0].permute(1, 2, 0)
+    return resized[..., 0].numpy() if array.ndim == 2 else resized.numpy()
+
+
+def to_batch(arrays, size=IMAGE_SIZE):
+    """Stack decoded uint8 arrays into a float (N, 3, size, size) tensor in [0, 1].
+
+    Single-channel arrays are broadcast into the three channels here, and
+    the uint8 -> float conversion runs once over the whole batch.
+    """
+    import torch
+
+    batch = np.empty((len(arrays), 3, size, size), dtype=np.uint8)
+    for i, array in enumerate(arrays):
+        batch[i] = array if array.ndim == 2 else array.transpose(2, 0, 1)
+    return torch.from_numpy(batch).float().div_(255)
+
+
+def check_parity(images, backend='pil', tolerance=PIL_BACKEND_TOLERANCE, draft=False):
+    """Compare ``(name, bytes)`` images against the torchvision reference
+    pipeline; raises AssertionError if any differs by more than ``tolerance``.
+    Returns the max abs difference."""
+    import torchvision.transforms as transforms
+
+    reference = transforms.Compose([
+        transforms.Resize((IMAGE_SIZE, IMAGE_SIZE)),
+        transforms.ToTensor(),
+    ])
+    worst = 0.0
+    failures = []
+    for name, image_bytes in images:
+        expected = reference(Image.open(io.BytesIO(image_bytes)).convert('RGB'))
+        actual = to_batch([decode_image(image_bytes, backend=backend, draft=draft)])[0]
+        diff = (expected - actual).abs().max().item()
+        print(f"{backend:5s} {'draft' if draft else 'full':5s} {name:32s} max abs diff {diff:.8f}")
+        worst = max(worst, diff)
+        if diff > tolerance:
+            failures.append(f"{name} ({diff:.8f})")
+    # Raised explicitly so the check still runs under python -O
+    if failures:
+        raise AssertionError(f"{backend}{' draft' if draft else ''} preprocessing differs from the reference pipeline by more than "
+                             f"{tolerance:.8f} for: {', '.join(failures)}")
+    return worst
+
+
+def _synthetic_images():
+    rng = np.random.default_rng(0)
+    gray = rng.integers(0, 256, (480, 400), dtype=np.uint8)
+    samples = {
+        'gray.png': Image.fromarray(gray),
+        'gray.jpg': Image.fromarray(gray),
+        'rgb.png': Image.fromarray(rng.integers(0, 256, (300, 320, 3), dtype=np.uint8)),
+        'rgba.png': Image.fromarray(rng.integers(0, 256, (200, 260, 4), dtype=np.uint8)),
+        'palette.png': Image.fromarray(gray).convert('P'),
+        'gray16.png': Image.fromarray(gray.astype(np.uint16) * 256),
+        'small.png': Image.fromarray(gray[:90, :70]),
+    }
+    for name, image in samples.items():
+        buffer = io.BytesIO()
+        image.save(buffer, format='JPEG' if name.endswith('.jpg') else 'PNG')
+        yield name, buffer.getvalue()
+
+
+def _large_synthetic_images(sides=(600, 1024, 2048)):
+    """X-ray-like JPEGs and PNGs large enough for draft decoding to reduce them"""
+    rng = np.random.default_rng(0)
+    for side in sides:
+        gray = Image.fromarray((_xray_like(side, rng) * 255).round().astype(np.uint8))
+        for fmt, extension in (('JPEG', 'jpg'), ('PNG', 'png')):
+            buffer = io.BytesIO()
+            gray.save(buffer, format=fmt, quality=90)
+            yield f"xray{side}.{extension}", buffer.getvalue()
+
+
+def _xray_like(side, rng):
+    """A smooth synthetic chest-X-ray-like image (vignette, two lung fields, noise) in [0, 1]"""
+    y, x = np.mgrid[0:side, 0:side].astype(np.float32) / side
+    body = np.exp(-((x - 0.5) ** 2 / 0.18 + (y - 0.55) ** 2 / 0.25))
+    lungs = sum(np.exp(-((x - cx) ** 2 / 0.012 + (y - 0.5) ** 2 / 0.05)) for cx in (0.33, 0.67))
+    image = 0.15 + 0.7 * body - 0.35 * lungs + rng.normal(0, 0.02, (side, side)).astype(np.float32)
+    return np.clip(image, 0, 1)
+
+
+def _write_large_samples(directory, sides):
+    """Write JPEG, PNG and (with pydicom) 12-bit DICOM versions of each size; return their paths"""
+    import os
+
+    rng = np.random.default_rng(0)
+    paths = []
+    for side in sides:
+        image = _xray_like(side, rng)
+        gray = Image.fromarray((image * 255).round().astype(np.uint8))
+        for fmt, extension in (('JPEG', 'jpg'), ('PNG', 'png')):
+            path = os.path.join(directory, f"{side}.{extension}")
+            gray.save(path, format=fmt, quality=90)
+            paths.append(path)
+        try:
+            path = os.path.join(directory, f"{side}.dcm")
+            _write_dicom(path, (image * 4095).round().astype(np.uint16))
+            paths.append(path)
+        except ImportError:
+            pass
+    return paths
+
+
+def _write_dicom(path, pixels):
+    import pydicom
+    from pydicom.dataset import FileMetaDataset
+    from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+
+    meta = FileMetaDataset()
+    meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.1.1'  # Digital X-Ray Image Storage
+    meta.MediaStorageSOPInstanceUID = generate_uid()
+    meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    dataset = pydicom.Dataset()
+    dataset.file_meta = meta
+    dataset.SOPClassUID = meta.MediaStorageSOPClassUID
+    dataset.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+    dataset.Modality = 'DX'
+    dataset.Rows, dataset.Columns = pixels.shape
+    dataset.SamplesPerPixel = 1
+    dataset.PhotometricInterpretation = 'MONOCHROME2'
+    dataset.BitsAllocated, dataset.BitsStored, dataset.HighBit = 16, 12, 11
+    dataset.PixelRepresentation = 0
+    dataset.WindowCenter, dataset.WindowWidth = 2048, 4096
+    dataset.PixelData = pixels.tobytes()
+    dataset.save_as(path, enforce_file_format=True)
+
+
+def _peak_rss_kb():
+    """VmHWM (peak RSS) of this process. Unlike ru_maxrss it starts afresh at
+    exec instead of inheriting the parent's peak. Linux only."""
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1])
+    return 0
+
+
+def _measure(path, draft, repeats):
+    """Run in a fresh process: median decode latency and the peak RSS it adds"""
+    import json
+
+    with open(path, 'rb') as f:
+        image_bytes = f.read()
+    if is_dicom(image_bytes):
+        # Imported before the baseline; decoding once to warm up would raise the peak
+        import pydicom  # noqa: F401
+    baseline = _peak_rss_kb()
+    times = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        decode_image(image_bytes, draft=draft)
+        times.append((time.perf_counter() - started) * 1000)
+    peak = _peak_rss_kb()
+    print(json.dumps({'ms': statistics.median(times), 'peak_mb': (peak - baseline) / 1024}))
+
+
+def benchmark(sides, repeats):
+    """Full vs reduced decoding of large synthetic uploads"""
+    import json
+    import os
+    import subprocess
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as directory:
+        paths = _write_large_samples(directory, sides)
+        print(f"{'image':>10} {'MB':>5} {'full ms':>8} {'reduced ms':>10} {'speedup':>7} "
+              f"{'full +RSS MB':>12} {'reduced +RSS MB':>15} {'mean |diff|':>11}")
+        for path in paths:
+            results = []
+            for draft in (False, True):
+                output = subprocess.run(
+                    [sys.executable, os.path.abspath(__file__), '--measure', path, '--repeats', str(repeats)]
+                    + (['--draft'] if draft else []),
+                    check=True, capture_output=True, text=True).stdout
+                results.append(json.loads(output.strip().splitlines()[-1]))
+            with open(path, 'rb') as f:
+                image_bytes = f.read()
+            # Difference of the final 150 x 150 uint8 arrays, in uint8 steps
+            diff = np.abs(decode_image(image_bytes).astype(np.int16)
+                          - decode_image(image_bytes, draft=True).astype(np.int16)).mean()
+            full, reduced = results
+            print(f"{os.path.basename(path):>10} {len(image_bytes) / 2 ** 20:>5.1f} {full['ms']:>8.1f} "
+                  f"{reduced['ms']:>10.1f} {full['ms'] / reduced['ms']:>6.1f}x {full['peak_mb']:>12.1f} "
+                  f"{reduced['peak_mb']:>15.1f} {diff:>11.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('images', nargs='*', help='extra images to include in the parity check')
+    parser.add_argument('--benchmark', action='store_true', help='compare full and reduced decoding of large images')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1024, 2048, 3072, 4096],
+                        help='benchmark image sides in pixels')
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--measure', help=argparse.SUPPRESS)
+    parser.add_argument('--draft', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        _measure(args.measure, args.draft, args.repeats)
+        return
+    if args.benchmark:
+        benchmark(args.sizes, args.repeats)
+        return
+
+    images = list(_synthetic_images()) + list(_large_synthetic_images())
+    for path in args.images:
+        with open(path, 'rb') as f:
+            images.append((path, f.read()))
+    failed = False
+    for backend, draft, tolerance in (('pil', False, PIL_BACKEND_TOLERANCE), ('torch', False, TORCH_BACKEND_TOLERANCE),
+                                      ('pil', True, DRAFT_TOLERANCE), ('torch', True, DRAFT_TOLERANCE)):
+        try:
+            worst = check_parity(images, backend=backend, tolerance=tolerance, draft=draft)
+            print(f"{backend}{' draft' if draft else ''}: worst {worst:.8f}, tolerance {tolerance:.8f} -> OK")
+        except AssertionError as e:
+            print(f"FAIL: {e}")
+            failed = True
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
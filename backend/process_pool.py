@@ -0,0 +1,62 @@
+"""
+Helpers shared by the multi-process command-line tools (sweep.py, score.py):
+atomic JSON state files, and pools of spawned worker processes that are each
+pinned to their own cores.
+
+Workers are spawned, not forked, so each one starts its own torch thread
+pools. torch is imported only inside the workers.
+"""
+import json
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+
+def write_json(obj, path):
+    """Write ``obj`` to ``path`` atomically (write then rename)"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(obj, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def read_json(path):
+    """The JSON in ``path``, or None if it is missing or unreadable"""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def available_cores():
+    """The cores this process may run on"""
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def _init_worker(core_sets, threads, initializer, initargs):
+    """Pin this worker process to its own cores and intra-op thread count"""
+    import torch
+
+    cores = core_sets.get()
+    if cores and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(threads)
+    torch.set_num_interop_threads(1)
+    if initializer is not None:
+        initializer(*initargs)
+
+
+def pinned_pool(workers, threads, cores=None, initializer=None, initargs=()):
+    """A ProcessPoolExecutor of ``workers`` spawned processes, each pinned to
+    ``threads`` cores of ``cores`` (default: all available) and then running
+    ``initializer(*initargs)``"""
+    cores = available_cores() if cores is None else cores
+    context = multiprocessing.get_context('spawn')
+    core_sets = context.Queue()
+    for worker in range(workers):
+        core_sets.put(cores[worker * threads:(worker + 1) * threads])
+    return ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_init_worker,
+                               initargs=(core_sets, threads, initializer, initargs))
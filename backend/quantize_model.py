@@ -0,0 +1,171 @@
+"""
+Post-training INT8 quantization of PneumoniaCNN.
+
+Calibrates on the validation split, writes pneumonia_detection_model_int8.pt
+(loaded by the server with MODEL_MODE=quantized) and a report comparing
+accuracy, precision, recall, F1, size and latency with the float model on the
+test split.
+"""
+import io
+import json
+import os
+import time
+
+import kagglehub
+import torch
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+from torch.utils.data import DataLoader
+from torchvision import datasets, transforms
+
+from optimize import fold_batchnorm, save_quantized
+from pneumonia_model import PneumoniaCNN
+from train_metrics import BinaryMetrics
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+FLOAT_MODEL_PATH = os.path.join(BASE_DIR, "pneumonia_detection_model.pth")
+QUANTIZED_MODEL_PATH = os.path.join(BASE_DIR, "pneumonia_detection_model_int8.pt")
+REPORT_PATH = os.path.join(BASE_DIR, "quantization_report.json")
+IMAGE_SIZE = 150
+
+
+def default_engine():
+    """Pick the best quantized kernel backend available on this machine"""
+    engines = torch.backends.quantized.supported_engines
+    for engine in ('x86', 'fbgemm', 'qnnpack'):
+        if engine in engines:
+            return engine
+    raise RuntimeError(f"No quantized engine available (supported: {engines})")
+
+
+def quantize_static(model, calibration_loader, engine):
+    """Post-training static INT8 quantization, calibrated on calibration_loader.
+
+    BatchNorm is folded and Dropout removed first (see optimize.py), so fewer
+    ops run in INT8 and the folded layers are calibrated as a whole.
+    """
+    torch.backends.quantized.engine = engine
+    model = fold_batchnorm(model.cpu().eval())
+    example_inputs = (torch.rand(1, 3, IMAGE_SIZE, IMAGE_SIZE),)
+    prepared = prepare_fx(model, get_default_qconfig_mapping(engine), example_inputs)
+    with torch.no_grad():
+        for images, _ in calibration_loader:
+            prepared(images)
+    quantized = convert_fx(prepared)
+    with torch.no_grad():
+        return torch.jit.freeze(torch.jit.trace(quantized, example_inputs))
+
+
+def evaluate(model, loader):
+    """Accuracy, precision, recall and F1 (positive class = pneumonia)"""
+    metrics = BinaryMetrics('cpu')
+    with torch.no_grad():
+        for images, labels in loader:
+            metrics.update(model(images), labels)
+    result = metrics.compute()
+    return {
+        'accuracy': result['accuracy'] / 100,
+        'precision': result['precision'],
+        'recall': result['recall'],
+        'f1': result['f1'],
+        'samples': result['total'],
+    }
+
+
+def measure_latency(model, batch_size, repeats=20, warmup=3):
+    """Mean forward-pass latency in milliseconds for one batch"""
+    inputs = torch.rand(batch_size, 3, IMAGE_SIZE, IMAGE_SIZE)
+    with torch.no_grad():
+        for _ in range(warmup):
+            model(inputs)
+        started = time.perf_counter()
+        for _ in range(repeats):
+            model(inputs)
+    return (time.perf_counter() - started) / repeats * 1000
+
+
+def state_bytes(model):
+    """Bytes held by parameters and buffers (packed weights for quantized models)"""
+    if isinstance(model, torch.jit.ScriptModule):
+        # Quantized convolutions keep their weights in packed params, which
+        # are not parameters; measure the serialized size instead
+        buffer = io.BytesIO()
+        torch.jit.save(model, buffer)
+        return buffer.tell()
+    tensors = list(model.parameters()) + list(model.buffers())
+    return sum(t.numel() * t.element_size() for t in tensors)
+
+
+def main():
+    print("Starting INT8 quantization...")
+
+    print("Downloading dataset...")
+    path = kagglehub.dataset_download("paultimothymooney/chest-xray-pneumonia")
+    print(f"Dataset downloaded to: {path}")
+
+    val_folder = os.path.join(path, 'chest_xray/val/')
+    test_folder = os.path.join(path, 'chest_xray/test/')
+    batch_size = 32
+
+    # Same preprocessing as validation/test in train_model.py
+    val_test_transforms = transforms.Compose([
+        transforms.Resize((IMAGE_SIZE, IMAGE_SIZE)),
+        transforms.ToTensor(),
+    ])
+    val_dataset = datasets.ImageFolder(val_folder, transform=val_test_transforms)
+    test_dataset = datasets.ImageFolder(test_folder, transform=val_test_transforms)
+    print(f"Class mapping: {val_dataset.class_to_idx}")
+
+    val_loader = DataLoader(val_dataset, batch_size=batch_size, shuffle=False, num_workers=0)
+    test_loader = DataLoader(test_dataset, batch_size=batch_size, shuffle=False, num_workers=0)
+
+    print(f"Loading float model from: {FLOAT_MODEL_PATH}")
+    float_model = PneumoniaCNN()
+    float_model.load_state_dict(torch.load(FLOAT_MODEL_PATH, map_location='cpu'))
+    float_model.eval()
+
+    engine = default_engine()
+    print(f"Quantizing with engine '{engine}', calibrating on {len(val_dataset)} validation images...")
+    quantized_model = quantize_static(float_model, val_loader, engine)
+
+    print("Evaluating float and INT8 models on the test split...")
+    float_metrics = evaluate(float_model, test_loader)
+    int8_metrics = evaluate(quantized_model, test_loader)
+
+    save_quantized(quantized_model, QUANTIZED_MODEL_PATH, engine, IMAGE_SIZE, metadata={
+        'source': os.path.basename(FLOAT_MODEL_PATH),
+        'test_metrics': int8_metrics,
+    })
+    print(f"Quantized model saved to: {QUANTIZED_MODEL_PATH}")
+
+    report = {
+        'engine': engine,
+        'calibration_images': len(val_dataset),
+        'float': dict(float_metrics,
+                      file_bytes=os.path.getsize(FLOAT_MODEL_PATH),
+                      state_bytes=state_bytes(float_model)),
+        'int8': dict(int8_metrics,
+                     file_bytes=os.path.getsize(QUANTIZED_MODEL_PATH),
+                     state_bytes=state_bytes(quantized_model)),
+        'latency_ms': {},
+    }
+    for name, model in (('float', float_model), ('int8', quantized_model)):
+        report['latency_ms'][name] = {
+            f'batch_{n}': round(measure_latency(model, n), 3) for n in (1, 16)
+        }
+
+    for name in ('float', 'int8'):
+        m = report[name]
+        print(f"{name:5s} Acc: {m['accuracy'] * 100:.2f}%  Precision: {m['precision']:.3f}  "
+              f"Recall: {m['recall']:.3f}  F1: {m['f1']:.3f}  "
+              f"Size: {m['file_bytes'] / 1e6:.2f} MB  "
+              f"Latency: {report['latency_ms'][name]['batch_1']:.2f} ms (batch 1)")
+
+    with open(REPORT_PATH, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Report written to: {REPORT_PATH}")
+    print("Quantization complete!")
+
+
+if __name__ == '__main__':
+    main()
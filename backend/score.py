@@ -0,0 +1,371 @@
+#!/usr/bin/env python3
+"""
+Offline bulk scoring of archived X-rays.
+
+Scores every image under one or more directories (walked recursively) and/or
+listed in ``--file-list`` files, without going through the HTTP server. It
+uses the same decoding (preprocessing.decode_image, pixel-identical to the
+training ``transform``; large JPEGs and DICOMs are decoded at reduced scale
+as in the server unless ``--no-draft``), the same PneumoniaCNN weights
+(inference.load_runtime, including optimized/quantized modes and
+calibration) and the same batched forward pass.
+
+The sorted image list is split into chunks of ``--chunk-size`` images. The
+chunks are scored by a pool of spawned worker processes, each pinned to its
+own cores and running batches of ``--batch-size`` images (a few images per
+call is fastest on CPU; see tta.py). Each finished chunk is written
+atomically to ``<out>/parts/part-NNNNNN.csv`` (or ``.parquet`` with
+``--format parquet``, which needs pyarrow) and recorded in
+``<out>/manifest.json``. Rerunning the same command skips the recorded
+chunks, so an interrupted run resumes where it stopped. When every chunk is
+done, the parts are merged into ``<out>/results.csv`` (or ``.parquet``) in
+input order, and throughput plus per-stage timings are printed and stored in
+the manifest.
+
+    python score.py /archive/xrays --out scores/2024-audit
+    python score.py --file-list studies.txt --out scores/audit --workers 4 --threads 1
+    python score.py /archive/xrays --out scores/audit --version v3 --format parquet
+"""
+import argparse
+import csv
+import hashlib
+import logging
+import multiprocessing
+import os
+import signal
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+
+from archives import is_image_member
+from process_pool import available_cores, pinned_pool, read_json, write_json
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+FORMATS = ('csv', 'parquet')
+COLUMNS = ('path', 'pneumonia_prob', 'prediction', 'calibrated', 'error')
+STAGES = ('read', 'decode', 'forward', 'write')
+MANIFEST = 'manifest.json'
+FILE_LIST = 'files.txt'
+
+# Set in each worker process by _load_worker
+_runtime = None
+_decode_options = None
+
+
+def list_images(directories=(), file_lists=()):
+    """Sorted, de-duplicated image paths from directory trees and list files"""
+    paths = set()
+    for directory in directories:
+        for root, dirs, files in os.walk(directory):
+            dirs[:] = [name for name in dirs if not name.startswith('.')]
+            for name in files:
+                path = os.path.join(root, name)
+                if is_image_member(path):
+                    paths.add(path)
+    for file_list in file_lists:
+        with open(file_list) as f:
+            paths.update(line.strip() for line in f if line.strip())
+    return sorted(paths)
+
+
+def _load_worker(weights_path, mode, version, quantized_model_path, decode_options):
+    """Load the model once per worker (run after process_pool pins it)"""
+    global _runtime, _decode_options
+    import inference
+
+    # Ctrl-C is handled by the parent, which cancels the queued chunks
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    logging.basicConfig(level=logging.WARNING)
+    _runtime = inference.load_runtime(weights_path, mode=mode, version=version,
+                                      quantized_model_path=quantized_model_path)
+    if mode == 'quantized' and _runtime.mode != 'quantized':
+        # The server falls back to the float model; a scoring run must not mix the two
+        raise RuntimeError(f"Could not load the INT8 model {quantized_model_path}")
+    _decode_options = decode_options
+
+
+def score_chunk(task):
+    """Score one chunk of paths; returns (chunk index, rows, stage seconds)"""
+    from preprocessing import decode_image
+
+    index, paths, batch_size = task
+    seconds = dict.fromkeys(STAGES, 0.0)
+    rows = [None] * len(paths)
+    pending = []
+
+    def flush():
+        started = time.perf_counter()
+        probs = _runtime.run_batch([image for _, image in pending])
+        seconds['forward'] += time.perf_counter() - started
+        for (i, _), prob in zip(pending, probs):
+            rows[i] = (paths[i], prob, 'Pneumonia' if prob > 0.5 else 'Normal',
+                       _runtime.calibrator is not None, '')
+        pending.clear()
+
+    for i, path in enumerate(paths):
+        try:
+            started = time.perf_counter()
+            with open(path, 'rb') as f:
+                image_bytes = f.read()
+            decoded = time.perf_counter()
+            seconds['read'] += decoded - started
+            pending.append((i, decode_image(image_bytes, **_decode_options)))
+            seconds['decode'] += time.perf_counter() - decoded
+        except Exception as e:
+            rows[i] = (path, None, '', False, f"{type(e).__name__}: {str(e)}")
+        if len(pending) == batch_size:
+            flush()
+    if pending:
+        flush()
+    return index, rows, seconds
+
+
+def part_path(out_dir, index, fmt):
+    return os.path.join(out_dir, 'parts', f"part-{index:06d}.{fmt}")
+
+
+def write_rows(path, rows, fmt):
+    """Write rows atomically as CSV or Parquet"""
+    tmp_path = f"{path}.tmp"
+    if fmt == 'csv':
+        with open(tmp_path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(COLUMNS)
+            writer.writerows(rows)
+    else:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        columns = list(zip(*rows)) if rows else [()] * len(COLUMNS)
+        table = pa.table({name: list(values) for name, values in zip(COLUMNS, columns)}, schema=_schema())
+        pq.write_table(table, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def _schema():
+    import pyarrow as pa
+    return pa.schema([('path', pa.string()), ('pneumonia_prob', pa.float64()), ('prediction', pa.string()),
+                      ('calibrated', pa.bool_()), ('error', pa.string())])
+
+
+def merge_parts(out_dir, chunks, fmt):
+    """Concatenate the parts, in input order, into results.<fmt>"""
+    path = os.path.join(out_dir, f"results.{fmt}")
+    tmp_path = f"{path}.tmp"
+    if fmt == 'csv':
+        with open(tmp_path, 'w', newline='') as out:
+            out.write(','.join(COLUMNS) + '\r\n')
+            for index in range(chunks):
+                with open(part_path(out_dir, index, fmt), newline='') as part:
+                    part.readline()
+                    for block in iter(lambda: part.read(1024 * 1024), ''):
+                        out.write(block)
+    else:
+        import pyarrow.parquet as pq
+        with pq.ParquetWriter(tmp_path, _schema()) as writer:
+            for index in range(chunks):
+                writer.write_table(pq.read_table(part_path(out_dir, index, fmt)))
+    os.replace(tmp_path, path)
+    return path
+
+
+def _file_list_sha256(paths):
+    return hashlib.sha256('\n'.join(paths).encode()).hexdigest()
+
+
+def scoring_settings(args, weights_path):
+    """Everything that decides the scores; a run is only resumed with the same"""
+    from calibration import calibration_path
+    from model_registry import file_sha256
+
+    if args.mode == 'quantized':
+        # The INT8 model is what runs, and it is served without calibration
+        model_path, calibration_sha256 = args.quantized_model, None
+        if not os.path.exists(model_path):
+            raise SystemExit(f"No INT8 model at {model_path}; build it with quantize_model.py")
+    else:
+        model_path = weights_path
+        calibration_file = calibration_path(weights_path)
+        calibration_sha256 = file_sha256(calibration_file) if os.path.exists(calibration_file) else None
+    return {
+        'model_sha256': file_sha256(model_path),
+        'calibration_sha256': calibration_sha256,
+        'mode': args.mode,
+        'draft': not args.no_draft,
+        'max_pixels': args.max_pixels,
+        'format': args.format,
+        'chunk_size': args.chunk_size,
+    }, model_path
+
+
+def prepare_run(args, weights_path, version):
+    """Load or start the manifest in ``args.out``; returns (manifest, paths)"""
+    os.makedirs(os.path.join(args.out, 'parts'), exist_ok=True)
+    manifest_path = os.path.join(args.out, MANIFEST)
+    manifest = read_json(manifest_path)
+    settings, model_path = scoring_settings(args, weights_path)
+    if manifest is not None:
+        # The stored list, not a fresh walk, defines the chunks of a resumed run
+        with open(os.path.join(args.out, FILE_LIST)) as f:
+            paths = f.read().splitlines()
+        if manifest['files_sha256'] != _file_list_sha256(paths):
+            raise SystemExit(f"{FILE_LIST} in {args.out} does not match its manifest")
+        changed = [name for name, value in settings.items() if manifest['settings'].get(name) != value]
+        if changed:
+            raise SystemExit(f"{args.out} was started with a different {', '.join(changed)}; "
+                             f"resume with the same model and options, or use another --out")
+        return manifest, paths
+
+    paths = list_images(args.inputs, args.file_list or ())
+    if not paths:
+        raise SystemExit("No images found")
+    with open(os.path.join(args.out, FILE_LIST), 'w') as f:
+        f.write('\n'.join(paths))
+    manifest = {
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'inputs': args.inputs,
+        'file_lists': args.file_list or [],
+        'images': len(paths),
+        'files_sha256': _file_list_sha256(paths),
+        'chunks': (len(paths) + args.chunk_size - 1) // args.chunk_size,
+        'model': {'path': os.path.abspath(model_path), 'version': version},
+        'settings': settings,
+        'done': {},
+        'runs': [],
+    }
+    write_json(manifest, manifest_path)
+    return manifest, paths
+
+
+def resolve_weights(args):
+    """(weights path, registry version or None) to score with"""
+    if args.version:
+        from model_registry import ModelRegistry
+        return ModelRegistry(args.registry).weights_path(args.version), args.version
+    return args.weights, None
+
+
+def print_report(images, errors, wall_seconds, seconds, workers):
+    rate = images / wall_seconds if wall_seconds else 0.0
+    print(f"Scored {images} image(s) ({errors} error(s)) in {wall_seconds:.1f}s: {rate:.1f} images/s "
+          f"with {workers} worker(s)")
+    if images:
+        print("Per-stage time (summed over workers):")
+        for stage in STAGES:
+            print(f"  {stage:8s} {seconds[stage]:9.2f}s  {seconds[stage] / images * 1000:8.2f} ms/image")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('inputs', nargs='*', help='directories to walk for images')
+    parser.add_argument('--file-list', action='append', help='text file with one image path per line (repeatable)')
+    parser.add_argument('--out', required=True, help='output directory (manifest, parts and merged results)')
+    parser.add_argument('--format', choices=FORMATS, default='csv')
+    parser.add_argument('--weights', default=os.path.join(BASE_DIR, 'pneumonia_detection_model.pth'))
+    parser.add_argument('--version', help='score with this registry version instead of --weights')
+    parser.add_argument('--registry', default=os.environ.get('MODEL_REGISTRY_DIR') or os.path.join(BASE_DIR, 'models'))
+    parser.add_argument('--mode', choices=('eager', 'optimized', 'quantized'), default='eager',
+                        help='model mode, as MODEL_MODE in the server')
+    parser.add_argument('--quantized-model', default=os.environ.get('QUANTIZED_MODEL_PATH') or os.path.join(
+        BASE_DIR, 'pneumonia_detection_model_int8.pt'), help='INT8 model for --mode quantized')
+    parser.add_argument('--workers', type=int, help='worker processes (default: one per core)')
+    parser.add_argument('--threads', type=int, help='intra-op threads per worker (default: cores / workers)')
+    parser.add_argument('--batch-size', type=int, default=8, help='images per forward pass')
+    parser.add_argument('--chunk-size', type=int, default=256,
+                        help='images per work unit and output part; the resume granularity')
+    parser.add_argument('--no-draft', action='store_true',
+                        help='decode large images in full (exact parity with the training transform)')
+    parser.add_argument('--max-pixels', type=int, default=50_000_000,
+                        help='images with more pixels are recorded as errors without being decoded (0: no limit)')
+    args = parser.parse_args()
+    if not args.inputs and not args.file_list:
+        parser.error('give at least one directory or --file-list')
+    if args.format == 'parquet':
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            parser.error('--format parquet needs pyarrow (pip install pyarrow)')
+
+    weights_path, version = resolve_weights(args)
+    manifest, paths = prepare_run(args, weights_path, version)
+    manifest_path = os.path.join(args.out, MANIFEST)
+    todo = [index for index in range(manifest['chunks']) if str(index) not in manifest['done']]
+    print(f"{manifest['images']} image(s) in {manifest['chunks']} chunk(s); "
+          f"{manifest['chunks'] - len(todo)} already done")
+
+    cores = available_cores()
+    workers = max(1, min(args.workers or len(cores) // (args.threads or 1), len(todo) or 1))
+    threads = args.threads or max(1, len(cores) // workers)
+    seconds = dict.fromkeys(STAGES, 0.0)
+    images = errors = 0
+    started = time.perf_counter()
+    if todo:
+        print(f"Scoring with {workers} worker(s) x {threads} thread(s), batches of {args.batch_size}")
+        decode_options = {'draft': not args.no_draft, 'max_pixels': args.max_pixels or None}
+        tasks = iter((index, paths[index * args.chunk_size:(index + 1) * args.chunk_size], args.batch_size)
+                     for index in todo)
+        pool = pinned_pool(workers, threads, cores, initializer=_load_worker,
+                           initargs=(weights_path, args.mode, version, args.quantized_model, decode_options))
+        try:
+            # A couple of chunks queued per worker keeps them busy without holding every result
+            running = set()
+            for task in tasks:
+                running.add(pool.submit(score_chunk, task))
+                if len(running) < 2 * workers:
+                    continue
+                done, running = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    images, errors = _record(future.result(), args, manifest, manifest_path, seconds,
+                                             images, errors, started)
+            for future in wait(running).done:
+                images, errors = _record(future.result(), args, manifest, manifest_path, seconds,
+                                         images, errors, started)
+        except KeyboardInterrupt:
+            # Chunks in flight are lost and scored again on resume
+            for process in multiprocessing.active_children():
+                process.terminate()
+            pool.shutdown(cancel_futures=True)
+            print(f"Interrupted with {len(manifest['done'])}/{manifest['chunks']} chunk(s) done; "
+                  f"rerun the same command to resume")
+            sys.exit(130)
+        except BrokenProcessPool:
+            raise SystemExit(f"A worker failed (see its error above) with {len(manifest['done'])}/"
+                             f"{manifest['chunks']} chunk(s) done; rerun the same command to resume")
+        pool.shutdown()
+
+    wall_seconds = time.perf_counter() - started
+    if todo:
+        manifest['runs'].append({'finished_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'), 'images': images,
+                                 'errors': errors, 'seconds': round(wall_seconds, 3), 'workers': workers,
+                                 'threads': threads, 'batch_size': args.batch_size,
+                                 'images_per_second': round(images / wall_seconds, 2) if wall_seconds else None,
+                                 'stage_seconds': {stage: round(value, 3) for stage, value in seconds.items()}})
+        write_json(manifest, manifest_path)
+        print_report(images, errors, wall_seconds, seconds, workers)
+    if len(manifest['done']) == manifest['chunks']:
+        results = merge_parts(args.out, manifest['chunks'], args.format)
+        total_errors = sum(chunk['errors'] for chunk in manifest['done'].values())
+        print(f"Results ({manifest['images']} image(s), {total_errors} error(s)): {results}")
+
+
+def _record(result, args, manifest, manifest_path, seconds, images, errors, started):
+    """Write a finished chunk's part, then mark it done in the manifest"""
+    index, rows, chunk_seconds = result
+    write_started = time.perf_counter()
+    write_rows(part_path(args.out, index, args.format), rows, args.format)
+    chunk_errors = sum(1 for row in rows if row[4])
+    manifest['done'][str(index)] = {'images': len(rows), 'errors': chunk_errors}
+    write_json(manifest, manifest_path)
+    chunk_seconds['write'] = time.perf_counter() - write_started
+    for stage, value in chunk_seconds.items():
+        seconds[stage] += value
+    images += len(rows)
+    errors += chunk_errors
+    elapsed = time.perf_counter() - started
+    print(f"  chunk {index + 1}/{manifest['chunks']}: {len(rows)} image(s), {chunk_errors} error(s); "
+          f"{len(manifest['done'])}/{manifest['chunks']} done, {images / elapsed:.1f} images/s")
+    return images, errors
+
+
+if __name__ == '__main__':
+    main()
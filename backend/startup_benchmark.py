@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+Startup benchmark for the backend.
+
+For each MODEL_LOAD mode, starts a fresh server process and measures:
+- import time of main.py
+- time until /api/health/live answers (the app is listening)
+- time until /api/health/ready answers 200
+- time until the first /predict succeeds
+
+MODEL_LOAD=eager is the old behaviour (torch import and model load at import
+time) and serves as the "before" figure.
+
+Usage: python startup_benchmark.py [--modes eager background lazy] [--repeats 3] [--output startup.json]
+"""
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+
+import requests
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+SAMPLE_IMAGE = os.path.join(BASE_DIR, "pneumonia.png")
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def measure_import(mode):
+    code = "import time; t = time.perf_counter(); import main; print(time.perf_counter() - t)"
+    env = dict(os.environ, MODEL_LOAD=mode)
+    output = subprocess.run(
+        [sys.executable, '-c', code], cwd=BASE_DIR, env=env,
+        capture_output=True, text=True, check=True,
+    ).stdout
+    return float(output.strip().splitlines()[-1])
+
+
+def wait_for(url, started, timeout, expect_ok=True):
+    deadline = started + timeout
+    while time.perf_counter() < deadline:
+        try:
+            response = requests.get(url, timeout=1)
+            if not expect_ok or response.ok:
+                return time.perf_counter() - started
+        except requests.RequestException:
+            pass
+        time.sleep(0.01)
+    raise TimeoutError(f"{url} not available after {timeout}s")
+
+
+def measure_server(mode, timeout=120):
+    port = free_port()
+    base = f"http://127.0.0.1:{port}"
+    code = f"from main import app; app.run(host='127.0.0.1', port={port}, threaded=True)"
+    env = dict(os.environ, MODEL_LOAD=mode, FLASK_ENV='production')
+    started = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, '-c', code], cwd=BASE_DIR, env=env,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        live = wait_for(f"{base}/api/health/live", started, timeout)
+        ready = wait_for(f"{base}/api/health/ready", started, timeout)
+        with open(SAMPLE_IMAGE, 'rb') as f:
+            response = requests.post(f"{base}/predict", files={'file': ('pneumonia.png', f)}, timeout=timeout)
+        response.raise_for_status()
+        first_prediction = time.perf_counter() - started
+    finally:
+        server.terminate()
+        server.wait()
+    return {'live_s': live, 'ready_s': ready, 'first_prediction_s': first_prediction}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--modes', nargs='+', default=['eager', 'background', 'lazy'])
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--output', help='write results as JSON to this file')
+    args = parser.parse_args()
+
+    results = {}
+    for mode in args.modes:
+        runs = []
+        for _ in range(args.repeats):
+            run = measure_server(mode)
+            run['import_s'] = measure_import(mode)
+            runs.append(run)
+        results[mode] = {
+            key: round(statistics.median(run[key] for run in runs), 3) for key in runs[0]
+        }
+        summary = '  '.join(f"{key}: {value:.3f}" for key, value in results[mode].items())
+        print(f"{mode:10s} {summary}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'repeats': args.repeats, 'median': results}, f, indent=2)
+        print(f"Results written to: {args.output}")
+
+
+if __name__ == '__main__':
+    main()
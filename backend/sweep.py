@@ -0,0 +1,353 @@
+#!/usr/bin/env python3
+"""
+Parallel hyperparameter sweep for the pneumonia model.
+
+Every trial trains PneumoniaCNN with training_engine.Trainer, the same way
+train_model.py does, using one combination from a search space. The space
+covers batch size, learning rate, image size and the RMSprop and
+ReduceLROnPlateau settings. Unlisted settings keep train_model.py's values.
+Trials run concurrently in a pool of spawned processes sized to the
+available cores. Each process is pinned to its own cores and uses that many
+intra-op threads, so trials do not compete for the same cores.
+
+All trials read the same pre-decoded shard cache (data_shards.py; one per
+image size), memory-mapped, so there is one copy of the dataset in the
+page cache however many trials run.
+
+Trials are pruned with a median rule. After ``--warmup`` epochs, a trial
+stops once its best val F1 so far is below the median of the other trials'
+best val F1 at the same epoch. Each trial lives in ``<out>/trial_NNN/``
+(last.pt, best.pt, history.json, result.json). Rerunning the same command
+skips finished trials and resumes unfinished ones from last.pt.
+
+At the end, the single-image CPU latency of every trial's best model is
+measured one trial at a time, so concurrent trials do not skew it. Trials
+are ranked by val F1 in ``leaderboard.json`` and ``leaderboard.csv``.
+
+    python sweep.py --out sweeps/lr --epochs 12
+    python sweep.py --space space.json --trials 8 --parallel 4 --threads 2
+
+A space file maps setting names (see DEFAULT_CONFIG) to lists of values:
+
+    {"learning_rate": [0.0003, 0.001], "batch_size": [32, 64], "image_size": [150, 224]}
+"""
+import argparse
+import csv
+import itertools
+import json
+import os
+import random
+import statistics
+import time
+from concurrent.futures import as_completed
+
+import numpy as np
+import torch
+import torch.optim as optim
+
+import data_shards
+from model_registry import build_model
+from process_pool import available_cores, pinned_pool, read_json, write_json
+from timing import percentile
+from training_engine import AMP_MODES, BEST_CHECKPOINT, Trainer
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# The settings train_model.py uses
+DEFAULT_CONFIG = {
+    'batch_size': 32,
+    'learning_rate': 0.001,
+    'image_size': 150,
+    'rmsprop_alpha': 0.99,
+    'rmsprop_momentum': 0.0,
+    'weight_decay': 0.0,
+    'lr_factor': 0.3,
+    'lr_patience': 2,
+    'min_lr': 1e-6,
+}
+
+DEFAULT_SPACE = {
+    'batch_size': [16, 32, 64],
+    'learning_rate': [0.0003, 0.001, 0.003],
+    'lr_factor': [0.3, 0.5],
+}
+
+HISTORY = 'history.json'
+RESULT = 'result.json'
+LEADERBOARD_COLUMNS = ('rank', 'trial', 'status', 'epochs', 'best_epoch', 'val_f1', 'val_accuracy',
+                       'val_precision', 'val_recall', 'latency_p50_ms', 'latency_p95_ms', 'params',
+                       'train_seconds')
+
+
+def load_space(path=None):
+    """Search space from a JSON file (or DEFAULT_SPACE), as {setting: [values]}"""
+    if path is None:
+        return dict(DEFAULT_SPACE)
+    with open(path) as f:
+        space = json.load(f)
+    unknown = sorted(set(space) - set(DEFAULT_CONFIG))
+    if unknown:
+        raise ValueError(f"Unknown settings in {path}: {unknown} (expected some of {sorted(DEFAULT_CONFIG)})")
+    return {key: values if isinstance(values, list) else [values] for key, values in space.items()}
+
+
+def expand_trials(space, trials=None, seed=0):
+    """Every combination of the space (or a random sample of ``trials`` of them) as full configs"""
+    keys = sorted(space)
+    configs = [dict(DEFAULT_CONFIG, **dict(zip(keys, values)))
+               for values in itertools.product(*(space[key] for key in keys))]
+    if trials is not None and trials < len(configs):
+        configs = random.Random(seed).sample(configs, trials)
+    return configs
+
+
+def shard_dir(data_cache, image_size):
+    """The shard cache for ``image_size``: train_model.py's cache for the default size"""
+    if image_size == DEFAULT_CONFIG['image_size']:
+        return data_cache
+    return os.path.join(data_cache, f'size_{image_size}')
+
+
+class MedianPruner:
+    """``Trainer.on_epoch_end`` callback that publishes the trial's history and
+    stops it when it falls below the median of its peers.
+
+    ``history`` is the trainer's own history list (already holding the epoch
+    being reported). Peers are the other trial directories in ``sweep_dir``;
+    only peers that have reached the same epoch count, and at least
+    ``min_trials`` of them are needed before a trial can be pruned.
+    """
+
+    def __init__(self, sweep_dir, name, history, warmup=2, min_trials=3):
+        self.sweep_dir = sweep_dir
+        self.name = name
+        self.history = history
+        self.warmup = warmup
+        self.min_trials = min_trials
+
+    def _peer_histories(self):
+        for entry in os.scandir(self.sweep_dir):
+            if entry.is_dir() and entry.name != self.name:
+                history = read_json(os.path.join(entry.path, HISTORY))
+                if history:
+                    yield history
+
+    def __call__(self, record):
+        write_json(self.history, os.path.join(self.sweep_dir, self.name, HISTORY))
+        epoch = record['epoch']
+        if epoch < self.warmup:
+            return False
+        best = max(r['val_f1'] for r in self.history[:epoch])
+        peers = [max(r['val_f1'] for r in history[:epoch])
+                 for history in self._peer_histories() if len(history) >= epoch]
+        return len(peers) >= self.min_trials and best < statistics.median(peers)
+
+
+def run_trial(task):
+    """Train one configuration; returns (and stores in result.json) its summary"""
+    name, config = task['name'], task['config']
+    out_dir = os.path.join(task['sweep_dir'], name)
+    finished = read_json(os.path.join(out_dir, RESULT))
+    if finished is not None:
+        return finished
+    os.makedirs(out_dir, exist_ok=True)
+
+    try:
+        torch.manual_seed(task['seed'])
+        np.random.seed(task['seed'])
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        # Shard reads are cheap memory-map slices; loader processes would only
+        # compete with the other trials for cores
+        train_loader, val_loader, _ = data_shards.build_loaders(
+            task['data_dir'], device, batch_size=config['batch_size'], num_workers=0, seed=task['seed'])
+
+        model = build_model(input_size=config['image_size']).to(device)
+        optimizer = optim.RMSprop(model.parameters(), lr=config['learning_rate'], alpha=config['rmsprop_alpha'],
+                                  momentum=config['rmsprop_momentum'], weight_decay=config['weight_decay'])
+        scheduler = optim.lr_scheduler.ReduceLROnPlateau(
+            optimizer, mode='max', factor=config['lr_factor'], patience=config['lr_patience'],
+            min_lr=config['min_lr'])
+        trainer = Trainer(model, optimizer, device, scheduler=scheduler, amp=task['amp'], checkpoint_dir=out_dir,
+                          patience=task['patience'] or None, monitor='f1', config=config)
+        trainer.resume()
+        trainer.on_epoch_end = MedianPruner(task['sweep_dir'], name, trainer.history,
+                                            task['warmup'], task['min_trials'])
+        trainer.fit(train_loader, val_loader, task['epochs'], log=lambda line: print(f"[{name}] {line}", flush=True))
+    except Exception as e:
+        # Not stored: rerunning the sweep retries the trial
+        return {'trial': name, 'status': 'failed', 'error': f"{type(e).__name__}: {e}", 'config': config}
+
+    if trainer.best_epoch is None:
+        # Stopped before any epoch finished: nothing to report for this trial
+        return {'trial': name, 'status': 'failed', 'config': config,
+                'error': f"No epoch finished ({trainer.stop_reason or 'no epochs run'})"}
+    if trainer.stop_reason == 'stopped by callback':
+        status = 'pruned'
+    elif trainer.stop_reason:
+        status = 'early_stopped'
+    else:
+        status = 'complete'
+    best = trainer.history[trainer.best_epoch - 1]
+    result = {
+        'trial': name,
+        'status': status,
+        'config': config,
+        'epochs': trainer.epoch,
+        'best_epoch': trainer.best_epoch,
+        'val_f1': best['val_f1'],
+        'val_accuracy': best['val_accuracy'],
+        'val_precision': best['val_precision'],
+        'val_recall': best['val_recall'],
+        'train_seconds': round(sum(r['seconds'] for r in trainer.history), 1),
+        'checkpoint': os.path.join(out_dir, BEST_CHECKPOINT),
+    }
+    write_json(result, os.path.join(out_dir, RESULT))
+    return result
+
+
+def measure_latency(checkpoint, image_size, threads=1, runs=50):
+    """Single-image CPU forward latency (ms) and parameter count of a best.pt"""
+    torch.set_num_threads(threads)
+    model = build_model(input_size=image_size)
+    model.load_state_dict(torch.load(checkpoint, map_location='cpu', weights_only=False)['model'])
+    model.eval()
+    image = torch.rand(1, 3, image_size, image_size)
+    times = []
+    with torch.inference_mode():
+        for i in range(runs + 5):
+            started = time.perf_counter()
+            model(image)
+            if i >= 5:  # the first calls allocate and pick kernels
+                times.append((time.perf_counter() - started) * 1000)
+    return {
+        'latency_p50_ms': round(percentile(times, 50), 3),
+        'latency_p95_ms': round(percentile(times, 95), 3),
+        'params': sum(p.numel() for p in model.parameters()),
+    }
+
+
+def rank(results):
+    """Best val F1 first (ties: val accuracy, then latency); failed trials last"""
+    def key(result):
+        if result['status'] == 'failed':
+            return (1, 0, 0, 0)
+        return (0, -result['val_f1'], -result['val_accuracy'], result.get('latency_p50_ms', 0))
+    ranked = sorted(results, key=key)
+    for position, result in enumerate(ranked, 1):
+        result['rank'] = position
+    return ranked
+
+
+def write_leaderboard(sweep_dir, ranked, meta):
+    write_json({'sweep': meta, 'trials': ranked}, os.path.join(sweep_dir, 'leaderboard.json'))
+    settings = sorted(DEFAULT_CONFIG)
+    with open(os.path.join(sweep_dir, 'leaderboard.csv'), 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(LEADERBOARD_COLUMNS + tuple(settings))
+        for result in ranked:
+            writer.writerow([result.get(column, '') for column in LEADERBOARD_COLUMNS]
+                            + [result['config'][key] for key in settings])
+
+
+def print_leaderboard(ranked, space):
+    varied = sorted(space)
+    print(f"\n{'rank':>4} {'trial':10} {'status':14} {'ep':>3} {'val_f1':>7} {'val_acc':>8} {'p50_ms':>8}  "
+          + '  '.join(varied))
+    for result in ranked:
+        values = '  '.join(f"{key}={result['config'][key]}" for key in varied)
+        if result['status'] == 'failed':
+            print(f"{result['rank']:>4} {result['trial']:10} {'failed':14} {'':>3} {'':>7} {'':>8} {'':>8}  "
+                  f"{values}  {result['error']}")
+            continue
+        print(f"{result['rank']:>4} {result['trial']:10} {result['status']:14} {result['epochs']:>3} "
+              f"{result['val_f1']:7.4f} {result['val_accuracy']:7.2f}% {result['latency_p50_ms']:8.2f}  {values}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--space', help='JSON search space (default: batch size x learning rate x LR decay factor)')
+    parser.add_argument('--trials', type=int, help='random sample of this many combinations (default: all)')
+    parser.add_argument('--out', default=os.path.join(BASE_DIR, 'sweeps', time.strftime('%Y%m%d-%H%M%S')),
+                        help='sweep directory; rerun with the same directory to resume')
+    parser.add_argument('--data-cache', default=os.path.join(BASE_DIR, 'data_cache'))
+    parser.add_argument('--dataset', help='chest_xray directory (downloaded with kagglehub if omitted)')
+    parser.add_argument('--epochs', type=int, default=12)
+    parser.add_argument('--patience', type=int, default=4, help='early stopping patience per trial (0 disables)')
+    parser.add_argument('--amp', choices=AMP_MODES, default='auto')
+    parser.add_argument('--parallel', type=int, help='concurrent trials (default: one per core, at most --trials)')
+    parser.add_argument('--threads', type=int, help='intra-op threads per trial (default: cores / parallel)')
+    parser.add_argument('--warmup', type=int, default=2, help='epochs before a trial can be pruned')
+    parser.add_argument('--min-trials', type=int, default=3, help='peers needed at an epoch before pruning')
+    parser.add_argument('--latency-threads', type=int, default=1, help='threads for the latency measurement')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    space = load_space(args.space)
+    configs = expand_trials(space, args.trials, args.seed)
+    os.makedirs(args.out, exist_ok=True)
+    print(f"{len(configs)} trials over {', '.join(f'{k}={v}' for k, v in sorted(space.items()))}")
+
+    dataset_root = args.dataset
+    if dataset_root is None:
+        import kagglehub
+        dataset_root = os.path.join(kagglehub.dataset_download("paultimothymooney/chest-xray-pneumonia"),
+                                    'chest_xray')
+    # Written once, before the trials start, and then only read
+    for size in sorted({config['image_size'] for config in configs}):
+        data_shards.ensure_shards(dataset_root, shard_dir(args.data_cache, size), size=size)
+
+    cores = available_cores()
+    parallel = args.parallel or max(1, min(len(configs), len(cores) // (args.threads or 1)))
+    threads = args.threads or max(1, len(cores) // parallel)
+    print(f"Running {parallel} trial(s) at a time with {threads} thread(s) each on {len(cores)} core(s)")
+
+    tasks = [{
+        'name': f'trial_{index:03d}',
+        'config': config,
+        'sweep_dir': args.out,
+        'data_dir': shard_dir(args.data_cache, config['image_size']),
+        'epochs': args.epochs,
+        'patience': args.patience,
+        'amp': args.amp,
+        'seed': args.seed,
+        'warmup': args.warmup,
+        'min_trials': args.min_trials,
+    } for index, config in enumerate(configs)]
+
+    started = time.perf_counter()
+    results = []
+    with pinned_pool(parallel, threads, cores) as pool:
+        futures = [pool.submit(run_trial, task) for task in tasks]
+        for future in as_completed(futures):
+            result = future.result()
+            results.append(result)
+            detail = result.get('error') or f"val F1 {result['val_f1']:.4f} after {result['epochs']} epochs"
+            print(f"{result['trial']} {result['status']}: {detail} ({len(results)}/{len(tasks)})", flush=True)
+    elapsed = time.perf_counter() - started
+
+    for result in results:
+        if result['status'] != 'failed':
+            result.update(measure_latency(result['checkpoint'], result['config']['image_size'],
+                                          args.latency_threads))
+    ranked = rank(results)
+    meta = {
+        'space': space,
+        'epochs': args.epochs,
+        'patience': args.patience,
+        'amp': args.amp,
+        'parallel': parallel,
+        'threads': threads,
+        'cores': len(cores),
+        'warmup': args.warmup,
+        'min_trials': args.min_trials,
+        'latency_threads': args.latency_threads,
+        'seed': args.seed,
+        'wall_seconds': round(elapsed, 1),
+    }
+    write_leaderboard(args.out, ranked, meta)
+    print_leaderboard(ranked, space)
+    print(f"\nSweep took {elapsed:.1f}s; leaderboard written to: {os.path.join(args.out, 'leaderboard.json')}")
+
+
+if __name__ == '__main__':
+    main()
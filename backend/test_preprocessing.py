@@ -0,0 +1,31 @@
+"""
+Preprocessing parity: ``python -m pytest test_preprocessing.py`` from backend/.
+"""
+import os
+
+import pytest
+
+from preprocessing import (DRAFT_TOLERANCE, PIL_BACKEND_TOLERANCE, TORCH_BACKEND_TOLERANCE, _large_synthetic_images,
+                           _synthetic_images, check_parity, decode_image, to_batch)
+
+FIXTURE_IMAGE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pneumonia.png')
+
+
+@pytest.mark.parametrize('draft', [False, True])
+def test_backends_match(draft):
+    with open(FIXTURE_IMAGE, 'rb') as f:
+        image_bytes = f.read()
+    pil = to_batch([decode_image(image_bytes, backend='pil', draft=draft)])
+    torch = to_batch([decode_image(image_bytes, backend='torch', draft=draft)])
+    assert (pil - torch).abs().max().item() <= TORCH_BACKEND_TOLERANCE
+
+
+@pytest.mark.parametrize('backend,draft,tolerance', [
+    ('pil', False, PIL_BACKEND_TOLERANCE),
+    ('torch', False, TORCH_BACKEND_TOLERANCE),
+    ('pil', True, DRAFT_TOLERANCE),
+    ('torch', True, DRAFT_TOLERANCE),
+])
+def test_matches_reference_pipeline(backend, draft, tolerance):
+    images = list(_synthetic_images()) + list(_large_synthetic_images())
+    check_parity(images, backend=backend, tolerance=tolerance, draft=draft)
@@ -0,0 +1,24 @@
+"""
+Small timing helpers: percentiles for the latency figures in stats() and
+the benchmarks, and a median wall-time timer for the benchmark scripts.
+"""
+import statistics
+import time
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def median_ms(fn, repeats):
+    """Median wall time of ``repeats`` calls of ``fn``, in milliseconds"""
+    times = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - started) * 1000)
+    return statistics.median(times)
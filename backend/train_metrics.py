@@ -0,0 +1,54 @@
+"""
+Streaming binary classification metrics for the training loop.
+
+``BinaryMetrics`` keeps confusion-matrix counts and the loss sum as tensors
+on the training device, so updating it inside the batch loop never waits for
+the device. ``compute()`` copies them to the host once, at the end of the
+epoch, and returns the same numbers as sklearn's accuracy/precision/recall/
+f1/confusion_matrix on the collected predictions (positive class =
+pneumonia, label 1; 0 when a ratio is undefined, like ``zero_division=0``).
+"""
+import torch
+
+
+class BinaryMetrics:
+    def __init__(self, device, threshold=0.5):
+        self.device = torch.device(device)
+        self.threshold = threshold
+        self.reset()
+
+    def reset(self):
+        # [tn, fp, fn, tp], indexed by 2 * label + prediction
+        self._counts = torch.zeros(4, dtype=torch.int64, device=self.device)
+        # float64 so the summed loss matches summing Python floats
+        self._loss_sum = torch.zeros((), dtype=torch.float64, device=self.device)
+        self._loss_count = torch.zeros((), dtype=torch.int64, device=self.device)
+
+    @torch.no_grad()
+    def update(self, outputs, labels, loss=None):
+        """Add a batch of sigmoid outputs and 0/1 labels; ``loss`` is the batch mean"""
+        preds = (outputs.detach().reshape(-1) > self.threshold).long()
+        labels = labels.detach().reshape(-1).long()
+        self._counts += torch.bincount(labels * 2 + preds, minlength=4)
+        if loss is not None:
+            self._loss_sum += loss.detach().double() * labels.numel()
+            self._loss_count += labels.numel()
+
+    def compute(self):
+        """Sync once and return accuracy (%), precision, recall, f1, loss and the confusion matrix"""
+        tn, fp, fn, tp = self._counts.tolist()
+        loss_sum = self._loss_sum.item()
+        loss_count = self._loss_count.item()
+        total = tn + fp + fn + tp
+        precision = tp / (tp + fp) if tp + fp else 0.0
+        recall = tp / (tp + fn) if tp + fn else 0.0
+        f1 = 2 * tp / (2 * tp + fp + fn) if tp + fp + fn else 0.0
+        return {
+            'accuracy': (tp + tn) / total * 100 if total else 0.0,
+            'precision': precision,
+            'recall': recall,
+            'f1': f1,
+            'loss': loss_sum / loss_count if loss_count else None,
+            'total': total,
+            'confusion_matrix': [[tn, fp], [fn, tp]],
+        }
@@ -1,3 +1,4 @@
+import argparse
 import kagglehub
 import os
 import torch
@@ -5,34 +6,43 @@ import torch.nn as nn
 import torch.optim as optim
 from torchvision import datasets, transforms
 from torch.utils.data import DataLoader
-from sklearn.metrics import confusion_matrix, precision_score, recall_score, f1_score
 import numpy as np
 from PIL import Image
 
-
-def main():
-    print("Starting improved model training with better architecture...")
-
-    # Download dataset
-    print("Downloading dataset...")
-    path = kagglehub.dataset_download("paultimothymooney/chest-xray-pneumonia")
-    print(f"Dataset downloaded to: {path}")
-
-    # Device configuration
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    print(f"Using device: {device}")
-
-    # Paths
-    train_folder = os.path.join(path, 'chest_xray/train/')
-    val_folder = os.path.join(path, 'chest_xray/val/')
-    test_folder = os.path.join(path, 'chest_xray/test/')
-
-    # Hyperparameters
-    batch_size = 32
-    num_epochs = 12
-    learning_rate = 0.001
-    image_size = 150  # Increased image size for better feature extraction
-
+import calibration
+import data_shards
+from model_registry import ModelRegistry, WEIGHTS_FILE, build_model, file_sha256
+from train_metrics import BinaryMetrics
+from training_engine import AMP_MODES, Trainer, atomic_save
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Train the pneumonia detection model")
+    parser.add_argument('--data-cache', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data_cache'),
+                        help='directory for pre-decoded uint8 shards (written on first use, see data_shards.py)')
+    parser.add_argument('--no-data-cache', action='store_true',
+                        help='decode JPEGs every epoch with torchvision ImageFolder instead')
+    parser.add_argument('--workers', type=int, default=min(4, os.cpu_count() or 1),
+                        help='data loading worker processes')
+    parser.add_argument('--epochs', type=int, default=12)
+    parser.add_argument('--amp', choices=AMP_MODES, default='auto',
+                        help='mixed precision: auto = float16 on CUDA, float32 on CPU')
+    parser.add_argument('--checkpoint-dir', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'checkpoints'),
+                        help='where last.pt (resumable state) and best.pt are written every epoch')
+    parser.add_argument('--resume', action='store_true', help='continue from last.pt in --checkpoint-dir')
+    parser.add_argument('--patience', type=int, default=4,
+                        help='stop after this many epochs without a better val F1 (0 disables)')
+    parser.add_argument('--registry', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'models'),
+                        help='model registry the trained weights are added to as a new version')
+    parser.add_argument('--activate', action='store_true',
+                        help='make the new version the one running servers switch to')
+    parser.add_argument('--calibration', choices=('auto', 'none') + calibration.METHODS, default='auto',
+                        help='probability calibration fitted on the val split (auto: temperature on small splits)')
+    return parser.parse_args()
+
+
+def build_folder_loaders(train_folder, val_folder, test_folder, image_size, batch_size, num_workers):
+    """ImageFolder loaders that decode and transform every image each epoch"""
     # Data transforms
     train_transforms = transforms.Compose([
         transforms.Resize((image_size, image_size)),
@@ -56,69 +66,51 @@ def main():
     print(f"Classes: {train_dataset.classes}")
     print(f"Number of classes: {len(train_dataset.classes)}")
 
-    train_loader = DataLoader(
-        train_dataset, batch_size=batch_size, shuffle=True,
-        num_workers=0, pin_memory=torch.cuda.is_available()
-    )
-    val_loader = DataLoader(
-        val_dataset, batch_size=batch_size, shuffle=False,
-        num_workers=0, pin_memory=torch.cuda.is_available()
-    )
-    test_loader = DataLoader(
-        test_dataset, batch_size=batch_size, shuffle=False,
-        num_workers=0, pin_memory=torch.cuda.is_available()
-    )
+    loader_options = dict(num_workers=num_workers, pin_memory=torch.cuda.is_available(),
+                          persistent_workers=num_workers > 0)
+    train_loader = DataLoader(train_dataset, batch_size=batch_size, shuffle=True, **loader_options)
+    val_loader = DataLoader(val_dataset, batch_size=batch_size, shuffle=False, **loader_options)
+    test_loader = DataLoader(test_dataset, batch_size=batch_size, shuffle=False, **loader_options)
+    return train_loader, val_loader, test_loader
+
+
+def main():
+    args = parse_args()
+    print("Starting improved model training with better architecture...")
+
+    # Download dataset
+    print("Downloading dataset...")
+    path = kagglehub.dataset_download("paultimothymooney/chest-xray-pneumonia")
+    print(f"Dataset downloaded to: {path}")
+
+    # Device configuration
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    print(f"Using device: {device}")
+
+    # Paths
+    train_folder = os.path.join(path, 'chest_xray/train/')
+    val_folder = os.path.join(path, 'chest_xray/val/')
+    test_folder = os.path.join(path, 'chest_xray/test/')
+
+    # Hyperparameters
+    batch_size = 32
+    num_epochs = args.epochs
+    learning_rate = 0.001
+    image_size = 150  # Increased image size for better feature extraction
+
+    if args.no_data_cache:
+        train_loader, val_loader, test_loader = build_folder_loaders(
+            train_folder, val_folder, test_folder, image_size, batch_size, args.workers)
+    else:
+        # Decode and resize once, then read uint8 batches from memory-mapped
+        # shards and augment them on the device
+        manifest = data_shards.ensure_shards(os.path.join(path, 'chest_xray'), args.data_cache)
+        print(f"Classes: {manifest['splits']['train']['classes']}")
+        train_loader, val_loader, test_loader = data_shards.build_loaders(
+            args.data_cache, device, batch_size=batch_size, num_workers=args.workers)
 
     print("Initializing improved model...")
-    class PneumoniaCNN(nn.Module):
-        def __init__(self):
-            super(PneumoniaCNN, self).__init__()
-            self.features = nn.Sequential(
-                nn.Conv2d(3, 32, kernel_size=3, padding=1),
-                nn.ReLU(),
-                nn.BatchNorm2d(32),
-                nn.MaxPool2d(2, 2),
-
-                nn.Conv2d(32, 64, kernel_size=3, padding=1),
-                nn.ReLU(),
-                nn.Dropout(0.1),
-                nn.BatchNorm2d(64),
-                nn.MaxPool2d(2, 2),
-
-                nn.Conv2d(64, 64, kernel_size=3, padding=1),
-                nn.ReLU(),
-                nn.BatchNorm2d(64),
-                nn.MaxPool2d(2, 2),
-
-                nn.Conv2d(64, 128, kernel_size=3, padding=1),
-                nn.ReLU(),
-                nn.Dropout(0.2),
-                nn.BatchNorm2d(128),
-                nn.MaxPool2d(2, 2),
-
-                nn.Conv2d(128, 256, kernel_size=3, padding=1),
-                nn.ReLU(),
-                nn.Dropout(0.2),
-                nn.BatchNorm2d(256),
-                nn.MaxPool2d(2, 2),
-            )
-            # Calculate the correct input size for the linear layer
-            # 150x150 -> 75x75 -> 37x37 -> 18x18 -> 9x9 -> 4x4
-            # So the final feature map is 256 * 4 * 4 = 4096
-            self.classifier = nn.Sequential(
-                nn.Linear(256 * 4 * 4, 128),
-                nn.ReLU(),
-                nn.Dropout(0.2),
-                nn.Linear(128, 1),
-                nn.Sigmoid()
-            )
-
-        def forward(self, x):
-            x = self.features(x)
-            x = x.view(x.size(0), -1)
-            return self.classifier(x)
-
-    model = PneumoniaCNN().to(device)
+    model = build_model(input_size=image_size).to(device)
     criterion = nn.BCELoss()
     optimizer = optim.RMSprop(model.parameters(), lr=learning_rate)
     scheduler = optim.lr_scheduler.ReduceLROnPlateau(
@@ -130,110 +122,62 @@ def main():
         verbose=True
     )
 
-    best_val_acc = 0.0
-    best_model_state = None
+    trainer = Trainer(
+        model, optimizer, device,
+        criterion=criterion,
+        scheduler=scheduler,
+        amp=args.amp,
+        checkpoint_dir=args.checkpoint_dir,
+        patience=args.patience or None,
+        monitor='f1',
+        config={'batch_size': batch_size, 'learning_rate': learning_rate, 'epochs': num_epochs},
+    )
+    if args.resume:
+        if trainer.resume():
+            print(f"Resumed from {args.checkpoint_dir} after epoch {trainer.epoch}")
+        else:
+            print(f"No checkpoint in {args.checkpoint_dir}, starting from scratch")
 
     print("Starting training...")
-    for epoch in range(num_epochs):
-        # Training
-        model.train()
-        running_loss = 0.0
-        correct = 0
-        total = 0
-        all_labels = []
-        all_preds = []
-
-        for images, labels in train_loader:
-            images = images.to(device)
-            labels = labels.unsqueeze(1).float().to(device)
-
-            optimizer.zero_grad()
-            outputs = model(images).squeeze()
-            loss = criterion(outputs, labels.view(-1))
-            loss.backward()
-            optimizer.step()
-
-            running_loss += loss.item() * images.size(0)
-            preds = (outputs > 0.5).float()
-            correct += (preds == labels.squeeze()).sum().item()
-            total += labels.size(0)
-            all_labels.extend(labels.squeeze().cpu().numpy())
-            all_preds.extend(preds.cpu().numpy())
-
-        epoch_loss = running_loss / len(train_loader.dataset)
-        train_acc = correct / total * 100
-        train_precision = precision_score(all_labels, all_preds)
-        train_recall = recall_score(all_labels, all_preds)
-        train_f1 = f1_score(all_labels, all_preds)
-
-        # Validation
-        model.eval()
-        val_correct = 0
-        val_total = 0
-        val_labels = []
-        val_preds = []
-        with torch.no_grad():
-            for images, labels in val_loader:
-                images = images.to(device)
-                labels = labels.unsqueeze(1).float().to(device)
-                outputs = model(images).squeeze()
-                preds = (outputs > 0.5).float()
-                val_correct += (preds == labels.squeeze()).sum().item()
-                val_total += labels.size(0)
-                val_labels.extend(labels.squeeze().cpu().numpy())
-                val_preds.extend(preds.cpu().numpy())
-
-        val_acc = val_correct / val_total * 100
-        val_precision = precision_score(val_labels, val_preds)
-        val_recall = recall_score(val_labels, val_preds)
-        val_f1 = f1_score(val_labels, val_preds)
-        scheduler.step(val_acc)
-
-        print(f"Epoch {epoch+1}/{num_epochs} - "
-              f"Train Loss: {epoch_loss:.4f} - "
-              f"Train Acc: {train_acc:.2f}% - "
-              f"Val Acc: {val_acc:.2f}% - "
-              f"Train F1: {train_f1:.2f} - Val F1: {val_f1:.2f}")
-
-        # Save best model
-        if val_acc > best_val_acc:
-            best_val_acc = val_acc
-            best_model_state = model.state_dict()
-
-    # Load best model
-    if best_model_state is not None:
-        model.load_state_dict(best_model_state)
+    # Keeps the best val F1 weights (a copy) and loads them back at the end
+    trainer.fit(train_loader, val_loader, num_epochs)
 
     print("Testing improved model...")
-    model.eval()
-    test_correct = 0
-    test_total = 0
-    test_labels = []
-    test_preds = []
-    with torch.no_grad():
-        for images, labels in test_loader:
-            images = images.to(device)
-            labels = labels.unsqueeze(1).float().to(device)
-            outputs = model(images).squeeze()
-            preds = (outputs > 0.5).float()
-            test_correct += (preds == labels.squeeze()).sum().item()
-            test_total += labels.size(0)
-            test_labels.extend(labels.squeeze().cpu().numpy())
-            test_preds.extend(preds.cpu().numpy())
-
-    test_acc = test_correct / test_total * 100
-    test_precision = precision_score(test_labels, test_preds)
-    test_recall = recall_score(test_labels, test_preds)
-    test_f1 = f1_score(test_labels, test_preds)
-    cm = confusion_matrix(test_labels, test_preds)
-    print(f"Test Accuracy: {test_acc:.2f}%  Precision: {test_precision:.2f}  Recall: {test_recall:.2f}  F1: {test_f1:.2f}")
+    # One pass over each split; the outputs give the test metrics and fit/evaluate the calibration
+    val_probs, val_labels = calibration.collect_probabilities(model, val_loader, device, trainer.dtype)
+    test_probs, test_labels = calibration.collect_probabilities(model, test_loader, device, trainer.dtype)
+    test_metrics = BinaryMetrics('cpu')
+    test_metrics.update(torch.from_numpy(test_probs), torch.from_numpy(test_labels))
+    test = test_metrics.compute()
+    cm = np.array(test['confusion_matrix'])
+    print(f"Test Accuracy: {test['accuracy']:.2f}%  Precision: {test['precision']:.2f}  "
+          f"Recall: {test['recall']:.2f}  F1: {test['f1']:.2f}")
     print(f"Confusion Matrix:\n{cm}")
 
     print("Saving improved model...")
     model_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "pneumonia_detection_model.pth")
-    torch.save(model.state_dict(), model_path)
+    atomic_save(model.state_dict(), model_path)
     print(f"Model saved to: {model_path}")
 
+    metrics = {key: test[key] for key in ('accuracy', 'precision', 'recall', 'f1')}
+    metrics['confusion_matrix'] = test['confusion_matrix']
+    metrics['val_f1'] = trainer.best_score
+    artifacts = None
+    if args.calibration != 'none':
+        calibrator = calibration.fit_and_report(val_probs, val_labels, test_probs, test_labels, args.calibration)
+        calibrator.weights_sha256 = file_sha256(model_path)
+        calibration_path = calibration.calibration_path(model_path)
+        calibrator.save(calibration_path)
+        print(calibration.format_report(calibrator))
+        print(f"Calibration saved to: {calibration_path}")
+        metrics['ece'] = calibrator.report['before']['ece']
+        metrics['calibrated_ece'] = calibrator.report['after']['ece']
+        artifacts = {os.path.basename(calibration.calibration_path(WEIGHTS_FILE)): calibration_path}
+    metadata = ModelRegistry(args.registry).register(
+        model_path, metrics=metrics, input_size=image_size, activate=args.activate, artifacts=artifacts,
+        config=dict(trainer.config, best_epoch=trainer.best_epoch, epochs_run=trainer.epoch, amp=args.amp))
+    print(f"Registered as version {metadata['version']}{' (active)' if args.activate else ''} in: {args.registry}")
+
     print("Improved training complete!")
 
 if __name__ == '__main__':
@@ -0,0 +1,252 @@
+"""
+Reusable training loop for PneumoniaCNN.
+
+``Trainer.fit`` runs epochs of training and validation with:
+- optional autocast mixed precision (float16 + GradScaler on CUDA,
+  bfloat16 on CPU),
+- an on-disk checkpoint (model, optimizer, LR scheduler, grad scaler, RNG
+  state, history) written atomically every ``checkpoint_every`` epochs, so a
+  run can be resumed after a crash,
+- early stopping once the monitored validation metric (F1 by default) has
+  not improved for ``patience`` epochs,
+- a snapshot (a copy, not a live reference) of the weights from the best
+  epoch, restored at the end and saved as ``best.pt``.
+"""
+import copy
+import os
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from train_metrics import BinaryMetrics
+
+AMP_MODES = ('auto', 'off', 'fp16', 'bf16')
+LAST_CHECKPOINT = 'last.pt'
+BEST_CHECKPOINT = 'best.pt'
+
+
+def amp_dtype(amp, device):
+    """The autocast dtype for ``amp`` on ``device``, or None for float32.
+
+    'auto' uses float16 on CUDA and float32 on CPU, where bfloat16 is only
+    faster on CPUs with native bfloat16 support (pass 'bf16' explicitly).
+    """
+    if amp not in AMP_MODES:
+        raise ValueError(f"Unknown amp mode: {amp} (expected one of {AMP_MODES})")
+    if amp == 'auto':
+        return torch.float16 if device.type == 'cuda' else None
+    if amp == 'fp16':
+        return torch.float16
+    if amp == 'bf16':
+        return torch.bfloat16
+    return None
+
+
+def evaluate(model, loader, device, dtype=None):
+    """Accuracy, precision, recall, F1 and confusion matrix of ``model`` on ``loader``"""
+    model.eval()
+    metrics = BinaryMetrics(device)
+    with torch.no_grad(), torch.autocast(device.type, dtype=dtype, enabled=dtype is not None):
+        for images, labels in loader:
+            images = images.to(device)
+            labels = labels.to(device)
+            metrics.update(model(images).float(), labels)
+    return metrics.compute()
+
+
+def atomic_save(obj, path):
+    """torch.save to a temporary file and rename it over ``path``, so readers
+    (and memory maps) of the old file never see a partial write"""
+    tmp_path = f"{path}.tmp"
+    torch.save(obj, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def _rng_state():
+    state = {'torch': torch.get_rng_state(), 'numpy': np.random.get_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def _set_rng_state(state):
+    torch.set_rng_state(state['torch'])
+    np.random.set_state(state['numpy'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+class Trainer:
+    """Trains ``model`` on batches of (images, 0/1 labels) with BCE loss on sigmoid outputs.
+
+    ``on_epoch_end(record)`` is called after every epoch with that epoch's
+    history record; returning True stops training (used to prune sweeps).
+    """
+
+    def __init__(self, model, optimizer, device, criterion=None, scheduler=None, amp='auto',
+                 checkpoint_dir=None, checkpoint_every=1, patience=None, min_delta=0.0, monitor='f1',
+                 on_epoch_end=None, config=None):
+        self.model = model
+        self.optimizer = optimizer
+        self.device = device
+        self.criterion = criterion or nn.BCELoss()
+        self.scheduler = scheduler
+        self.dtype = amp_dtype(amp, device)
+        # Loss scaling keeps small float16 gradients from underflowing; bfloat16 does not need it
+        self.scaler = torch.cuda.amp.GradScaler(enabled=self.dtype == torch.float16 and device.type == 'cuda')
+        self.checkpoint_dir = checkpoint_dir
+        self.checkpoint_every = checkpoint_every
+        self.patience = patience
+        self.min_delta = min_delta
+        self.monitor = monitor
+        self.on_epoch_end = on_epoch_end
+        self.config = config or {}
+
+        self.epoch = 0
+        self.best_score = None
+        self.best_epoch = None
+        self.best_state = None
+        self.epochs_without_improvement = 0
+        self.history = []
+        self.stop_reason = None
+        self._saved_best_epoch = None
+
+    def train_epoch(self, loader):
+        self.model.train()
+        metrics = BinaryMetrics(self.device)
+        for images, labels in loader:
+            images = images.to(self.device)
+            labels = labels.float().to(self.device)
+
+            self.optimizer.zero_grad(set_to_none=True)
+            with torch.autocast(self.device.type, dtype=self.dtype, enabled=self.dtype is not None):
+                outputs = self.model(images).view(-1)
+            # BCELoss is not autocast-safe; compute it in float32
+            loss = self.criterion(outputs.float(), labels)
+            self.scaler.scale(loss).backward()
+            self.scaler.step(self.optimizer)
+            self.scaler.update()
+
+            metrics.update(outputs, labels, loss)
+        return metrics.compute()
+
+    def fit(self, train_loader, val_loader, epochs, log=print):
+        """Train until ``epochs`` epochs have run in total (counting resumed ones)
+        or early stopping triggers, then load the best weights"""
+        if self.stop_reason:
+            log(f"Run already finished at epoch {self.epoch}: {self.stop_reason}")
+        while self.epoch < epochs and not self.stop_reason:
+            started = time.perf_counter()
+            train = self.train_epoch(train_loader)
+            val = evaluate(self.model, val_loader, self.device, self.dtype)
+            if self.scheduler is not None:
+                # Same plateau schedule as before: driven by validation accuracy
+                self.scheduler.step(val['accuracy'])
+            self.epoch += 1
+
+            score = val[self.monitor]
+            improved = self.best_score is None or score > self.best_score + self.min_delta
+            if improved:
+                self.best_score = score
+                self.best_epoch = self.epoch
+                self.best_state = copy.deepcopy(self.model.state_dict())
+                self.epochs_without_improvement = 0
+            else:
+                self.epochs_without_improvement += 1
+
+            record = {
+                'epoch': self.epoch,
+                'train_loss': train['loss'],
+                'train_accuracy': train['accuracy'],
+                'train_f1': train['f1'],
+                'val_accuracy': val['accuracy'],
+                'val_precision': val['precision'],
+                'val_recall': val['recall'],
+                'val_f1': val['f1'],
+                'lr': self.optimizer.param_groups[0]['lr'],
+                'seconds': time.perf_counter() - started,
+            }
+            self.history.append(record)
+            log(f"Epoch {self.epoch}/{epochs} - "
+                f"Train Loss: {record['train_loss']:.4f} - "
+                f"Train Acc: {record['train_accuracy']:.2f}% - "
+                f"Val Acc: {record['val_accuracy']:.2f}% - "
+                f"Train F1: {record['train_f1']:.2f} - Val F1: {record['val_f1']:.2f} - "
+                f"Time: {record['seconds']:.1f}s{' *' if improved else ''}")
+
+            if self.patience is not None and self.epochs_without_improvement >= self.patience:
+                self.stop_reason = f"early stopping: val {self.monitor} did not improve for {self.patience} epochs"
+            if self.on_epoch_end is not None and self.on_epoch_end(record):
+                self.stop_reason = self.stop_reason or 'stopped by callback'
+
+            if self.checkpoint_dir and (self.epoch % self.checkpoint_every == 0 or self.stop_reason
+                                        or self.epoch >= epochs):
+                self.save_checkpoint()
+            if self.stop_reason:
+                log(f"Stopping after epoch {self.epoch}: {self.stop_reason}")
+                break
+
+        if self.best_state is not None:
+            self.model.load_state_dict(self.best_state)
+            log(f"Restored best weights from epoch {self.best_epoch} (val {self.monitor} {self.best_score:.4f})")
+        return self.history
+
+    def state(self):
+        return {
+            'epoch': self.epoch,
+            'model': self.model.state_dict(),
+            'optimizer': self.optimizer.state_dict(),
+            'scheduler': self.scheduler.state_dict() if self.scheduler is not None else None,
+            'scaler': self.scaler.state_dict(),
+            'best_score': self.best_score,
+            'best_epoch': self.best_epoch,
+            'best_state': self.best_state,
+            'epochs_without_improvement': self.epochs_without_improvement,
+            'history': self.history,
+            'stop_reason': self.stop_reason,
+            'monitor': self.monitor,
+            'config': self.config,
+            'rng': _rng_state(),
+        }
+
+    def save_checkpoint(self):
+        os.makedirs(self.checkpoint_dir, exist_ok=True)
+        atomic_save(self.state(), os.path.join(self.checkpoint_dir, LAST_CHECKPOINT))
+        if self.best_epoch is not None and self.best_epoch != self._saved_best_epoch:
+            self._saved_best_epoch = self.best_epoch
+            atomic_save({'epoch': self.best_epoch, 'score': self.best_score, 'monitor': self.monitor,
+                          'model': self.best_state, 'config': self.config},
+                         os.path.join(self.checkpoint_dir, BEST_CHECKPOINT))
+
+    def resume(self, path=None):
+        """Restore training state from ``path`` (default: last.pt in checkpoint_dir).
+
+        Returns False if there is no checkpoint to resume from.
+        """
+        path = path or (os.path.join(self.checkpoint_dir, LAST_CHECKPOINT) if self.checkpoint_dir else None)
+        if not path or not os.path.exists(path):
+            return False
+        # Checkpoints hold optimizer state and RNG state, not just tensors
+        state = torch.load(path, map_location=self.device, weights_only=False)
+        self.model.load_state_dict(state['model'])
+        self.optimizer.load_state_dict(state['optimizer'])
+        if self.scheduler is not None and state['scheduler'] is not None:
+            self.scheduler.load_state_dict(state['scheduler'])
+        self.scaler.load_state_dict(state['scaler'])
+        self.epoch = state['epoch']
+        self.best_score = state['best_score']
+        self.best_epoch = state['best_epoch']
+        self.best_state = state['best_state']
+        self._saved_best_epoch = self.best_epoch
+        self.epochs_without_improvement = state['epochs_without_improvement']
+        self.history = state['history']
+        self.stop_reason = state['stop_reason']
+        self.monitor = state.get('monitor', self.monitor)
+        rng = state['rng']
+        rng['torch'] = rng['torch'].cpu()
+        if 'cuda' in rng:
+            rng['cuda'] = [s.cpu() for s in rng['cuda']]
+        _set_rng_state(rng)
+        return True
@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+"""
+Test-time augmentation (TTA) and checkpoint ensembles in one forward pass.
+
+``TTAEnsemble`` turns a batch of B images into B x N views and runs them
+through M models. It returns each image's mean pneumonia probability and
+its variance over the N x M predictions.
+
+- Views are a fixed, deterministic list (``VIEWS``): the identity, a
+  horizontal flip and small rotations, shifts and zooms. They stay within
+  the training RandomAffine ranges and use the same nearest-neighbour
+  sampling with zero fill. All views of a batch come from one
+  affine_grid/grid_sample call.
+- On CPU, the view batch goes through each model in chunks of
+  ``chunk_size`` images, since per-image cost is lowest at a few images
+  per call and larger batches fall out of cache. Models are called in
+  turn; stacking them into one call is not used on CPU.
+- With ``stack=True`` (meant for CUDA, where it saves kernel launches),
+  models of the same architecture are stacked with torch.func and the
+  whole ensemble runs as a single vmapped call.
+
+Measure the cost of N views x M models against a plain forward pass and
+N x M sequential single-image passes with:
+
+    python tta.py --views 1 2 4 8 16 --models 1 3
+
+and compare ``--chunk-size`` values to pick one for the machine.
+"""
+import argparse
+import copy
+import math
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from timing import median_ms
+
+# (rotation degrees, shift x, shift y as a fraction of the size, zoom, horizontal flip)
+VIEWS = (
+    (0.0, 0.0, 0.0, 1.0, False),
+    (0.0, 0.0, 0.0, 1.0, True),
+    (10.0, 0.0, 0.0, 1.0, False),
+    (-10.0, 0.0, 0.0, 1.0, False),
+    (0.0, 0.05, 0.05, 1.0, False),
+    (0.0, -0.05, -0.05, 1.0, False),
+    (0.0, 0.0, 0.0, 1.1, False),
+    (0.0, 0.0, 0.0, 0.9, False),
+)
+# The second half repeats the first with the flip toggled
+MAX_VIEWS = 2 * len(VIEWS)
+
+# Images per forward call on CPU; see the module docstring
+DEFAULT_CHUNK_SIZE = 4
+
+
+def view_params(views):
+    """The first ``views`` entries of VIEWS, followed by their flipped versions"""
+    if not 1 <= views <= MAX_VIEWS:
+        raise ValueError(f"views must be between 1 and {MAX_VIEWS}, got {views}")
+    params = list(VIEWS) + [(angle, tx, ty, zoom, not flip) for angle, tx, ty, zoom, flip in VIEWS]
+    return params[:views]
+
+
+def view_thetas(params, size):
+    """affine_grid matrices (N, 2, 3) for view params, built like data_shards.augment_batch"""
+    thetas = torch.empty(len(params), 2, 3)
+    for i, (degrees, tx, ty, zoom, flip) in enumerate(params):
+        angle = math.radians(degrees)
+        sign = -1.0 if flip else 1.0
+        # Whole-pixel shifts, as in torchvision's RandomAffine
+        shift_x = round(tx * size) * 2 / size
+        shift_y = round(ty * size) * 2 / size
+        cos = math.cos(angle) / zoom
+        sin = math.sin(angle) / zoom
+        thetas[i] = torch.tensor([
+            [cos * sign, sin, -(cos * shift_x + sin * shift_y)],
+            [-sin * sign, cos, sin * shift_x - cos * shift_y],
+        ])
+    return thetas
+
+
+def expand_views(images, thetas):
+    """(B, C, H, W) -> (B * N, C, H, W): every image under every view, image-major"""
+    n = thetas.shape[0]
+    if n == 1 and torch.equal(thetas[0], torch.tensor([[1.0, 0.0, 0.0], [0.0, 1.0, 0.0]])):
+        return images
+    batch, channels, height, width = images.shape
+    repeated = images.repeat_interleave(n, dim=0)
+    grid = F.affine_grid(thetas.to(images.device, images.dtype).repeat(batch, 1, 1),
+                         [batch * n, channels, height, width], align_corners=False)
+    return F.grid_sample(repeated, grid, mode='nearest', padding_mode='zeros', align_corners=False)
+
+
+def _stackable(models):
+    return (len(models) > 1 and all(isinstance(m, nn.Module) and not isinstance(m, torch.jit.ScriptModule)
+                                    for m in models)
+            and len({type(m) for m in models}) == 1)
+
+
+class TTAEnsemble:
+    """Mean and variance of the predictions of ``models`` over ``views`` views of each image"""
+
+    def __init__(self, models, views=1, image_size=150, chunk_size=None, stack=False):
+        self.models = list(models)
+        self.views = views
+        self.thetas = view_thetas(view_params(views), image_size)
+        self.chunk_size = chunk_size
+        self._stacked = None
+        if stack and _stackable(self.models):
+            from torch.func import stack_module_state
+            params, buffers = stack_module_state(self.models)
+            # A parameter-free copy to call functionally with each model's tensors
+            base = copy.deepcopy(self.models[0]).to('meta')
+            self._stacked = (base, params, buffers)
+
+    @property
+    def samples(self):
+        """Predictions averaged per image"""
+        return self.views * len(self.models)
+
+    def _forward_stacked(self, batch):
+        from torch.func import functional_call, vmap
+        base, params, buffers = self._stacked
+
+        def run(params, buffers, x):
+            return functional_call(base, (params, buffers), (x,))
+
+        # (M, B * N, 1): the same input for every model, one vmapped call
+        return vmap(run, in_dims=(0, 0, None))(params, buffers, batch)
+
+    @torch.no_grad()
+    def samples_for(self, images):
+        """(B, 3, H, W) float images -> (B, M * N) tensor of every model's prediction on every view"""
+        batch = expand_views(images, self.thetas.to(images.device))
+        if self._stacked is not None:
+            outputs = self._forward_stacked(batch)
+        else:
+            chunks = batch.split(self.chunk_size) if self.chunk_size else (batch,)
+            outputs = torch.stack([torch.cat([model(chunk) for chunk in chunks]) for model in self.models])
+        # (M, B * N) -> (B, M * N)
+        probs = outputs[..., 0].float().view(len(self.models), images.shape[0], self.views)
+        return probs.permute(1, 0, 2).reshape(images.shape[0], -1)
+
+    def __call__(self, images):
+        """(B, 3, H, W) float images -> (mean, variance) tensors of shape (B,)"""
+        probs = self.samples_for(images)
+        return probs.mean(dim=1), probs.var(dim=1, unbiased=False)
+
+
+def _benchmark(views_list, models_list, batch, repeats, threads, chunk_size, stack):
+    """Latency of TTA/ensemble inference against one plain forward pass and N x M sequential passes"""
+    from model_registry import build_model
+
+    torch.manual_seed(0)
+    if threads:
+        torch.set_num_threads(threads)
+    images = torch.rand(batch, 3, 150, 150)
+    all_models = [build_model().eval() for _ in range(max(models_list))]
+    with torch.no_grad():
+        for _ in range(3):
+            all_models[0](images)
+        single = median_ms(lambda: all_models[0](images), repeats)
+    print(f"batch {batch}, {torch.get_num_threads()} thread(s), chunk size {chunk_size or 'unlimited'}"
+          f"{', stacked models' if stack else ''}; plain forward pass {single:.2f} ms\n")
+    print(f"{'views':>5} {'models':>6} {'samples':>7} {'batched ms':>10} {'x plain':>8} "
+          f"{'sequential ms':>13} {'speedup':>7}")
+    for models in models_list:
+        for views in views_list:
+            runner = TTAEnsemble(all_models[:models], views, chunk_size=chunk_size, stack=stack)
+            runner(images)
+            batched = median_ms(lambda: runner(images), repeats)
+            thetas = view_thetas(view_params(views), 150)
+
+            def sequential():
+                with torch.no_grad():
+                    for model in all_models[:models]:
+                        for theta in thetas:
+                            model(expand_views(images, theta[None]))
+
+            sequential_ms = median_ms(sequential, repeats)
+            print(f"{views:>5} {models:>6} {views * models:>7} {batched:>10.2f} {batched / single:>7.2f}x "
+                  f"{sequential_ms:>13.2f} {sequential_ms / batched:>6.2f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--views', type=int, nargs='+', default=[1, 2, 4, 8, 16])
+    parser.add_argument('--models', type=int, nargs='+', default=[1, 3])
+    parser.add_argument('--batch', type=int, default=1, help='images per request batch')
+    parser.add_argument('--repeats', type=int, default=30)
+    parser.add_argument('--threads', type=int, help='intra-op threads (default: torch default)')
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE,
+                        help='images per forward call (0: the whole view batch at once)')
+    parser.add_argument('--stack', action='store_true', help='run the models as one vmapped call')
+    args = parser.parse_args()
+    _benchmark(args.views, args.models, args.batch, args.repeats, args.threads, args.chunk_size or None, args.stack)
+
+
+if __name__ == '__main__':
+    main()
@@ -30,6 +30,15 @@ fi
 
 echo "✅ Backend files found!"
 
+# Check that the server's preprocessing matches the training pipeline
+echo "🔍 Checking preprocessing parity..."
+if ! (cd backend && python preprocessing.py); then
+    echo "❌ Preprocessing parity check failed!"
+    exit 1
+fi
+
+echo "✅ Preprocessing matches the training pipeline!"
+
 echo "🎉 Ready for deployment!"
 echo ""
 echo "Next steps:"
@@ -38,8 +47,8 @@ echo "2. Go to render.com"
 echo "3. Create a new Web Service"
 echo "4. Connect your GitHub repository"
 echo "5. Use these settings:"
-echo "   - Build Command: pip install -r backend/requirements.txt && npm install && npm run build"
-echo "   - Start Command: cd backend && gunicorn wsgi:app --bind 0.0.0.0:\$PORT --workers 1 --timeout 120"
+echo "   - Build Command: pip install -r backend/requirements.txt && (cd backend && python preprocessing.py) && npm install && npm run build"
+echo "   - Start Command: cd backend && gunicorn wsgi:app -c gunicorn.conf.py"
 echo "   - Environment: Python 3"
 echo ""
 echo "Your app will be available at: https://your-app-name.onrender.com" 
\ No newline at end of file